@@ -0,0 +1,341 @@
+"""
+Benchmarks of the exporters with synthetic rows, without a database, and of the sheets and the
+exporters on a synthetic edxapp dataset loaded on a local MySQL or MariaDB instance.
+
+    python benchmark.py xlsx --rows 200000
+    python benchmark.py dataset --config benchmark.ini --database edxapp_benchmark --enrollments 1M
+    python benchmark.py sheets --config benchmark.ini --database edxapp_benchmark --output results.json
+    python benchmark.py compare before.json results.json
+"""
+import argparse
+import configparser
+import datetime
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from decimal import Decimal
+
+import xlsxwriter
+from gspread.exceptions import WorksheetNotFound
+
+import dataset
+from metrics import peak_rss_bytes
+from nau import Reports, result_columns_and_rows
+from report_xlsx import _write_worksheet
+
+
+def synthetic_rows(count: int, seed: int = 0):
+	"""
+	Rows similar to the ones of `enrollments_with_profile_info`, with text, integer, decimal,
+	datetime and NULL values.
+	"""
+	rng = random.Random(seed)
+	start = datetime.datetime(2020, 1, 1)
+	for i in range(count):
+		yield {
+			"course_id": f"course-v1:ORG{i % 50}+C{i % 700}+{2020 + i % 4}_T{i % 3}",
+			"user_id": i,
+			"created": start + datetime.timedelta(seconds=rng.randrange(10 ** 8)),
+			"grade": Decimal(rng.randrange(101)) / 100,
+			"country": rng.choice(("PT", "BR", "AO", "MZ", None)),
+			"year_of_birth": rng.choice((None, rng.randrange(1940, 2010))),
+		}
+
+
+def _legacy_write_worksheet(columns: list, lines, worksheet):
+	"""
+	The previous writer, with a write call and the check of the datetime types on each cell.
+	"""
+	for col, key in enumerate(columns):
+		worksheet.write(0, col, key)
+	row = 1
+	for line in lines:
+		col = 0
+		for value in line.values():
+			if isinstance(value, (datetime.datetime, datetime.date, datetime.time, datetime.timedelta)):
+				worksheet.write_datetime(row, col, value)
+			else:
+				worksheet.write(row, col, value)
+			col += 1
+		row += 1
+
+
+def _run_xlsx(write_worksheet, constant_memory: bool, rows: int, directory: str, memory: bool) -> tuple:
+	path = os.path.join(directory, f"benchmark_{write_worksheet.__name__}_{constant_memory}.xlsx")
+	# generated before, so only the writer is measured
+	lines = list(synthetic_rows(rows))
+	columns = list(lines[0].keys())
+	if memory:
+		tracemalloc.start()
+	start = time.perf_counter()
+	workbook = xlsxwriter.Workbook(path, {'default_date_format': 'yyyy-mm-dd', 'constant_memory': constant_memory})
+	write_worksheet(columns, lines, workbook.add_worksheet("benchmark"))
+	workbook.close()
+	seconds = time.perf_counter() - start
+	peak = None
+	if memory:
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	return (seconds, peak, os.path.getsize(path))
+
+
+def benchmark_xlsx(rows: int, memory: bool = False):
+	"""
+	Rows per second, and the peak of allocated memory with `memory`, of the previous and the
+	current xlsx writers.
+	"""
+	with tempfile.TemporaryDirectory() as directory:
+		for name, write_worksheet, constant_memory in (
+			("previous (in memory, write per cell)", _legacy_write_worksheet, False),
+			("current (in memory, writer per column)", _write_worksheet, False),
+			("current (constant memory, writer per column)", _write_worksheet, True),
+		):
+			seconds, peak, size = _run_xlsx(write_worksheet, constant_memory, rows, directory, memory)
+			line = f"{name}: {rows / seconds:,.0f} rows/s, {seconds:.1f}s, {size / 1e6:.1f} MB file"
+			if peak is not None:
+				line += f", {peak / 1e6:.1f} MB peak memory"
+			print(line)
+
+
+class _LocalWorksheet:
+	"""
+	A worksheet kept in memory, with the methods of a gspread Worksheet used by the exporter.
+	The values of each update are encoded as JSON, like on the body of the request.
+	"""
+	def __init__(self, id: int, title: str, rows: int, cols: int):
+		self.id = id
+		self.title = title
+		self.row_count = rows
+		self.col_count = cols
+
+	def resize(self, rows: int = None, cols: int = None):
+		self.row_count = rows if rows is not None else self.row_count
+		self.col_count = cols if cols is not None else self.col_count
+
+	def update(self, range_name, values, **kwargs):
+		json.dumps({"range": range_name, "values": values})
+
+	def batch_update(self, data, **kwargs):
+		json.dumps(data)
+
+	def clear(self):
+		pass
+
+
+class _LocalSpreadsheet:
+	def __init__(self, id: str):
+		self.id = id
+		self._worksheets = {}
+
+	def worksheet(self, title: str) -> _LocalWorksheet:
+		if title not in self._worksheets:
+			raise WorksheetNotFound(title)
+		return self._worksheets[title]
+
+	def add_worksheet(self, title: str, rows: int, cols: int) -> _LocalWorksheet:
+		worksheet = self._worksheets[title] = _LocalWorksheet(len(self._worksheets), title, rows, cols)
+		return worksheet
+
+	def worksheets(self) -> list:
+		return list(self._worksheets.values())
+
+
+class LocalGoogleSheets:
+	"""
+	A gspread client with the spreadsheets in memory, to measure the Google Sheets exporter
+	without the network.
+	"""
+	def __init__(self):
+		self._spreadsheets = {}
+
+	def open_by_key(self, key: str) -> _LocalSpreadsheet:
+		return self._spreadsheets.setdefault(key, _LocalSpreadsheet(key))
+
+
+def benchmark_settings(config: configparser.ConfigParser) -> dict:
+	"""
+	The connection settings of the `[benchmark_connection]` section, never the ones of the
+	`[connection]` of the exports.
+	"""
+	return {name: config.get('benchmark_connection', name, fallback=default) for name, default in (('host', 'localhost'), ('port', '3306'), ('user', 'root'), ('password', ''))}
+
+
+def _benchmark_config(config: configparser.ConfigParser, database: str, directory: str) -> configparser.ConfigParser:
+	"""
+	A copy of the configuration with the `[benchmark_connection]` to `database` as its connection,
+	that writes to `directory`, without the incremental refresh, so every run queries all the rows.
+	"""
+	bench_config = configparser.ConfigParser(interpolation=None)
+	bench_config.read_dict({
+		section: dict(config.items(section, raw=True)) for section in config.sections()
+		if section != 'connection' and not section.startswith('connection:')
+	})
+	bench_config.read_dict({
+		'connection': {**dict(config.items('benchmark_connection', raw=True)), **benchmark_settings(config), 'database': database},
+		'incremental': {'enabled': 'False'},
+		'xlsx': {'file': os.path.join(directory, 'benchmark.xlsx'), 'manifest': os.path.join(directory, 'benchmark.xlsx.manifest.json')},
+		'google_upload': {'requests_per_minute': '0', 'delta': 'False', 'manifest': os.path.join(directory, 'google_sheets_manifest.json')},
+	})
+	return bench_config
+
+
+def _measured(function, memory: bool) -> tuple:
+	"""
+	The result of `function`, its seconds, its peak of allocated memory with `memory` and how much
+	it grew the peak resident memory of the process.
+	"""
+	if memory:
+		tracemalloc.start()
+	start = time.perf_counter()
+	rss_before = peak_rss_bytes()
+	try:
+		result = function()
+	finally:
+		seconds = time.perf_counter() - start
+		peak = None
+		if memory:
+			peak = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+		rss_growth = None if rss_before is None else peak_rss_bytes() - rss_before
+	return (result, seconds, peak, rss_growth)
+
+
+def _timing(seconds: float, rows: int, peak: int, rss_growth: int) -> dict:
+	return {
+		"seconds": round(seconds, 3),
+		"rows": rows,
+		"rows_per_second": round(rows / seconds, 1) if rows and seconds > 0 else None,
+		"peak_memory_bytes": peak,
+		"peak_rss_growth_bytes": rss_growth,
+	}
+
+
+def _consume_sheet(report: Reports, key: str) -> int:
+	rows = 0
+	for _, _, data in report.produce_sheets([key]):
+		_, lines = result_columns_and_rows(data)
+		for _ in lines:
+			rows += 1
+	return rows
+
+
+def benchmark_sheets(config: configparser.ConfigParser, database: str, sheets_keys: list = None, memory: bool = False) -> dict:
+	"""
+	The wall time, rows, rows per second and peak memory of producing each sheet on its own,
+	without the results shared with the other sheets, and of the xlsx and the Google Sheets
+	exporters with all the sheets, the Google Sheets with the spreadsheets in memory.
+	"""
+	with tempfile.TemporaryDirectory() as directory:
+		config = _benchmark_config(config, database, directory)
+		report = Reports(config, use_cache=False)
+		report.progress = False
+		keys = sheets_keys or list(report.available_sheets_to_export_keys())
+		results = {
+			"generated": datetime.datetime.now().isoformat(timespec='seconds'),
+			"database": f"{config.get('connection', 'host', fallback='localhost')}:{config.get('connection', 'port', fallback='3306')}/{config.get('connection', 'database', fallback='edxapp')}",
+			"tables": {},
+			"sheets": {},
+			"exporters": {},
+		}
+		try:
+			for table in dataset.TABLES:
+				results["tables"][table] = report.data_link.get(f"SELECT COUNT(1) FROM {table}")
+
+			for key in keys:
+				report.forget_shared_results()
+				rows, seconds, peak, rss_growth = _measured(lambda: _consume_sheet(report, key), memory)
+				sheet_metrics = report.metrics.sheet(key).to_dict()
+				results["sheets"][key] = {
+					**_timing(seconds, rows, peak, rss_growth),
+					**{name: value for name, value in sheet_metrics.items() if name.endswith('_seconds')},
+				}
+				print(f"{key}: {seconds:.2f}s, {rows:,} rows")
+		finally:
+			report.close()
+
+		from report_google import export_queries_to_google
+		from report_xlsx import export_to_xlsx
+		config.read_dict({'xlsx': {'export': ','.join(keys)}, 'google_sheets': {key: f"benchmark-{key}" for key in keys}})
+		for target, export in (
+			('xlsx', lambda report: export_to_xlsx(config, report)),
+			('google_sheets', lambda report: export_queries_to_google(config, report, LocalGoogleSheets())),
+		):
+			report = Reports(config, use_cache=False)
+			report.progress = False
+			try:
+				_, seconds, peak, rss_growth = _measured(lambda: export(report), memory)
+			finally:
+				report.close()
+			rows = sum(sheet.targets.get(target, {}).get("rows") or 0 for sheet in report.metrics.sheets.values())
+			results["exporters"][target] = _timing(seconds, rows, peak, rss_growth)
+			print(f"{target} exporter: {seconds:.2f}s, {rows:,} rows")
+	return results
+
+
+def compare(before: dict, after: dict):
+	"""
+	Print the seconds of each sheet and exporter on two results, and the ratio of the second to the first.
+	"""
+	for group in ('sheets', 'exporters'):
+		for key, result in after[group].items():
+			previous = before[group].get(key)
+			if previous is None:
+				print(f"{key}: {result['seconds']:.2f}s, new")
+				continue
+			ratio = result['seconds'] / previous['seconds'] if previous['seconds'] else float('inf')
+			print(f"{key}: {previous['seconds']:.2f}s -> {result['seconds']:.2f}s ({ratio:.2f}x)")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Benchmarks of the exporters and of the sheets.')
+	subparsers = parser.add_subparsers(dest='target', required=True)
+
+	xlsx_parser = subparsers.add_parser('xlsx', help='The xlsx writer with synthetic rows, without a database.')
+	xlsx_parser.add_argument('--rows', type=int, default=200000, help='Number of synthetic rows.')
+	xlsx_parser.add_argument('--memory', action='store_true', help='Also measure the peak of allocated memory, slower.')
+
+	dataset_parser = subparsers.add_parser('dataset', help='Load a synthetic edxapp dataset on a database of the [benchmark_connection], creating its tables.')
+	dataset_parser.add_argument('--config', type=argparse.FileType('r'), required=True, help='A config.ini with the [benchmark_connection] of a local database server.')
+	dataset_parser.add_argument('--database', required=True, help='The database of the dataset, not edxapp unless with --yes-drop-tables.')
+	dataset_parser.add_argument('--yes-drop-tables', action='store_true', help='Replace the tables of the dataset even if they have rows.')
+	dataset_parser.add_argument('--enrollments', type=dataset.parse_scale, default=dataset.parse_scale('10k'), help='Number of enrollments, e.g. 10k or 10M, the other tables are proportional.')
+	dataset_parser.add_argument('--seed', type=int, default=0, help='Seed of the generated rows.')
+
+	sheets_parser = subparsers.add_parser('sheets', help='Each sheet and the xlsx and Google Sheets exporters on the database of the config.')
+	sheets_parser.add_argument('--config', type=argparse.FileType('r'), required=True, help='A config.ini with the [benchmark_connection] of a local database server.')
+	sheets_parser.add_argument('--database', required=True, help='The database of the dataset.')
+	sheets_parser.add_argument('--sheets', type=lambda value: value.split(','), help='Comma separated keys of the sheets, by default all.')
+	sheets_parser.add_argument('--memory', action='store_true', help='Also measure the peak of allocated memory, slower.')
+	sheets_parser.add_argument('--output', help='Save the results as JSON on this path.')
+
+	compare_parser = subparsers.add_parser('compare', help='Compare two results of the sheets benchmark.')
+	compare_parser.add_argument('before', help='The path of the previous results.')
+	compare_parser.add_argument('after', help='The path of the current results.')
+	args = parser.parse_args()
+
+	match args.target:
+		case 'xlsx':
+			benchmark_xlsx(args.rows, args.memory)
+		case 'dataset' | 'sheets':
+			config = configparser.ConfigParser()
+			config.read_string(args.config.read())
+			if not config.has_section('benchmark_connection'):
+				parser.error("the config needs a [benchmark_connection] section, the [connection] of the exports is never used by the benchmarks")
+			if args.target == 'dataset':
+				if args.database == 'edxapp' and not args.yes_drop_tables:
+					parser.error("the edxapp database is only replaced with --yes-drop-tables, use another --database")
+				try:
+					dataset.load(benchmark_settings(config), args.database, args.enrollments, args.seed, replace=args.yes_drop_tables)
+				except ValueError as e:
+					parser.error(str(e))
+			else:
+				results = benchmark_sheets(config, args.database, args.sheets, args.memory)
+				if args.output:
+					with open(args.output, 'w') as f:
+						json.dump(results, f, indent=1)
+		case 'compare':
+			with open(args.before) as before, open(args.after) as after:
+				compare(json.load(before), json.load(after))
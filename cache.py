@@ -0,0 +1,256 @@
+"""
+Local cache of the query results, so a retry or a re-export soon after a run doesn't run the
+queries again on the database.
+Each result is stored on a file keyed by the sheet that runs the query, a hash of the SQL and of
+the connection target, and it is served while younger than the TTL of that sheet. The oldest files
+are evicted when the cache exceeds its maximum size.
+"""
+import hashlib
+import itertools
+import os
+import pickle
+import threading
+import time
+
+# rows of each pickled batch of a cache file
+_BATCH_SIZE = 1000
+
+
+class ResultCache:
+	"""
+	Query results stored on files of `directory`, as a header with the columns and the description
+	of the query followed by batches of rows, each one a tuple of values.
+	"""
+	directory : str
+	target : str
+	default_ttl : int
+	ttls : dict
+	max_size_bytes : int
+	refresh : set
+
+	def __init__(self, directory: str, target: str, default_ttl: int = 3600, ttls: dict = None, max_size_bytes: int = 1 << 30, refresh: set = None):
+		"""
+		`ttls` are the seconds that the results of each sheet key are valid, by default `default_ttl`,
+		and the sheets of `refresh` are always queried again, replacing their cached results.
+		"""
+		self.directory = directory
+		self.target = target
+		self.default_ttl = default_ttl
+		self.ttls = ttls or {}
+		self.max_size_bytes = max_size_bytes
+		self.refresh = set(refresh or ())
+		self._lock = threading.Lock()
+
+	def _path(self, sheet_key: str, query: str) -> str:
+		digest = hashlib.sha256(f"{self.target}\n{query}".encode()).hexdigest()[:32]
+		return os.path.join(self.directory, f"{sheet_key}-{digest}.pickle")
+
+	def lookup(self, sheet_key: str, query: str):
+		"""
+		The valid cached result of the query opened for reading, or None. It is opened while the
+		results can't be evicted, so it is still read when evicted later.
+		"""
+		if sheet_key in self.refresh:
+			return None
+		path = self._path(sheet_key, query)
+		with self._lock:
+			try:
+				age = time.time() - os.path.getmtime(path)
+				if age > self.ttls.get(sheet_key, self.default_ttl):
+					_remove_quietly(path)
+					return None
+				return open(path, 'rb')
+			except FileNotFoundError:
+				return None
+
+	def writer(self, sheet_key: str, query: str, columns: list, description) -> 'CacheEntryWriter':
+		return CacheEntryWriter(self, self._path(sheet_key, query), columns, description)
+
+	def evict(self):
+		"""
+		Remove the oldest results until the cache isn't bigger than `max_size_bytes`.
+		"""
+		with self._lock:
+			entries = []
+			for entry in os.scandir(self.directory):
+				if entry.name.endswith('.pickle'):
+					stat = entry.stat()
+					entries.append((stat.st_mtime, stat.st_size, entry.path))
+			size = sum(entry[1] for entry in entries)
+			for _, entry_size, path in sorted(entries):
+				if size <= self.max_size_bytes:
+					break
+				_remove_quietly(path)
+				size -= entry_size
+
+
+def _remove_quietly(path: str):
+	try:
+		os.remove(path)
+	except FileNotFoundError:
+		pass
+
+
+class CacheEntryWriter:
+	"""
+	Writes a result to a temporary file, that replaces the cached one on `commit`.
+	"""
+	def __init__(self, cache: ResultCache, path: str, columns: list, description):
+		self.cache = cache
+		self.path = path
+		os.makedirs(cache.directory, exist_ok=True)
+		self._tmp_path = f"{path}.{threading.get_ident()}.tmp"
+		self._file = open(self._tmp_path, 'wb')
+		pickle.dump({"columns": list(columns), "description": description}, self._file)
+
+	def write(self, rows: list):
+		if rows:
+			pickle.dump(rows, self._file)
+
+	def commit(self):
+		self._file.close()
+		os.replace(self._tmp_path, self.path)
+		self.cache.evict()
+
+	def discard(self):
+		self._file.close()
+		_remove_quietly(self._tmp_path)
+
+
+def _read_header(f) -> dict:
+	return pickle.load(f)
+
+
+def _read_batches(f):
+	while True:
+		try:
+			yield pickle.load(f)
+		except EOFError:
+			return
+
+
+class CachedStream:
+	"""
+	The rows of a cached result, read one batch at a time from its open file, with the interface of
+	a RowStream.
+	"""
+	description = None
+	columns : list = None
+
+	def __init__(self, f):
+		self._file = f
+
+	def open(self):
+		if self.columns is None:
+			header = _read_header(self._file)
+			self.columns = header["columns"]
+			self.description = header["description"]
+		return self
+
+	def __iter__(self):
+		self.open()
+		try:
+			columns = self.columns
+			for batch in _read_batches(self._file):
+				for values in batch:
+					yield dict(zip(columns, values))
+		finally:
+			self.close()
+
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+
+
+class RecordingStream:
+	"""
+	A stream of rows from the database that also writes them to the cache, the result is only
+	cached when all the rows are read.
+	"""
+	def __init__(self, stream, cache: ResultCache, sheet_key: str, query: str):
+		self._stream = stream
+		self._cache = cache
+		self._sheet_key = sheet_key
+		self._query = query
+
+	@property
+	def columns(self) -> list:
+		return self._stream.columns
+
+	@property
+	def description(self):
+		return self._stream.description
+
+	def open(self):
+		self._stream.open()
+		return self
+
+	def __iter__(self):
+		self.open()
+		writer = self._cache.writer(self._sheet_key, self._query, self.columns, self.description)
+		finished = False
+		try:
+			rows = iter(self._stream)
+			for batch in iter(lambda: list(itertools.islice(rows, _BATCH_SIZE)), []):
+				writer.write([tuple(row.values()) for row in batch])
+				yield from batch
+			finished = True
+		finally:
+			if finished:
+				writer.commit()
+			else:
+				writer.discard()
+
+	def close(self):
+		self._stream.close()
+
+
+class CachingDataLink:
+	"""
+	A DataLink that serves the results of the queries of each sheet from the cache, and caches the
+	results of the queries that it runs. `sheet_key()` returns the key of the sheet being produced,
+	the queries outside of a sheet aren't cached, and `result_type` is the list of the results with
+	a `description`. The other methods are the ones of the wrapped `data_link`.
+	"""
+	def __init__(self, data_link, cache: ResultCache, sheet_key, result_type):
+		self.data_link = data_link
+		self.cache = cache
+		self.sheet_key = sheet_key
+		self.result_type = result_type
+
+	def __getattr__(self, name):
+		return getattr(self.data_link, name)
+
+	def query(self, query):
+		sheet_key = self.sheet_key()
+		if sheet_key is None:
+			return self.data_link.query(query)
+		f = self.cache.lookup(sheet_key, query)
+		if f is not None:
+			with f:
+				header = _read_header(f)
+				result = self.result_type(dict(zip(header["columns"], values)) for batch in _read_batches(f) for values in batch)
+			result.description = header["description"]
+			return result
+
+		result = self.data_link.query(query)
+		# the results of the local store have no description
+		columns = [column[0] for column in result.description] if result.description else list(result[0].keys()) if result else []
+		writer = self.cache.writer(sheet_key, query, columns, result.description)
+		try:
+			for start in range(0, len(result), _BATCH_SIZE):
+				writer.write([tuple(row.values()) for row in result[start:start + _BATCH_SIZE]])
+		except BaseException:
+			writer.discard()
+			raise
+		writer.commit()
+		return result
+
+	def stream(self, query, batch_size: int = 10000):
+		sheet_key = self.sheet_key()
+		if sheet_key is None:
+			return self.data_link.stream(query, batch_size)
+		f = self.cache.lookup(sheet_key, query)
+		if f is not None:
+			return CachedStream(f)
+		return RecordingStream(self.data_link.stream(query, batch_size), self.cache, sheet_key, query)
@@ -0,0 +1,87 @@
+"""
+Conversion of the values of the sheets for the exporters, with a function chosen once per column
+instead of checking the type of every value.
+The kind of each column comes from the description of its query, when the rows come directly
+from the database, or from the first value of the column that isn't NULL.
+"""
+import datetime
+from decimal import Decimal
+
+from mysql.connector import FieldType
+
+NUMBER = 'number'
+TEXT = 'text'
+DATE = 'date'
+TIME = 'time'
+OTHER = 'other'
+
+_KINDS_BY_TYPE_CODE = {
+	**{type_code: NUMBER for type_code in FieldType.get_number_types()},
+	**{type_code: DATE for type_code in FieldType.get_timestamp_types()},
+	FieldType.DATE: DATE,
+	FieldType.NEWDATE: DATE,
+	FieldType.TIME: TIME,
+	**{type_code: TEXT for type_code in FieldType.get_string_types()},
+}
+
+
+def kind_of_type_code(type_code: int) -> str:
+	"""
+	Kind of the values of a column with the `type_code` of the cursor description. The binary
+	and JSON columns are OTHER, as their values may not be text.
+	"""
+	return _KINDS_BY_TYPE_CODE.get(type_code, OTHER)
+
+
+def kind_of_value(value) -> str:
+	if isinstance(value, bool):
+		return OTHER
+	if isinstance(value, (int, float, Decimal)):
+		return NUMBER
+	if isinstance(value, str):
+		return TEXT
+	if isinstance(value, (datetime.datetime, datetime.date)):
+		return DATE
+	if isinstance(value, (datetime.time, datetime.timedelta)):
+		return TIME
+	return OTHER
+
+
+def column_kinds(data, columns: list) -> list:
+	"""
+	Kind of each column of a sheet result from the description of its query, or None for each
+	column when the result has no description, e.g. the rows computed by the exporter.
+	"""
+	description = getattr(data, 'description', None)
+	if description is None or [column[0] for column in description] != list(columns):
+		return [None] * len(columns)
+	return [kind_of_type_code(column[1]) for column in description]
+
+
+class ColumnConverters:
+	"""
+	Converts the values of each row with a function per column, from `converters`, a dict of
+	function by kind, or `fallback` for the other kinds. The functions receive None for NULL.
+	The columns without a kind get the function of the kind of their first value not NULL.
+	"""
+	functions : list
+
+	def __init__(self, kinds: list, converters: dict, fallback):
+		self.converters = converters
+		self.fallback = fallback
+		self.functions = [self._resolver(index) if kind is None else converters.get(kind, fallback) for index, kind in enumerate(kinds)]
+
+	def _resolver(self, index: int):
+		def resolve(value):
+			if value is None:
+				return self.fallback(value)
+			function = self.functions[index] = self.converters.get(kind_of_value(value), self.fallback)
+			return function(value)
+		return resolve
+
+	def convert(self, values) -> list:
+		try:
+			return [function(value) for function, value in zip(self.functions, values)]
+		except (TypeError, AttributeError, ValueError):
+			# a value with other type than the one of its column
+			return [self.fallback(value) for value in values]
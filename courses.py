@@ -0,0 +1,163 @@
+"""
+Course level data shared by the sheets: the course overviews, the organization names and the
+aggregates of each course run, loaded once per run.
+"""
+from datetime import datetime
+from functools import lru_cache, reduce
+
+import numpy as np
+
+
+def collation_key(value):
+	"""
+	Key that groups the values like the case insensitive and pad space collations of the database.
+	"""
+	if isinstance(value, str):
+		return value.rstrip(' ').casefold()
+	return value
+
+
+def substring_index(value: str, delimiter: str, count: int) -> str:
+	"""
+	The same as the SUBSTRING_INDEX function of the database.
+	"""
+	if value is None:
+		return None
+	if count == 0:
+		return ''
+	parts = value.split(delimiter)
+	return delimiter.join(parts[:count] if count > 0 else parts[count:])
+
+
+@lru_cache(maxsize=None)
+def course_key_parts(course_id: str) -> tuple:
+	"""
+	The org, course and edition codes of a course id, the same as the SUBSTRING_INDEX of the queries.
+	There are few distinct course ids, so the parsing of each one is memoized.
+	"""
+	return (
+		substring_index(substring_index(course_id, ':', -1), '+', 1),
+		substring_index(substring_index(course_id, '+', -2), '+', 1),
+		substring_index(course_id, '+', -1),
+	)
+
+
+def datediff(value: datetime, reference: datetime) -> int:
+	"""
+	The same as the DATEDIFF function of the database.
+	"""
+	if value is None or reference is None:
+		return None
+	return (value.date() - reference.date()).days
+
+
+def to_datetime64(values) -> np.ndarray:
+	"""
+	Array of datetime64 of a list of datetimes or "%Y-%m-%d" dates, NULL values are NaT.
+	"""
+	return np.array([np.datetime64('NaT') if value is None else value for value in values], dtype='datetime64[us]')
+
+
+def availability_states(reference, enrollment_start, enrollment_end, start, end) -> np.ndarray:
+	"""
+	Availability of each course run on the `reference` datetime, the same as the CASE of the
+	queries, over datetime64 arrays, or a datetime64 scalar `reference`, with NaT as NULL.
+	"""
+	# each condition is a pair of masks (true, false), both are False when the condition is NULL
+	def lt(a, b):
+		known = ~(np.isnat(a) | np.isnat(b))
+		less = a < b
+		return (known & less, known & ~less)
+	def and_(*conditions):
+		return (reduce(np.logical_and, [c[0] for c in conditions]), reduce(np.logical_or, [c[1] for c in conditions]))
+	def not_(condition):
+		return (condition[1], condition[0])
+
+	opens = np.where(np.isnat(enrollment_start), start, enrollment_start)
+	closes = np.where(np.isnat(enrollment_end), end, enrollment_end)
+	enrollment_open = and_(lt(opens, reference), lt(reference, closes))
+	running = and_(lt(start, reference), lt(reference, end))
+	before_start = lt(reference, start)
+	after_end = lt(end, reference)
+	reference_not_null = (~np.isnat(reference), np.isnat(reference))
+
+	conditions = [
+		and_(enrollment_open, running),
+		and_(enrollment_open, before_start),
+		and_(enrollment_open, after_end),
+		and_(lt(reference, opens), before_start),
+		and_(not_(enrollment_open), reference_not_null, before_start),
+		and_(not_(enrollment_open), running),
+		and_(not_(enrollment_open), after_end),
+	]
+	labels = ['ONGOING_OPEN', 'FUTURE_OPEN', 'ARCHIVED_OPEN', 'FUTURE_NOT_YET_OPEN', 'FUTURE_CLOSED', 'ONGOING_CLOSED', 'ARCHIVED_CLOSED']
+	shape = np.broadcast(reference, start).shape
+	return np.select([np.broadcast_to(c[0], shape) for c in conditions], labels, default='OTHER')
+
+
+def organization_names(organizations: list) -> dict:
+	"""
+	Name of each organization by its short name, ignoring the case.
+	"""
+	names = {}
+	for organization in organizations:
+		names.setdefault(collation_key(organization['short_name']), organization['name'])
+	return names
+
+
+class CourseDimension:
+	"""
+	Course overviews, organization names and aggregates of each course run.
+	The lookups by id, short name or course code ignore the case, like the database collation.
+	"""
+	overviews : list
+	aggregate_columns = ('enrolled_count', 'enrolled_count_active', 'certificates_count', 'average_grade', 'passed')
+
+	def __init__(self, overviews: list, organizations: list, aggregates: list):
+		"""
+		`overviews` are the course overviews ordered by creation, with the `id`, `course_code`
+		and `created` columns; `organizations` have the `short_name` and `name` columns; and
+		`aggregates` are lists of rows with a `course_id` column and some of the `aggregate_columns`.
+		"""
+		self.overviews = overviews
+		self._by_id = {}
+		self._runs_count = {}
+		self._first_edition = {}
+		for overview in overviews:
+			self._by_id.setdefault(collation_key(overview['id']), overview)
+			code = collation_key(overview['course_code'])
+			self._runs_count[code] = self._runs_count.get(code, 0) + 1
+			self._first_edition.setdefault(code, overview['id'])
+
+		self._org_names = organization_names(organizations)
+
+		self._aggregates = {}
+		for rows in aggregates:
+			for row in rows:
+				values = self._aggregates.setdefault(collation_key(row['course_id']), {})
+				values.update((column, value) for column, value in row.items() if column != 'course_id')
+
+	def overview(self, course_id: str) -> dict:
+		return self._by_id.get(collation_key(course_id))
+
+	def org_name(self, org_code: str) -> str:
+		return self._org_names.get(collation_key(org_code))
+
+	def aggregates(self, course_id: str) -> dict:
+		"""
+		The aggregates of a course run, the counts are 0 and the average grade None without rows.
+		"""
+		values = self._aggregates.get(collation_key(course_id), {})
+		return {column: values.get(column, None if column == 'average_grade' else 0) for column in self.aggregate_columns}
+
+	def runs_count(self, course_code: str) -> int:
+		return self._runs_count.get(collation_key(course_code), 0)
+
+	def is_first_edition(self, course_code: str, course_id: str) -> int:
+		"""
+		1 if the course run is the first created of its course code, None if the code is unknown.
+		"""
+		first_edition = self._first_edition.get(collation_key(course_code))
+		if first_edition is None:
+			return None
+		return int(collation_key(first_edition) == collation_key(course_id))
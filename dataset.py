@@ -0,0 +1,338 @@
+"""
+Synthetic edxapp dataset, with the tables and columns read by the sheets, generated from a seed so
+the same scale always has the same rows, to benchmark the sheets on a local MySQL or MariaDB
+instance without a copy of the production data.
+The size of the dataset is given by its number of enrollments, the other tables are proportional.
+"""
+import datetime
+import random
+from decimal import Decimal
+
+import mysql.connector
+
+# the rows of the synthetic dataset are dated on this range, so they don't depend on the day of the run
+START = datetime.datetime(2019, 1, 1)
+END = datetime.datetime(2026, 1, 1)
+
+# rows of each INSERT
+_INSERT_BATCH_SIZE = 5000
+
+TABLES = {
+	"organizations_organization": """
+		CREATE TABLE organizations_organization (
+			id INT PRIMARY KEY,
+			created DATETIME(6) NOT NULL,
+			modified DATETIME(6) NOT NULL,
+			name VARCHAR(255) NOT NULL,
+			short_name VARCHAR(255) NOT NULL,
+			description LONGTEXT,
+			logo VARCHAR(255),
+			active TINYINT(1) NOT NULL,
+			KEY organizations_organization_short_name (short_name)
+		)""",
+	"course_overviews_courseoverview": """
+		CREATE TABLE course_overviews_courseoverview (
+			created DATETIME(6) NOT NULL,
+			modified DATETIME(6) NOT NULL,
+			id VARCHAR(255) PRIMARY KEY,
+			_location VARCHAR(255) NOT NULL,
+			display_name LONGTEXT,
+			start DATETIME(6),
+			end DATETIME(6),
+			advertised_start LONGTEXT,
+			course_image_url LONGTEXT NOT NULL,
+			social_sharing_url LONGTEXT,
+			certificates_display_behavior LONGTEXT,
+			certificates_show_before_end TINYINT(1) NOT NULL,
+			cert_html_view_enabled TINYINT(1) NOT NULL,
+			has_any_active_web_certificate TINYINT(1) NOT NULL,
+			cert_name_short LONGTEXT NOT NULL,
+			cert_name_long LONGTEXT NOT NULL,
+			lowest_passing_grade DECIMAL(5,2),
+			days_early_for_beta DOUBLE,
+			mobile_available TINYINT(1) NOT NULL,
+			visible_to_staff_only TINYINT(1) NOT NULL,
+			enrollment_start DATETIME(6),
+			enrollment_end DATETIME(6),
+			enrollment_domain LONGTEXT,
+			invitation_only TINYINT(1) NOT NULL,
+			max_student_enrollments_allowed INT,
+			announcement DATETIME(6),
+			catalog_visibility LONGTEXT,
+			course_video_url LONGTEXT,
+			effort LONGTEXT,
+			self_paced TINYINT(1) NOT NULL,
+			certificate_available_date DATETIME(6)
+		)""",
+	"auth_user": """
+		CREATE TABLE auth_user (
+			id INT PRIMARY KEY,
+			username VARCHAR(150) NOT NULL,
+			is_active TINYINT(1) NOT NULL,
+			date_joined DATETIME(6) NOT NULL,
+			UNIQUE KEY username (username)
+		)""",
+	"auth_userprofile": """
+		CREATE TABLE auth_userprofile (
+			id INT PRIMARY KEY,
+			user_id INT NOT NULL,
+			year_of_birth INT,
+			gender VARCHAR(6),
+			level_of_education VARCHAR(6),
+			country VARCHAR(2),
+			UNIQUE KEY user_id (user_id)
+		)""",
+	"nau_openedx_extensions_nauuserextendedmodel": """
+		CREATE TABLE nau_openedx_extensions_nauuserextendedmodel (
+			id INT PRIMARY KEY,
+			user_id INT NOT NULL,
+			employment_situation VARCHAR(255),
+			UNIQUE KEY user_id (user_id)
+		)""",
+	"student_courseenrollment": """
+		CREATE TABLE student_courseenrollment (
+			id INT PRIMARY KEY,
+			user_id INT NOT NULL,
+			course_id VARCHAR(255) NOT NULL,
+			created DATETIME(6),
+			is_active TINYINT(1) NOT NULL,
+			mode VARCHAR(100) NOT NULL,
+			UNIQUE KEY student_courseenrollment_user_id_course_id (user_id, course_id),
+			KEY student_courseenrollment_course_id (course_id),
+			KEY student_courseenrollment_created (created)
+		)""",
+	"grades_persistentcoursegrade": """
+		CREATE TABLE grades_persistentcoursegrade (
+			id BIGINT PRIMARY KEY,
+			user_id INT NOT NULL,
+			course_id VARCHAR(255) NOT NULL,
+			percent_grade DOUBLE NOT NULL,
+			letter_grade VARCHAR(255) NOT NULL,
+			passed_timestamp DATETIME(6),
+			created DATETIME(6) NOT NULL,
+			modified DATETIME(6) NOT NULL,
+			UNIQUE KEY course_user (course_id, user_id),
+			KEY user_id (user_id),
+			KEY passed_timestamp_course_id (passed_timestamp, course_id),
+			KEY modified (modified)
+		)""",
+	"certificates_generatedcertificate": """
+		CREATE TABLE certificates_generatedcertificate (
+			id INT PRIMARY KEY,
+			user_id INT NOT NULL,
+			course_id VARCHAR(255) NOT NULL,
+			grade VARCHAR(5) NOT NULL,
+			status VARCHAR(32) NOT NULL,
+			mode VARCHAR(32) NOT NULL,
+			created_date DATETIME(6) NOT NULL,
+			modified_date DATETIME(6) NOT NULL,
+			UNIQUE KEY user_id_course_id (user_id, course_id),
+			KEY course_id (course_id)
+		)""",
+	"completion_blockcompletion": """
+		CREATE TABLE completion_blockcompletion (
+			id BIGINT PRIMARY KEY,
+			user_id INT NOT NULL,
+			course_key VARCHAR(255) NOT NULL,
+			block_key VARCHAR(255) NOT NULL,
+			block_type VARCHAR(64) NOT NULL,
+			completion DOUBLE NOT NULL,
+			created DATETIME(6) NOT NULL,
+			modified DATETIME(6) NOT NULL,
+			UNIQUE KEY course_key_block_key_user (course_key, block_key, user_id),
+			KEY user_course_modified (user_id, course_key, modified)
+		)""",
+}
+
+_GENDERS = ('m', 'f', 'o', '', None)
+_LEVELS_OF_EDUCATION = ('p', 'm', 'b', 'a', 'hs', 'jhs', 'el', 'none', 'other', '', None)
+_COUNTRIES = ('PT', 'PT', 'PT', 'PT', 'BR', 'BR', 'AO', 'MZ', 'CV', 'ES', 'FR', 'US', '', None)
+_EMPLOYMENT_SITUATIONS = ('employed', 'unemployed', 'student', 'retired', 'self-employed', None)
+_MODES = ('audit', 'audit', 'audit', 'honor', 'verified')
+
+
+def parse_scale(value: str) -> int:
+	"""
+	A number of enrollments, with an optional k or M suffix, e.g. 10k or 10M.
+	"""
+	multipliers = {'k': 1000, 'm': 1000000}
+	value = value.strip()
+	if value and value[-1].lower() in multipliers:
+		return int(float(value[:-1]) * multipliers[value[-1].lower()])
+	return int(value)
+
+
+def scale_counts(enrollments: int) -> dict:
+	"""
+	The number of rows of the main tables of a dataset with `enrollments` enrollments.
+	"""
+	courses = max(20, enrollments // 2000)
+	return {
+		"enrollments": enrollments,
+		"users": max(1, enrollments // 4),
+		"courses": courses,
+		"organizations": max(5, courses // 40),
+	}
+
+
+def _random_datetime(rng: random.Random, start: datetime.datetime = START, end: datetime.datetime = END) -> datetime.datetime:
+	return start + datetime.timedelta(seconds=rng.randrange(max(1, int((end - start).total_seconds()))))
+
+
+def course_id(course: int, counts: dict) -> str:
+	"""
+	The id of a course run, with 3 editions of each course code.
+	"""
+	organization = course % counts["organizations"]
+	return f"course-v1:ORG{organization}+C{course // 3}+{2019 + course % 7}_T{course % 3 + 1}"
+
+
+def organizations(counts: dict, rng: random.Random):
+	for organization in range(counts["organizations"]):
+		created = _random_datetime(rng, START, START + datetime.timedelta(days=365))
+		yield (organization + 1, created, created, f"Organization {organization}", f"ORG{organization}", f"Description of organization {organization}", f"organization_logos/org{organization}.png", 1)
+
+
+def course_overviews(counts: dict, rng: random.Random):
+	for course in range(counts["courses"]):
+		key = course_id(course, counts)
+		created = _random_datetime(rng)
+		enrollment_start = created + datetime.timedelta(days=rng.randrange(1, 60))
+		start = enrollment_start + datetime.timedelta(days=rng.randrange(0, 60))
+		end = start + datetime.timedelta(days=rng.randrange(14, 180))
+		enrollment_end = rng.choice((None, end, start + datetime.timedelta(days=7)))
+		self_paced = rng.random() < 0.3
+		yield (
+			created, created, key, f"block-v1:{key[10:]}+type@course+block@course", f"Course {course // 3} edition {course % 3 + 1}",
+			start, end, None, f"/asset-v1:{key[10:]}+type@asset+block@course_image.png", f"https://www.nau.edu.pt/pt/curso/c{course // 3}/",
+			'end', 0, 1, rng.random() < 0.8, f"C{course // 3}", f"Course {course // 3}",
+			Decimal('0.50'), 0.0, 0, 0, enrollment_start if rng.random() < 0.9 else None,
+			enrollment_end, None, rng.random() < 0.05, None, None, 'both',
+			None, f"{rng.randrange(2, 8)}h", self_paced, None,
+		)
+
+
+def users(counts: dict, rng: random.Random):
+	"""
+	The rows of auth_user, auth_userprofile and nau_openedx_extensions_nauuserextendedmodel.
+	"""
+	for user in range(1, counts["users"] + 1):
+		yield "auth_user", (user, f"user{user}", rng.random() < 0.9, _random_datetime(rng))
+		yield "auth_userprofile", (user, user, rng.choice((None, rng.randrange(1940, 2010))), rng.choice(_GENDERS), rng.choice(_LEVELS_OF_EDUCATION), rng.choice(_COUNTRIES))
+		if rng.random() < 0.7:
+			yield "nau_openedx_extensions_nauuserextendedmodel", (user, user, rng.choice(_EMPLOYMENT_SITUATIONS))
+
+
+def enrollments(counts: dict, rng: random.Random, completions_per_enrollment: int = 3):
+	"""
+	The rows of student_courseenrollment, and of the grades, certificates and block completions
+	of its enrollments. Each user is enrolled on a different course on each round over the users.
+	"""
+	grade_id = certificate_id = completion_id = 0
+	for enrollment in range(counts["enrollments"]):
+		user = enrollment % counts["users"] + 1
+		course = (user * 31 + enrollment // counts["users"]) % counts["courses"]
+		key = course_id(course, counts)
+		created = _random_datetime(rng)
+		yield "student_courseenrollment", (enrollment + 1, user, key, created, rng.random() < 0.95, rng.choice(_MODES))
+
+		if rng.random() < 0.6:
+			grade_id += 1
+			percent = round(rng.random(), 2)
+			passed = percent >= 0.5
+			graded = created + datetime.timedelta(days=rng.randrange(1, 120))
+			yield "grades_persistentcoursegrade", (grade_id, user, key, percent, 'Pass' if passed else '', graded if passed else None, graded, graded)
+			if passed and rng.random() < 0.8:
+				certificate_id += 1
+				certified = graded + datetime.timedelta(days=rng.randrange(0, 30))
+				yield "certificates_generatedcertificate", (certificate_id, user, key, f"{percent:.2f}", 'downloadable', 'honor', certified, certified)
+
+		for block in range(rng.randrange(0, 2 * completions_per_enrollment + 1)):
+			completion_id += 1
+			completed = created + datetime.timedelta(seconds=rng.randrange(90 * 24 * 3600))
+			yield "completion_blockcompletion", (completion_id, user, key, f"block-v1:{key[10:]}+type@problem+block@b{block}", 'problem', 1.0, completed, completed)
+
+
+class _Inserter:
+	"""
+	Inserts the rows of several tables in batches, committing after each batch.
+	"""
+	def __init__(self, connection):
+		self.connection = connection
+		self.cursor = connection.cursor()
+		self.batches = {}
+		self.counts = {}
+
+	def add(self, table: str, row: tuple):
+		batch = self.batches.setdefault(table, [])
+		batch.append(row)
+		if len(batch) >= _INSERT_BATCH_SIZE:
+			self.flush(table)
+
+	def flush(self, table: str):
+		batch = self.batches.pop(table, None)
+		if not batch:
+			return
+		self.cursor.executemany(f"INSERT INTO {table} VALUES ({', '.join(['%s'] * len(batch[0]))})", batch)
+		self.connection.commit()
+		self.counts[table] = self.counts.get(table, 0) + len(batch)
+
+	def flush_all(self):
+		for table in list(self.batches):
+			self.flush(table)
+
+
+def tables_with_rows(cursor, database: str) -> list:
+	"""
+	The tables of the dataset that already exist on `database` and have rows.
+	"""
+	cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = %s", (database,))
+	existing = {row[0] for row in cursor.fetchall()}
+	result = []
+	for table in TABLES:
+		if table in existing:
+			cursor.execute(f"SELECT 1 FROM {database}.{table} LIMIT 1")
+			if cursor.fetchall():
+				result.append(table)
+	return result
+
+
+def load(settings: dict, database: str, enrollments: int, seed: int = 0, progress: bool = True, replace: bool = False) -> dict:
+	"""
+	Create the tables of the synthetic dataset on `database` and load them.
+	`settings` are the connection settings, as the ones of the `[benchmark_connection]` section.
+	The existing tables are dropped, but if any of them has rows it fails, unless `replace`, so a
+	wrong database isn't wiped. Returns the number of rows of each table.
+	"""
+	counts = scale_counts(enrollments)
+	connection = mysql.connector.connect(host=settings["host"], port=settings["port"], user=settings["user"], password=settings["password"])
+	try:
+		cursor = connection.cursor()
+		cursor.execute(f"CREATE DATABASE IF NOT EXISTS {database}")
+		cursor.execute(f"USE {database}")
+		if not replace:
+			with_rows = tables_with_rows(cursor, database)
+			if with_rows:
+				raise ValueError(f"The tables {', '.join(with_rows)} of the {database} database already have rows, they are only replaced with --yes-drop-tables")
+		cursor.execute("SET unique_checks = 0")
+		for table, ddl in TABLES.items():
+			cursor.execute(f"DROP TABLE IF EXISTS {table}")
+			cursor.execute(ddl)
+
+		inserter = _Inserter(connection)
+		# each generator has its own seed, so the rows of a table don't depend on the ones of the others
+		for rows in (
+			(("organizations_organization", row) for row in organizations(counts, random.Random(seed * 10 + 1))),
+			(("course_overviews_courseoverview", row) for row in course_overviews(counts, random.Random(seed * 10 + 2))),
+			users(counts, random.Random(seed * 10 + 3)),
+			enrollments(counts, random.Random(seed * 10 + 4)),
+		):
+			for table, row in rows:
+				inserter.add(table, row)
+			inserter.flush_all()
+			if progress:
+				print(f"Loaded {', '.join(f'{table} {rows:,}' for table, rows in inserter.counts.items())}")
+		cursor.execute("SET unique_checks = 1")
+		return inserter.counts
+	finally:
+		connection.close()
@@ -1,11 +1,72 @@
 """
-Script that exports data to xlsx or to a Google Sheet.
+Script that exports data to xlsx or to a Google Sheet, once or as a daemon.
 """
 import argparse
 import configparser
 
+from metrics import save_prometheus_textfile, save_run_report
 from nau import Reports
 
+EXPORT_MODES = ['xlsx', 'google_sheets', 'csv', 'jsonl', 'parquet']
+
+
+def exporter(export_mode: str):
+	"""
+	The function that exports a report to the `export_mode` target.
+	"""
+	match export_mode:
+		case 'xlsx':
+			from report_xlsx import export_to_xlsx
+			return export_to_xlsx
+		case 'google_sheets':
+			from report_google import export_queries_to_google
+			return export_queries_to_google
+		case 'csv' | 'jsonl' | 'parquet':
+			from report_files import export_to_files
+			return lambda config, report: export_to_files(config, report, export_mode)
+		case _:
+			raise ValueError(f"Invalid export mode selected {export_mode}")
+
+
+def export_report(config: configparser.ConfigParser, report: Reports, export_modes_selected: list, google_client = None):
+	"""
+	Export the report to each of the `export_modes_selected` targets, the Google Sheets ones
+	with `google_client` when given.
+	"""
+	exporters = []
+	for mode in export_modes_selected:
+		function = exporter(mode)
+		if mode == 'google_sheets' and google_client is not None:
+			exporters.append((mode, lambda report, function=function: function(config, report, google_client)))
+		else:
+			exporters.append((mode, lambda report, function=function: function(config, report)))
+	if len(exporters) == 1:
+		exporters[0][1](report)
+	else:
+		# each sheet is produced once and written to all the targets at the same time
+		from fanout import FanOut
+		FanOut(report, exporters, config.getint('export', 'max_buffered_batches', fallback=4), config.get('export', 'spill_directory', fallback=None)).run()
+
+
+def save_metrics(config: configparser.ConfigParser, report: Reports, succeeded: bool) -> dict:
+	"""
+	Save the run report, and the Prometheus textfile when configured, of the last run of the report.
+	"""
+	run = report.metrics.to_dict(succeeded)
+	save_run_report(run, config.get('metrics', 'run_report', fallback='run_report.json'))
+	prometheus_textfile = config.get('metrics', 'prometheus_textfile', fallback=None)
+	if prometheus_textfile:
+		save_prometheus_textfile(run, prometheus_textfile)
+	return run
+
+
+def export_modes(value: str) -> list:
+	modes = [mode.strip() for mode in value.split(',')]
+	for mode in modes:
+		if mode not in EXPORT_MODES:
+			raise argparse.ArgumentTypeError(f"invalid choice: '{mode}' (choose from {', '.join(EXPORT_MODES)})")
+	return list(dict.fromkeys(modes))
+
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(
@@ -14,23 +75,54 @@ if __name__ == "__main__":
 		epilog='This program exports to a xlsx file or directly to a Google Sheet information from the Open edX database, so it can be analyze or integrated with dashboard application.',
 	)
 	parser.add_argument('--config', type=argparse.FileType('r'), required=True, help='The path to a config.ini with the required configurations.')
-	parser.add_argument('--export', required=True, choices=['xlsx','google_sheets'], help='The export mode selected.')
+	parser.add_argument('--export', type=export_modes, help=f"The export mode selected, or several comma separated modes, from {', '.join(EXPORT_MODES)}.")
+	parser.add_argument('--no-cache', action='store_true', help='Query the database without the local result cache.')
+	parser.add_argument('--refresh', action='append', default=[], metavar='SHEET', help='Query again the sheet with this key, replacing its cached result, can be repeated.')
+	parser.add_argument('--profile-queries', action='store_true', help='Explain the queries of all the sheets and diff their plans with the previous profile, instead of exporting.')
+	parser.add_argument('--daemon', action='store_true', help='Keep running and export each sheet on the cadence of the [daemon] section.')
 	args = parser.parse_args()
+	if args.export is None and not args.profile_queries:
+		parser.error("the --export or the --profile-queries argument is required")
+	if args.daemon and (args.profile_queries or 'xlsx' in args.export):
+		parser.error("the --daemon argument exports each sheet on its own, not to a xlsx workbook with all of them, nor with --profile-queries")
 
 	config_file = args.config
 	config_file_content = config_file.read()
 
 	config = configparser.ConfigParser()
 	config.read_string(config_file_content)
-	reports:Reports = Reports(config)
-	export_mode = args.export
 
-	match export_mode:
-		case 'xlsx':
-			from report_xlsx import export_to_xlsx
-			export_to_xlsx(config, reports)
-		case 'google_sheets':
-			from report_google import export_queries_to_google
-			export_queries_to_google(config, reports)
-		case _:
-			raise ValueError(f"Invalid export mode selected {export_mode}")
+	if any(section.startswith('connection:') for section in config.sections()):
+		if args.daemon or args.profile_queries:
+			parser.error("the --daemon and --profile-queries arguments need a single [connection]")
+		from instances import export_instances
+		export_instances(config, args.export, use_cache=not args.no_cache, refresh_sheets=args.refresh)
+		raise SystemExit(0)
+
+	reports:Reports = Reports(config, use_cache=not (args.no_cache or args.profile_queries), refresh_sheets=args.refresh, use_local_store=not args.profile_queries)
+	export_modes_selected = args.export
+
+	if args.profile_queries:
+		from profiler import profile_queries
+		try:
+			profile_queries(config, reports)
+		finally:
+			reports.close()
+		raise SystemExit(0)
+
+	if args.daemon:
+		from scheduler import Scheduler
+		try:
+			Scheduler(config, reports, export_modes_selected).run_forever()
+		finally:
+			reports.close()
+		raise SystemExit(0)
+
+	succeeded = False
+	try:
+		export_report(config, reports, export_modes_selected)
+		succeeded = True
+	finally:
+		reports.close()
+		# also of a failed run, with the sheets produced until the failure
+		save_metrics(config, reports, succeeded)
@@ -0,0 +1,250 @@
+"""
+Export of the same run to several targets, e.g. xlsx and Google Sheets, producing each sheet once.
+Each target runs its exporter on its own thread, with a `TargetReport` instead of the `Reports`,
+that receives the sheets produced for all the targets. The lists of rows are shared by the
+targets, the streamed rows are copied in batches to each target, spilled to disk when it is slower.
+"""
+import collections
+import itertools
+import os
+import pickle
+import queue
+import tempfile
+import threading
+
+from nau import Reports, result_columns_and_rows
+
+# seconds between the checks of an aborted stream while waiting for its rows
+_POLL_SECONDS = 0.5
+
+# sent to the targets instead of the end of the sheets when they couldn't all be produced
+_ABORTED = object()
+
+
+class _Target:
+	"""
+	State of an export target, shared by its thread and the producer.
+	"""
+	def __init__(self, name: str):
+		self.name = name
+		self.keys = None
+		self.sheets = queue.Queue()
+		self.failed = threading.Event()
+		self.error = None
+
+
+class StreamBranch:
+	"""
+	The copy of a streamed sheet for one target, with the rows received in batches. Up to
+	`max_batches` are kept in memory, the next ones are spilled to a temporary file until the
+	target reads them, so a slow target doesn't hold the producer nor the other targets.
+	"""
+	description = None
+	columns : list = None
+
+	def __init__(self, columns: list, description, target: _Target, max_batches: int, spill_directory: str = None):
+		self.columns = columns
+		self.description = description
+		self._target = target
+		self._max_batches = max(1, max_batches)
+		self._spill_directory = spill_directory
+		self._batches = collections.deque()
+		self._spill = None
+		self._spilled = 0
+		self._spill_read_offset = 0
+		self._available = threading.Condition()
+		self._aborted = False
+
+	def open(self):
+		return self
+
+	def put(self, batch):
+		"""
+		Add a batch of rows, None at the end, spilled to disk when the memory queue is full or
+		older batches are already spilled, so they are read in order. Ignored when the target failed.
+		"""
+		if self._target.failed.is_set():
+			return
+		with self._available:
+			if self._spilled or len(self._batches) >= self._max_batches:
+				if self._spill is None:
+					# removed when closed, also by the operating system if the process dies
+					self._spill = tempfile.TemporaryFile(dir=self._spill_directory)
+				self._spill.seek(0, os.SEEK_END)
+				pickle.dump(batch, self._spill, pickle.HIGHEST_PROTOCOL)
+				self._spilled += 1
+			else:
+				self._batches.append(batch)
+			self._available.notify()
+
+	def abort(self):
+		"""
+		Stop the target reading the rows, as the rest of them won't be produced.
+		"""
+		with self._available:
+			self._aborted = True
+			self._available.notify()
+
+	def _get(self):
+		"""
+		The next batch, from memory and then from the spill file, waiting for the producer.
+		"""
+		with self._available:
+			while not self._batches and not self._spilled:
+				if self._aborted:
+					raise RuntimeError("The rows of the sheet couldn't be produced")
+				self._available.wait(_POLL_SECONDS)
+			if self._batches:
+				return self._batches.popleft()
+			self._spill.seek(self._spill_read_offset)
+			batch = pickle.load(self._spill)
+			self._spilled -= 1
+			if self._spilled:
+				self._spill_read_offset = self._spill.tell()
+			else:
+				# all read, the next batches are kept in memory again
+				self._spill.seek(0)
+				self._spill.truncate()
+				self._spill_read_offset = 0
+			return batch
+
+	def close(self):
+		with self._available:
+			spill, self._spill = self._spill, None
+			self._spilled = 0
+		if spill is not None:
+			spill.close()
+
+	def __iter__(self):
+		try:
+			while True:
+				batch = self._get()
+				if batch is None:
+					return
+				yield from batch
+		finally:
+			self.close()
+
+
+class TargetReport:
+	"""
+	The `Reports` of an export target, its `produce_sheets` yields the sheets produced once for all
+	the targets, the other attributes are the ones of the `Reports`.
+	"""
+	def __init__(self, report: Reports, fan_out: 'FanOut', target: _Target):
+		self._report = report
+		self._fan_out = fan_out
+		self._target = target
+
+	def __getattr__(self, name):
+		return getattr(self._report, name)
+
+	def produce_sheets(self, sheets_keys: list):
+		"""
+		Yield a `(key, title, data)` tuple for each sheet key, in the order of the sheets produced
+		for all the targets. Fails when the producer fails, so the target doesn't save a partial export.
+		"""
+		self._fan_out.register(self._target, sheets_keys)
+		while True:
+			sheet = self._target.sheets.get()
+			if sheet is None:
+				return
+			if sheet is _ABORTED:
+				raise RuntimeError("The sheets couldn't be produced")
+			yield sheet
+
+
+class FanOut:
+	"""
+	Runs the exporter of each target on its own thread, feeding them with the sheets produced once.
+	The sheets are produced in the order of the keys of the first target, followed by the other
+	keys of the next targets. A target waits for the streamed rows of a sheet when it is faster than
+	the producer, and the batches that a slower target hasn't read, over `max_batches`, are spilled
+	to a temporary file on `spill_directory`, by default the one of the system.
+	"""
+	def __init__(self, report: Reports, exporters: list, max_batches: int = 4, spill_directory: str = None):
+		"""
+		`exporters` is a list of `(name, function)`, and each function receives the report to export.
+		"""
+		self.report = report
+		self.exporters = exporters
+		self.max_batches = max_batches
+		self.spill_directory = spill_directory
+		self._targets = [_Target(name) for name, _ in exporters]
+		self._registered = threading.Condition()
+
+	def register(self, target: _Target, sheets_keys: list):
+		with self._registered:
+			target.keys = list(sheets_keys)
+			self._registered.notify_all()
+
+	def _run_target(self, target: _Target, function):
+		try:
+			function(TargetReport(self.report, self, target))
+		except BaseException as e:
+			target.error = e
+			target.failed.set()
+			# a target that fails before asking for its sheets doesn't receive any
+			self.register(target, target.keys or [])
+
+	def _sheets_keys(self) -> list:
+		with self._registered:
+			self._registered.wait_for(lambda: all(target.keys is not None for target in self._targets))
+		keys = []
+		for target in self._targets:
+			keys.extend(key for key in target.keys if key not in keys)
+		return keys
+
+	def _send(self, key: str, title: str, data):
+		targets = [target for target in self._targets if key in target.keys and not target.failed.is_set()]
+		if not targets:
+			return
+		if isinstance(data, list):
+			for target in targets:
+				target.sheets.put((key, title, data))
+			return
+
+		columns, lines = result_columns_and_rows(data)
+		branches = [StreamBranch(columns, getattr(data, 'description', None), target, self.max_batches, self.spill_directory) for target in targets]
+		for target, branch in zip(targets, branches):
+			target.sheets.put((key, title, branch))
+		lines = iter(lines)
+		try:
+			for batch in iter(lambda: list(itertools.islice(lines, self.report.batch_size)), []):
+				for branch in branches:
+					branch.put(batch)
+		except BaseException:
+			for branch in branches:
+				branch.abort()
+			raise
+		for branch in branches:
+			branch.put(None)
+
+	def run(self):
+		"""
+		Export to all the targets, raising the error of the first target that failed, if any,
+		after all the others have finished. When the producer fails, the targets fail too, without
+		replacing their previous exports, and its error is raised.
+		"""
+		threads = [
+			threading.Thread(target=self._run_target, args=(target, function), name=f"export-{target.name}")
+			for target, (_, function) in zip(self._targets, self.exporters)
+		]
+		for thread in threads:
+			thread.start()
+		end = None
+		try:
+			for key, title, data in self.report.produce_sheets(self._sheets_keys()):
+				self._send(key, title, data)
+		except BaseException:
+			end = _ABORTED
+			raise
+		finally:
+			for target in self._targets:
+				target.sheets.put(end)
+			for thread in threads:
+				thread.join()
+
+		for target in self._targets:
+			if target.error is not None:
+				raise RuntimeError(f"The {target.name} export failed") from target.error
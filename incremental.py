@@ -0,0 +1,105 @@
+"""
+Incremental refresh of the sheets bucketed by date.
+The rows computed on previous runs are kept on a local state file per sheet, so each run only
+queries the most recent buckets and merges them with the stored ones.
+"""
+import datetime
+import hashlib
+import os
+import pickle
+
+
+def bucket_start(day: datetime.date, bucket: str) -> datetime.date:
+	"""
+	First day of the `bucket` ('day', 'week' or 'month') that contains `day`.
+	"""
+	if bucket == 'month':
+		return day.replace(day=1)
+	if bucket == 'week':
+		# the ISO weeks start on Monday
+		return day - datetime.timedelta(days=day.weekday())
+	return day
+
+
+def bucket_label(day: datetime.date, bucket: str) -> str:
+	"""
+	The label of a bucket, using the same format of the DATE_FORMAT on the queries.
+	"""
+	if bucket == 'month':
+		return day.strftime("%Y-%m")
+	return day.strftime("%Y-%m-%d")
+
+
+class IncrementalState:
+	"""
+	Stored rows of the sheets bucketed by date, with the watermark of the last run of each one.
+	"""
+	state_dir : str
+	safety_window_days : int
+	full_refresh_days : int
+
+	def __init__(self, state_dir: str = 'state', safety_window_days: int = 3, full_refresh_days: int = 7):
+		self.state_dir = state_dir
+		self.safety_window_days = safety_window_days
+		self.full_refresh_days = full_refresh_days
+
+	def _path(self, key: str) -> str:
+		return os.path.join(self.state_dir, f"{key}.pickle")
+
+	def load(self, key: str) -> dict:
+		try:
+			with open(self._path(key), 'rb') as f:
+				return pickle.load(f)
+		except FileNotFoundError:
+			return None
+
+	def save(self, key: str, state: dict):
+		os.makedirs(self.state_dir, exist_ok=True)
+		path = self._path(key)
+		tmp_path = path + '.tmp'
+		with open(tmp_path, 'wb') as f:
+			pickle.dump(state, f)
+		os.replace(tmp_path, path)
+
+	def since(self, state: dict, version: str, bucket: str, today: datetime.date) -> datetime.date:
+		"""
+		The first day that needs to be queried again, or None if a full refresh is needed.
+		"""
+		if state is None or state.get('version') != version:
+			return None
+		if self.full_refresh_days > 0 and (today - state['full_refresh']).days >= self.full_refresh_days:
+			return None
+		return bucket_start(state['watermark'] - datetime.timedelta(days=self.safety_window_days), bucket)
+
+	def refresh(self, key: str, query_function, run_range, date_column: str, bucket: str = 'day') -> list:
+		"""
+		Refresh the rows of the `key` sheet.
+		`query_function(date_range)` returns the SQL of the sheet restricted to a `(start, end)` range,
+		`run_range(date_range)` returns its rows, and `date_column` is the column with the bucket label of each row.
+		The rows of the buckets after the watermark minus the safety window are replaced by the
+		new ones, the older buckets are kept from the state.
+		"""
+		# a change on the query invalidates the stored rows
+		version = hashlib.sha256(query_function(None).encode()).hexdigest()
+		state = self.load(key)
+		today = datetime.date.today()
+		since = self.since(state, version, bucket, today)
+
+		rows = run_range((since, None))
+		if since is None:
+			full_refresh = today
+		else:
+			full_refresh = state['full_refresh']
+			since_label = bucket_label(since, bucket)
+			# rows without date aren't queried again, so they are kept from the last full refresh
+			kept = [r for r in state['rows'] if r[date_column] is None or str(r[date_column]) < since_label]
+			rows = kept + rows
+		rows.sort(key=lambda r: (r[date_column] is not None, str(r[date_column])))
+
+		self.save(key, {
+			'version': version,
+			'watermark': today,
+			'full_refresh': full_refresh,
+			'rows': rows,
+		})
+		return rows
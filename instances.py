@@ -0,0 +1,246 @@
+"""
+Export of several Open edX instances, each one with its `[connection:<name>]` section, on a pool of
+processes, each instance on its own or all of them merged, with the `instance` of each row.
+"""
+import configparser
+import os
+import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+from mysql.connector import FieldType
+
+from export import export_report, save_metrics
+from metrics import RunMetrics
+from nau import Reports, result_columns_and_rows
+
+INSTANCE_COLUMN = 'instance'
+_SPOOL_DIRECTORY = 'merge'
+
+
+def instance_names(config: configparser.ConfigParser) -> list:
+	"""
+	The names of the instances of the `[connection:<name>]` sections.
+	"""
+	return [section.partition(':')[2] for section in config.sections() if section.startswith('connection:')]
+
+
+def instance_config(config: configparser.ConfigParser, name: str) -> configparser.ConfigParser:
+	"""
+	The configuration of the instance `name`, where each `[<section>:<name>]` section overrides the
+	options of `<section>`, e.g. `[connection:<name>]` or `[sheets:<name>]`, and without the
+	sections of the other instances.
+	"""
+	instance = configparser.ConfigParser()
+	instance.read_dict({section: dict(config.items(section, raw=True)) for section in config.sections() if ':' not in section})
+	for section in config.sections():
+		base, _, section_instance = section.partition(':')
+		if section_instance == name:
+			instance.read_dict({base: dict(config.items(section, raw=True))})
+	return instance
+
+
+def _spool_sheets(report: Reports, keys: list) -> list:
+	"""
+	Write the rows of each sheet, with its title, columns and description, to a file of the
+	spool directory, and return the `(key, title)` of the sheets written.
+	"""
+	os.makedirs(_SPOOL_DIRECTORY, exist_ok=True)
+	spooled = []
+	for key, title, data in report.produce_sheets(keys):
+		with report.metrics.writing(key, 'merge') as written, open(os.path.join(_SPOOL_DIRECTORY, key + '.pickle'), 'wb') as f:
+			columns, lines = result_columns_and_rows(data)
+			pickle.dump((title, columns, getattr(data, 'description', None)), f)
+			rows = 0
+			batch = []
+			for line in lines:
+				batch.append(tuple(line.values()))
+				if len(batch) >= report.batch_size:
+					pickle.dump(batch, f)
+					rows += len(batch)
+					batch = []
+			if batch:
+				pickle.dump(batch, f)
+				rows += len(batch)
+			written.update(rows=rows, bytes=f.tell())
+		spooled.append((key, title))
+	return spooled
+
+
+def _export_instance(sections: dict, name: str, directory: str, export_modes_selected: list, merge_keys: list,
+		use_cache: bool = True, refresh_sheets: list = ()):
+	"""
+	Export the instance `name` on the working directory `directory`, where its relative paths are,
+	to `export_modes_selected`, or only spool the sheets of `merge_keys` when they are merged.
+	`use_cache` and `refresh_sheets` are the ones of the `Reports`.
+	"""
+	config = configparser.ConfigParser()
+	config.read_dict(sections)
+	config = instance_config(config, name)
+	os.makedirs(directory, exist_ok=True)
+	os.chdir(directory)
+	report = Reports(config, use_cache=use_cache, refresh_sheets=refresh_sheets)
+	succeeded = False
+	try:
+		if merge_keys is None:
+			export_report(config, report, export_modes_selected)
+			spooled = None
+		else:
+			spooled = _spool_sheets(report, merge_keys or list(report.available_sheets_to_export_keys()))
+		succeeded = True
+	finally:
+		report.close()
+		save_metrics(config, report, succeeded)
+	return spooled
+
+
+class MergedRows:
+	"""
+	The rows of a sheet of all the instances, read from their spool files, with the name of the
+	instance on the first column, with the interface of a RowStream. The columns missing on an
+	instance are None, and the result has the description of the instances when they are the same.
+	"""
+	description = None
+	columns : list = None
+
+	def __init__(self, paths: dict):
+		"""
+		`paths` has the spool file of the sheet of each instance.
+		"""
+		self.paths = paths
+		self._files = None
+
+	def open(self):
+		if self._files is not None:
+			return self
+		self._files = {}
+		headers = {}
+		try:
+			for name, path in self.paths.items():
+				self._files[name] = open(path, 'rb')
+				headers[name] = pickle.load(self._files[name])
+		except BaseException:
+			self.close()
+			raise
+		self.columns = [INSTANCE_COLUMN]
+		for _, columns, _ in headers.values():
+			self.columns += [column for column in columns if column not in self.columns]
+		self._columns = {name: columns for name, (_, columns, _) in headers.items()}
+		descriptions = [description for _, _, description in headers.values()]
+		if descriptions and all(description is not None and list(description) == list(descriptions[0]) for description in descriptions):
+			self.description = [(INSTANCE_COLUMN, FieldType.VAR_STRING, None, None, None, None, 0, 0)] + list(descriptions[0])
+		return self
+
+	def __iter__(self):
+		self.open()
+		try:
+			for name, f in self._files.items():
+				columns = self._columns[name]
+				while True:
+					try:
+						batch = pickle.load(f)
+					except EOFError:
+						break
+					for values in batch:
+						row = dict.fromkeys(self.columns)
+						row[INSTANCE_COLUMN] = name
+						row.update(zip(columns, values))
+						yield row
+		finally:
+			self.close()
+
+	def close(self):
+		files, self._files = self._files, None
+		for f in (files or {}).values():
+			f.close()
+
+
+class MergedReport:
+	"""
+	The sheets of all the instances, with the interface of the `Reports` used by the exporters.
+	"""
+	def __init__(self, config: configparser.ConfigParser, sheets: dict):
+		"""
+		`sheets` has the title and the spool files of each instance of each sheet key.
+		"""
+		self.sheets = sheets
+		self.progress = config.get('sheets', 'progress', fallback=True)
+		self.batch_size = config.getint('sheets', 'batch_size', fallback=10000)
+		self.metrics = RunMetrics()
+
+	def available_sheets_to_export_keys(self):
+		return self.sheets.keys()
+
+	def produce_sheets(self, sheets_keys: list):
+		for key in sheets_keys:
+			if key in self.sheets:
+				title, paths = self.sheets[key]
+				self.metrics.sheet(key, title)
+				yield key, title, MergedRows(paths)
+
+	def close(self):
+		pass
+
+
+def _remove_spool_files(directory: str, names: list):
+	"""
+	Remove the spool directory of each instance, with the rows of the sheets merged, that have the
+	personal data of the users. Also the ones of a failed export.
+	"""
+	for name in names:
+		shutil.rmtree(os.path.join(directory, name, _SPOOL_DIRECTORY), ignore_errors=True)
+
+
+def export_instances(config: configparser.ConfigParser, export_modes_selected: list, use_cache: bool = True, refresh_sheets: list = ()):
+	"""
+	Export each instance of the configuration on its own process, up to `max_parallel_instances`
+	at the same time. Each instance exports to its own targets, or, with `merge`, the sheets of all
+	the instances are exported together to the targets of the configuration, after all of them,
+	and their spool files are removed. `use_cache` and `refresh_sheets` are the ones of the
+	`Reports` of each instance.
+	An instance that fails doesn't stop the others, but fails the export, and the merged export.
+	"""
+	names = instance_names(config)
+	directory = os.path.abspath(config.get('instances', 'directory', fallback='instances'))
+	max_parallel_instances = max(1, config.getint('instances', 'max_parallel_instances', fallback=2))
+	merge = config.getboolean('instances', 'merge', fallback=False)
+	merge_keys = None
+	if merge:
+		# by default all the sheets of each instance
+		merge_keys = [key for key in config.get('instances', 'export', fallback='').split(',') if key]
+	sections = {section: dict(config.items(section, raw=True)) for section in config.sections()}
+
+	try:
+		spooled = {}
+		errors = {}
+		with ProcessPoolExecutor(max_workers=min(max_parallel_instances, len(names))) as executor:
+			futures = {
+				name: executor.submit(_export_instance, sections, name, os.path.join(directory, name), export_modes_selected, merge_keys, use_cache, refresh_sheets)
+				for name in names
+			}
+			for name, future in futures.items():
+				try:
+					spooled[name] = future.result()
+					print(f"Exported the instance {name}")
+				except Exception as e:
+					errors[name] = e
+					print(f"The export of the instance {name} failed: {type(e).__name__}: {e}")
+		if errors:
+			raise RuntimeError(f"The export of the instances {', '.join(errors)} failed") from next(iter(errors.values()))
+		if not merge:
+			return
+
+		sheets = {}
+		for name in names:
+			for key, title in spooled[name]:
+				sheets.setdefault(key, (title, {}))[1][name] = os.path.join(directory, name, _SPOOL_DIRECTORY, key + '.pickle')
+		report = MergedReport(config, sheets)
+		succeeded = False
+		try:
+			export_report(config, report, export_modes_selected)
+			succeeded = True
+		finally:
+			save_metrics(config, report, succeeded)
+	finally:
+		if merge:
+			_remove_spool_files(directory, names)
@@ -0,0 +1,348 @@
+"""
+Local analytical store of the edxapp tables read by the sheets, on a DuckDB file.
+The columns of each table are extracted once per run from the database, incrementally by the
+primary key or by the modification date when possible, and the queries of all the sheets run on
+the store, using the cores of the export host, instead of on the database.
+"""
+import datetime
+import itertools
+import os
+import re
+import time
+
+from mysql.connector import FieldType
+
+from metrics import FETCH, QUERY
+
+FULL = 'full'
+APPEND = 'append'
+MODIFIED = 'modified'
+
+
+class SourceTable:
+	"""
+	A table of the database with the `columns` read by the sheets, each one a column name or an
+	expression with its alias. It is extracted in full on every run, or incrementally on `APPEND`
+	mode, the rows with an id bigger than the last one, or on `MODIFIED` mode, the rows modified
+	since the last one, by the `modified` column.
+	"""
+	def __init__(self, name: str, columns: list, mode: str = FULL, modified: str = None):
+		self.name = name
+		self.columns = columns
+		self.mode = mode
+		self.modified = modified
+
+
+SOURCE_TABLES = [
+	SourceTable("organizations_organization", ["id", "created", "modified", "name", "short_name", "description", "logo", "active"]),
+	SourceTable("course_overviews_courseoverview", [
+		"created", "modified", "id", "_location", "display_name", "start", "end", "advertised_start", "course_image_url",
+		"social_sharing_url", "certificates_display_behavior", "certificates_show_before_end", "cert_html_view_enabled",
+		"has_any_active_web_certificate", "cert_name_short", "cert_name_long", "lowest_passing_grade", "days_early_for_beta",
+		"mobile_available", "visible_to_staff_only", "enrollment_start", "enrollment_end", "enrollment_domain", "invitation_only",
+		"max_student_enrollments_allowed", "announcement", "catalog_visibility", "course_video_url", "effort", "self_paced",
+		"certificate_available_date",
+	]),
+	# the users and their profiles can change and have no modification date, their few columns are read in full
+	SourceTable("auth_user", ["id", "is_active", "date_joined"]),
+	SourceTable("auth_userprofile", ["id", "user_id", "year_of_birth", "gender", "level_of_education", "country"]),
+	SourceTable("nau_openedx_extensions_nauuserextendedmodel", ["id", "user_id", "employment_situation"]),
+	# unenrollments and upgrades change is_active and mode in place, without a modification date
+	SourceTable("student_courseenrollment", ["id", "user_id", "course_id", "created", "is_active", "mode"]),
+	SourceTable("grades_persistentcoursegrade", ["id", "user_id", "course_id", "passed_timestamp", "modified"], MODIFIED, "modified"),
+	# the grade is a text, converted to a number like on the AVG of the database
+	SourceTable("certificates_generatedcertificate", ["id", "user_id", "course_id", "grade + 0 as grade", "created_date", "modified_date"], MODIFIED, "modified_date"),
+	SourceTable("completion_blockcompletion", ["id", "user_id", "course_key", "created"], APPEND),
+]
+
+_INTEGER_TYPE_CODES = (FieldType.TINY, FieldType.SHORT, FieldType.LONG, FieldType.LONGLONG, FieldType.INT24, FieldType.YEAR, FieldType.BIT)
+_DOUBLE_TYPE_CODES = (FieldType.FLOAT, FieldType.DOUBLE, FieldType.DECIMAL, FieldType.NEWDECIMAL)
+_DATE_TYPE_CODES = (FieldType.DATE, FieldType.NEWDATE)
+_TIMESTAMP_TYPE_CODES = (FieldType.DATETIME, FieldType.TIMESTAMP)
+
+# MySQL functions of the sheets queries that DuckDB doesn't have, or has with other arguments
+_MACROS = [
+	"""CREATE OR REPLACE MACRO mysql_substring_index(value, delimiter, count) AS CASE
+		WHEN count >= 0 THEN array_to_string(string_split(value, delimiter)[1:count], delimiter)
+		ELSE array_to_string(string_split(value, delimiter)[count:], delimiter)
+	END""",
+	"CREATE OR REPLACE MACRO mysql_date_format(value, format) AS strftime(CAST(value AS TIMESTAMP), format)",
+	"CREATE OR REPLACE MACRO mysql_datediff(a, b) AS datediff('day', CAST(b AS DATE), CAST(a AS DATE))",
+]
+
+
+def _duckdb_type(type_code: int) -> str:
+	if type_code in _INTEGER_TYPE_CODES:
+		return 'BIGINT'
+	if type_code in _DOUBLE_TYPE_CODES:
+		return 'DOUBLE'
+	if type_code in _DATE_TYPE_CODES:
+		return 'DATE'
+	if type_code in _TIMESTAMP_TYPE_CODES:
+		return 'TIMESTAMP'
+	return 'VARCHAR'
+
+
+def _value_converter(duckdb_type: str):
+	"""
+	Function that converts a value from the database to the Arrow type of the column, or None.
+	"""
+	if duckdb_type == 'DOUBLE':
+		return lambda value: None if value is None else float(value)
+	if duckdb_type == 'VARCHAR':
+		return lambda value: value.decode() if isinstance(value, (bytes, bytearray)) else (value if value is None or isinstance(value, str) else str(value))
+	return None
+
+
+def to_duckdb_sql(query: str, now: datetime.datetime) -> str:
+	"""
+	A query of the sheets, written for MySQL, on the DuckDB dialect: the double quoted strings
+	are single quoted, with the ISO year and week of MySQL, %x and %v, as %G and %V of DuckDB,
+	NOW() is `now`, the MySQL functions are replaced by their macros and the
+	columns named `end` and `day`, keywords of DuckDB, are quoted.
+	The columns are written in lower case and the keywords in upper case on the queries.
+	"""
+	query = re.sub(r'"([^"\']*)"', lambda match: "'" + match.group(1).replace('%x', '%G').replace('%v', '%V') + "'", query)
+	query = re.sub(r'\bNOW\(\)', f"TIMESTAMP '{now.isoformat(sep=' ', timespec='microseconds')}'", query, flags=re.IGNORECASE)
+	query = re.sub(r'\b(SUBSTRING_INDEX|DATE_FORMAT|DATEDIFF)\s*\(', lambda match: f"mysql_{match.group(1).lower()}(", query, flags=re.IGNORECASE)
+	return re.sub(r'\b(end|day)\b', r'"\1"', query)
+
+
+class LocalStore:
+	"""
+	The DuckDB file with the tables extracted from the `database` of the source DataLink, on a
+	schema with the same name, so the queries of the sheets run unchanged.
+	"""
+	def __init__(self, path: str, source, database: str, batch_size: int = 10000, full_refresh_days: int = 7,
+			safety_window_hours: int = 1, threads: int = None):
+		try:
+			import duckdb
+		except ImportError as e:
+			raise ImportError("The local store needs duckdb and pyarrow, install them with `pip install -r requirements-optional.txt`") from e
+		self.path = path
+		self.source = source
+		self.database = database
+		self.batch_size = batch_size
+		self.full_refresh_days = full_refresh_days
+		self.safety_window_hours = safety_window_hours
+		os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+		self.connection = duckdb.connect(path)
+		if threads:
+			self.connection.execute(f"SET threads = {int(threads)}")
+		# the same comparisons of the case insensitive collations of the database
+		self.connection.execute("SET default_collation = 'nocase'")
+		self.connection.execute(f"CREATE SCHEMA IF NOT EXISTS {database}")
+		self.connection.execute(f"SET search_path = '{database}'")
+		self.connection.execute(f"CREATE TABLE IF NOT EXISTS {database}._extracts (table_name VARCHAR PRIMARY KEY, full_extract TIMESTAMP)")
+		for macro in _MACROS:
+			self.connection.execute(macro)
+
+	def cursor(self):
+		"""
+		A connection to the store for the current thread.
+		"""
+		cursor = self.connection.cursor()
+		cursor.execute("SET default_collation = 'nocase'")
+		cursor.execute(f"SET search_path = '{self.database}'")
+		return cursor
+
+	def _last_full_extract(self, table: SourceTable) -> datetime.datetime:
+		row = self.connection.execute(f"SELECT full_extract FROM {self.database}._extracts WHERE table_name = ?", [table.name]).fetchone()
+		return None if row is None else row[0]
+
+	def _incremental_condition(self, table: SourceTable) -> str:
+		"""
+		Condition of the rows to extract incrementally, or None to extract the table in full.
+		"""
+		if table.mode == FULL:
+			return None
+		last_full_extract = self._last_full_extract(table)
+		if last_full_extract is None:
+			return None
+		# refreshed in full from time to time, e.g. for the deleted rows
+		if self.full_refresh_days > 0 and datetime.datetime.now() - last_full_extract >= datetime.timedelta(days=self.full_refresh_days):
+			return None
+		if table.mode == APPEND:
+			last_id = self.connection.execute(f"SELECT MAX(id) FROM {self.database}.{table.name}").fetchone()[0]
+			return None if last_id is None else f"id > {int(last_id)}"
+		last_modified = self.connection.execute(f"SELECT MAX({table.modified}) FROM {self.database}.{table.name}").fetchone()[0]
+		if last_modified is None:
+			return None
+		# the rows committed late with an older modification date
+		return f"{table.modified} >= '{last_modified - datetime.timedelta(hours=self.safety_window_hours)}'"
+
+	def _extract_table(self, table: SourceTable, condition: str) -> int:
+		import pyarrow as pa
+
+		query = f"SELECT {', '.join(table.columns)} FROM {self.database}.{table.name}"
+		if condition is not None:
+			query += f" WHERE {condition}"
+		rows = self.source.stream(query, self.batch_size)
+		rows.open()
+		columns = rows.columns
+		types = [_duckdb_type(column[1]) for column in rows.description]
+		arrow_types = {'BIGINT': pa.int64(), 'DOUBLE': pa.float64(), 'DATE': pa.date32(), 'TIMESTAMP': pa.timestamp('us'), 'VARCHAR': pa.string()}
+		schema = pa.schema([pa.field(column, arrow_types[duckdb_type]) for column, duckdb_type in zip(columns, types)])
+		value_converters = [_value_converter(duckdb_type) for duckdb_type in types]
+
+		target = table.name if condition is not None else f"{table.name}__extract"
+		cursor = self.cursor()
+		try:
+			cursor.execute("BEGIN TRANSACTION")
+			if condition is None:
+				column_definitions = ', '.join(f'"{column}" {duckdb_type}' for column, duckdb_type in zip(columns, types))
+				cursor.execute(f"CREATE OR REPLACE TABLE {self.database}.{target} ({column_definitions})")
+			count = 0
+			lines = iter(rows)
+			while True:
+				batch = [tuple(line.values()) for line in itertools.islice(lines, self.batch_size)]
+				if not batch:
+					break
+				arrays = []
+				for values, convert, field in zip(zip(*batch), value_converters, schema):
+					arrays.append(pa.array(values if convert is None else [convert(value) for value in values], type=field.type))
+				extract_batch = pa.Table.from_arrays(arrays, schema=schema)
+				cursor.register('extract_batch', extract_batch)
+				if condition is not None and table.mode == MODIFIED:
+					cursor.execute(f"DELETE FROM {self.database}.{target} WHERE id IN (SELECT id FROM extract_batch)")
+				cursor.execute(f"INSERT INTO {self.database}.{target} SELECT * FROM extract_batch")
+				cursor.unregister('extract_batch')
+				count += len(batch)
+			if condition is None:
+				cursor.execute(f"DROP TABLE IF EXISTS {self.database}.{table.name}")
+				cursor.execute(f"ALTER TABLE {self.database}.{target} RENAME TO {table.name}")
+				cursor.execute(f"INSERT OR REPLACE INTO {self.database}._extracts VALUES (?, ?)", [table.name, datetime.datetime.now()])
+			cursor.execute("COMMIT")
+		except BaseException:
+			cursor.execute("ROLLBACK")
+			rows.close()
+			raise
+		finally:
+			cursor.close()
+		return count
+
+	def extract(self, progress: bool = True):
+		"""
+		Extract the tables of the sheets from the database, each one in full or incrementally.
+		"""
+		for table in SOURCE_TABLES:
+			start = time.perf_counter()
+			condition = self._incremental_condition(table)
+			count = self._extract_table(table, condition)
+			if progress:
+				print(f"Extracted {table.name}: {count} rows {'in full' if condition is None else 'since the last run'} in {time.perf_counter() - start:.1f}s")
+
+	def close(self):
+		self.connection.close()
+
+
+class LocalStream:
+	"""
+	The rows of a query on the local store, read in batches, with the interface of a RowStream.
+	"""
+	description = None
+	columns : list = None
+
+	def __init__(self, link: 'LocalStoreLink', query: str, batch_size: int):
+		self.link = link
+		self.query = query
+		self.batch_size = batch_size
+		self.metrics = link.sheet_metrics()
+		self._cursor = None
+
+	def open(self):
+		if self._cursor is None:
+			self._cursor = self.link._execute(self.query, self.metrics)
+			self.columns = [column[0] for column in self._cursor.description]
+		return self
+
+	def __iter__(self):
+		self.open()
+		try:
+			row_converter = self.link._row_converter(self._cursor)
+			while True:
+				start = time.perf_counter()
+				rows = self._cursor.fetchmany(self.batch_size)
+				if self.metrics is not None:
+					self.metrics.add(FETCH, time.perf_counter() - start)
+				if not rows:
+					break
+				for row in rows:
+					yield dict(zip(self.columns, row_converter(row)))
+		finally:
+			self.close()
+
+	def close(self):
+		cursor, self._cursor = self._cursor, None
+		if cursor is not None:
+			cursor.close()
+
+
+class LocalStoreLink:
+	"""
+	A DataLink that runs the queries of the sheets on the local store. The tables are extracted
+	by `prepare()`, called before each query, that extracts them once per run. The results have no
+	description, as their types are the ones of DuckDB, and the booleans are returned as numbers,
+	like on MySQL. `settings`, `pool` and `execute` are the ones of the `source` DataLink.
+	"""
+	def __init__(self, store: LocalStore, source, prepare, result_type):
+		self.store = store
+		self.source = source
+		self.settings = source.settings
+		self.pool = source.pool
+		self.sheet_metrics = source.sheet_metrics
+		self.prepare = prepare
+		self.result_type = result_type
+
+	def _execute(self, query: str, metrics):
+		self.prepare()
+		cursor = self.store.cursor()
+		start = time.perf_counter()
+		cursor.execute(to_duckdb_sql(query, datetime.datetime.now()))
+		if metrics is not None:
+			metrics.add(QUERY, time.perf_counter() - start)
+		return cursor
+
+	@staticmethod
+	def _row_converter(cursor):
+		boolean_columns = [index for index, column in enumerate(cursor.description) if str(column[1]).upper() in ('BOOL', 'BOOLEAN')]
+		if not boolean_columns:
+			return lambda row: row
+		def convert(row):
+			row = list(row)
+			for index in boolean_columns:
+				if row[index] is not None:
+					row[index] = int(row[index])
+			return row
+		return convert
+
+	def query(self, query):
+		metrics = self.sheet_metrics()
+		cursor = self._execute(query, metrics)
+		try:
+			start = time.perf_counter()
+			columns = [column[0] for column in cursor.description]
+			row_converter = self._row_converter(cursor)
+			result = self.result_type(dict(zip(columns, row_converter(row))) for row in cursor.fetchall())
+			if metrics is not None:
+				metrics.add(FETCH, time.perf_counter() - start)
+		finally:
+			cursor.close()
+		return result
+
+	def stream(self, query, batch_size: int = 10000) -> LocalStream:
+		return LocalStream(self, query, batch_size)
+
+	def get(self, query):
+		cursor = self._execute(query, None)
+		try:
+			return cursor.fetchone()[0]
+		finally:
+			cursor.close()
+
+	def execute(self, query):
+		self.source.execute(query)
+
+	def close(self):
+		self.store.close()
+		self.source.close()
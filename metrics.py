@@ -0,0 +1,226 @@
+"""
+Instrumentation of a run, with the time spent on each phase of each sheet, the rows and bytes
+written to each target and the peak memory of the process, saved as a JSON run report and
+optionally as a Prometheus textfile for the node_exporter.
+"""
+import datetime
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+	import resource
+except ImportError:
+	# not available on Windows
+	resource = None
+
+QUERY = 'query'
+FETCH = 'fetch'
+SHARED = 'shared'
+TRANSFORM = 'transform'
+PHASES = (QUERY, FETCH, SHARED, TRANSFORM)
+
+
+def peak_rss_bytes() -> int:
+	"""
+	The peak resident memory of the process until now, or None when it isn't known.
+	"""
+	if resource is None:
+		return None
+	# kilobytes on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SheetMetrics:
+	"""
+	Seconds spent on each phase of a sheet, or of a result shared by several sheets:
+	running its queries, fetching their rows, waiting for the shared results and transforming the
+	rows, and the seconds, rows and bytes of each target where it was written, and how much the
+	peak resident memory of the process grew while it was produced or written, as the peak itself is
+	of the whole process.
+	"""
+	key : str
+	title : str
+	shared : bool
+
+	def __init__(self, key: str, title: str = None, shared: bool = False):
+		self.key = key
+		self.title = title
+		self.shared = shared
+		self.seconds = dict.fromkeys(PHASES, 0.0)
+		self.targets = {}
+		self.peak_rss_growth_bytes = None
+		self._lock = threading.Lock()
+
+	def add(self, phase: str, seconds: float):
+		with self._lock:
+			self.seconds[phase] += seconds
+
+	def _accounted(self) -> float:
+		with self._lock:
+			return self.seconds[QUERY] + self.seconds[FETCH] + self.seconds[SHARED]
+
+	def _fetch_seconds(self) -> float:
+		with self._lock:
+			return self.seconds[FETCH]
+
+	def _add_peak_rss_growth(self, peak_before: int):
+		peak = peak_rss_bytes()
+		if peak is None or peak_before is None:
+			return
+		with self._lock:
+			self.peak_rss_growth_bytes = (self.peak_rss_growth_bytes or 0) + peak - peak_before
+
+	def to_dict(self) -> dict:
+		with self._lock:
+			return {
+				"key": self.key,
+				"title": self.title,
+				"shared": self.shared,
+				**{f"{phase}_seconds": round(seconds, 6) for phase, seconds in self.seconds.items()},
+				"targets": {target: dict(values) for target, values in self.targets.items()},
+				"peak_rss_growth_bytes": self.peak_rss_growth_bytes,
+			}
+
+
+class RunMetrics:
+	"""
+	The metrics of each sheet of a run. The time of the queries and of fetching the rows is added
+	by the DataLink, and the rest of the time spent producing a sheet is its transform time.
+	The write time of a target doesn't count the rows fetched while it writes them. The growth of the
+	peak memory while several sheets are produced or written at the same time is counted on each one.
+	"""
+	def __init__(self):
+		self.started = datetime.datetime.now()
+		self._start = time.perf_counter()
+		self.sheets = {}
+		self._lock = threading.Lock()
+
+	def sheet(self, key: str, title: str = None, shared: bool = False) -> SheetMetrics:
+		"""
+		The metrics of the sheet `key`, or None without a key, e.g. for a query outside of a sheet.
+		"""
+		if key is None:
+			return None
+		with self._lock:
+			metrics = self.sheets.get(key)
+			if metrics is None:
+				metrics = self.sheets[key] = SheetMetrics(key, title, shared)
+			elif title is not None:
+				metrics.title = title
+			return metrics
+
+	def add(self, key: str, phase: str, seconds: float):
+		metrics = self.sheet(key)
+		if metrics is not None:
+			metrics.add(phase, seconds)
+
+	@contextmanager
+	def producing(self, key: str, title: str = None, shared: bool = False):
+		"""
+		Count the time of the block, that produces the sheet `key`, not spent on its queries,
+		fetching its rows or waiting for shared results, as its transform time.
+		"""
+		metrics = self.sheet(key, title, shared)
+		if metrics is None:
+			yield
+			return
+		start = time.perf_counter()
+		accounted = metrics._accounted()
+		peak_before = peak_rss_bytes()
+		try:
+			yield
+		finally:
+			# the queries run at the same time, e.g. of the partitions of a sheet, can add up to more than the elapsed time
+			metrics.add(TRANSFORM, max(0.0, time.perf_counter() - start - (metrics._accounted() - accounted)))
+			metrics._add_peak_rss_growth(peak_before)
+
+	@contextmanager
+	def writing(self, key: str, target: str):
+		"""
+		Count the time of the block, that writes the sheet `key` to `target`, not spent fetching
+		its rows. The block receives a dict where it sets the `rows` and `bytes` written.
+		"""
+		metrics = self.sheet(key)
+		written = {"rows": None, "bytes": None}
+		start = time.perf_counter()
+		# the rows can be fetched by other threads, e.g. the producers of the streamed sheets
+		fetch = metrics._fetch_seconds()
+		peak_before = peak_rss_bytes()
+		try:
+			yield written
+		finally:
+			seconds = time.perf_counter() - start - (metrics._fetch_seconds() - fetch)
+			with metrics._lock:
+				metrics.targets[target] = {"write_seconds": round(seconds, 6), **written}
+			metrics._add_peak_rss_growth(peak_before)
+
+	def to_dict(self, succeeded: bool) -> dict:
+		with self._lock:
+			sheets = list(self.sheets.values())
+		return {
+			"started": self.started.isoformat(timespec='seconds'),
+			"seconds": round(time.perf_counter() - self._start, 3),
+			"succeeded": succeeded,
+			"peak_rss_bytes": peak_rss_bytes(),
+			"sheets": [sheet.to_dict() for sheet in sheets],
+		}
+
+
+def _write_replacing(path: str, content: str):
+	os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'w') as f:
+		f.write(content)
+	os.replace(tmp_path, path)
+
+
+def save_run_report(run: dict, path: str):
+	_write_replacing(path, json.dumps(run, indent=1))
+
+
+def _label(value: str) -> str:
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(run: dict, prefix: str = 'nau_export') -> str:
+	"""
+	The metrics of a run on the Prometheus text format.
+	"""
+	lines = []
+	def metric(name: str, help_text: str, samples: list):
+		lines.append(f"# HELP {prefix}_{name} {help_text}")
+		lines.append(f"# TYPE {prefix}_{name} gauge")
+		for labels, value in samples:
+			if value is None:
+				continue
+			labels_text = ','.join(f'{label}="{_label(label_value)}"' for label, label_value in labels.items())
+			lines.append(f"{prefix}_{name}{{{labels_text}}} {value}" if labels_text else f"{prefix}_{name} {value}")
+
+	sheets = run["sheets"]
+	started = datetime.datetime.fromisoformat(run["started"])
+	metric('run_start_timestamp_seconds', 'Start of the last run.', [({}, started.timestamp())])
+	metric('run_seconds', 'Duration of the last run.', [({}, run["seconds"])])
+	metric('run_succeeded', 'Whether the last run succeeded.', [({}, int(run["succeeded"]))])
+	metric('run_peak_rss_bytes', 'Peak resident memory of the last run.', [({}, run["peak_rss_bytes"])])
+	metric('sheet_phase_seconds', 'Seconds spent on each phase of producing a sheet.',
+		[({"sheet": sheet["key"], "phase": phase}, sheet[f"{phase}_seconds"]) for sheet in sheets for phase in PHASES])
+	for name, help_text, field in (
+		('sheet_write_seconds', 'Seconds spent writing a sheet to a target, without fetching its rows.', 'write_seconds'),
+		('sheet_rows', 'Rows of a sheet written to a target.', 'rows'),
+		('sheet_bytes', 'Bytes of a sheet written to a target.', 'bytes'),
+	):
+		metric(name, help_text, [({"sheet": sheet["key"], "target": target}, values[field]) for sheet in sheets for target, values in sheet["targets"].items()])
+	metric('sheet_peak_rss_growth_bytes', 'Growth of the peak resident memory of the process while a sheet was produced or written.',
+		[({"sheet": sheet["key"]}, sheet["peak_rss_growth_bytes"]) for sheet in sheets])
+	return '\n'.join(lines) + '\n'
+
+
+def save_prometheus_textfile(run: dict, path: str):
+	"""
+	Save the metrics of a run for the textfile collector of the node_exporter, replacing the
+	previous file at once, so the collector never reads a partial file.
+	"""
+	_write_replacing(path, prometheus_text(run))
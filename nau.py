@@ -1,65 +1,292 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-import mysql.connector
+import collections
 import configparser
+import itertools
+import os
+import queue
+import threading
+import time
 
+import mysql.connector
+import numpy as np
 
-class DataLink:
-	connection = None
-	settings = dict({"host": "localhost", "port": "3306", "user": "", "password": "", "database": "edxapp"})
-	
-	def __init__(self, config):
-		self.settings = config
-	
-	def _connect(self):
-		self.connection = mysql.connector.connect(
+from cache import CachingDataLink, ResultCache
+from courses import CourseDimension, availability_states, collation_key, course_key_parts, datediff, organization_names, to_datetime64
+from hyperloglog import DailySketches, distinct_counts_by_window
+from incremental import IncrementalState
+from local_store import LocalStore, LocalStoreLink
+from metrics import FETCH, QUERY, SHARED, RunMetrics
+from partitions import date_partitions
+
+
+# Community of Portuguese Language Countries
+CPLP_COUNTRIES = ('AO','BR','CV','GW','GQ','MZ','PT','ST','TL')
+# the sheets bucketed by date that can be queried with a query per range of dates
+PARTITIONED_SHEETS = ('course_run_by_date', 'registered_users_by_day', 'distinct_users_by_day', 'distinct_users_by_month', 'distinct_users_by_week', 'distinct_users_rolling_30_days')
+
+
+class ConnectionPool:
+	"""
+	Bounded pool of MySQL connections, so the connection handshake is paid once per connection
+	and not once per query.
+	"""
+	settings : dict = None
+	size : int = 1
+
+	def __init__(self, settings: dict, size: int = 1):
+		self.settings = settings
+		self.size = max(1, size)
+		self._idle = queue.LifoQueue()
+		self._lock = threading.Lock()
+		self._open_count = 0
+		self.stats = {"created": 0, "reused": 0, "discarded": 0, "wait_time": 0.0}
+
+	def _new_connection(self):
+		connection = mysql.connector.connect(
 			host=self.settings["host"],
 			port=self.settings["port"],
 			user=self.settings["user"],
 			passwd=self.settings["password"],
 			database=self.settings["database"]
 		)
+		with self._lock:
+			self.stats["created"] += 1
+		return connection
+
+	def acquire(self):
+		"""
+		Return an healthy connection, reusing an idle one when possible.
+		Blocks when all the `size` connections are in use.
+		"""
+		try:
+			connection = self._idle.get_nowait()
+		except queue.Empty:
+			with self._lock:
+				can_open = self._open_count < self.size
+				if can_open:
+					self._open_count += 1
+			if can_open:
+				try:
+					return self._new_connection()
+				except Exception:
+					with self._lock:
+						self._open_count -= 1
+					raise
+			start = time.monotonic()
+			connection = self._idle.get()
+			with self._lock:
+				self.stats["wait_time"] += time.monotonic() - start
+
+		# health check before reuse, replacing connections closed by the server
+		if connection.is_connected():
+			with self._lock:
+				self.stats["reused"] += 1
+			return connection
+		self._close_quietly(connection)
+		with self._lock:
+			self.stats["discarded"] += 1
+		try:
+			return self._new_connection()
+		except Exception:
+			with self._lock:
+				self._open_count -= 1
+			raise
+
+	def release(self, connection):
+		"""
+		Give back a connection to the pool, ending any transaction left open.
+		"""
+		try:
+			connection.rollback()
+		except mysql.connector.Error:
+			self.discard(connection)
+			return
+		self._idle.put(connection)
+
+	def discard(self, connection):
+		"""
+		Close a connection that shouldn't be reused, e.g. after an error.
+		"""
+		self._close_quietly(connection)
+		with self._lock:
+			self._open_count -= 1
+			self.stats["discarded"] += 1
+
+	def close(self):
+		while True:
+			try:
+				connection = self._idle.get_nowait()
+			except queue.Empty:
+				break
+			self._close_quietly(connection)
+			with self._lock:
+				self._open_count -= 1
+
+	@staticmethod
+	def _close_quietly(connection):
+		try:
+			connection.close()
+		except mysql.connector.Error:
+			pass
+
+
+class RowStream:
+	"""
+	Rows of a query read from the server in batches of `batch_size` with an unbuffered cursor,
+	so only a batch is kept in memory. It can be iterated only once.
+	"""
+	description = None
+	columns : list = None
+
+	def __init__(self, data_link, query: str, batch_size: int):
+		self.data_link = data_link
+		self.query = query
+		self.batch_size = batch_size
+		self._connection = None
+		self._cursor = None
+		self._consumed = False
+		# of the sheet that created the stream, as its rows are read while the sheet is written
+		self.metrics = data_link.sheet_metrics()
+
+	def open(self):
+		"""
+		Execute the query, so its columns are known before the rows are read.
+		"""
+		if self._cursor is not None:
+			return self
+		connection = self.data_link.pool.acquire()
+		start = time.perf_counter()
+		try:
+			cursor = connection.cursor()
+			cursor.execute("START TRANSACTION READ ONLY")
+			cursor.execute(self.query)
+		except Exception:
+			self.data_link.pool.discard(connection)
+			raise
+		if self.metrics is not None:
+			self.metrics.add(QUERY, time.perf_counter() - start)
+		self._connection = connection
+		self._cursor = cursor
+		self.description = cursor.description
+		self.columns = [column[0] for column in cursor.description]
+		return self
+
+	def __iter__(self):
+		if self._consumed:
+			raise RuntimeError("The rows of a RowStream can only be iterated once")
+		self.open()
+		self._consumed = True
+		columns = self.columns
+		finished = False
+		try:
+			while True:
+				start = time.perf_counter()
+				rows = self._cursor.fetchmany(self.batch_size)
+				if self.metrics is not None:
+					self.metrics.add(FETCH, time.perf_counter() - start)
+				if not rows:
+					break
+				for row in rows:
+					yield dict(zip(columns, row))
+			finished = True
+		finally:
+			self._close(finished)
+
+	def close(self):
+		self._close(False)
+
+	def _close(self, finished: bool):
+		connection, self._connection = self._connection, None
+		if connection is None:
+			return
+		if finished:
+			self.data_link.pool.release(connection)
+		else:
+			# the connection still has unread rows, so it can't be reused
+			self.data_link.pool.discard(connection)
+
+
+class QueryResult(list):
+	"""
+	Rows of a query as a list of dicts, with the description of its columns.
+	"""
+	description = None
+
+
+def result_columns_and_rows(data) -> tuple:
+	"""
+	Return the column names and an iterator over the rows of a sheet result,
+	that can be a list or an iterator of dicts, or a RowStream or other stream of rows with the
+	`open` method and the `columns`.
+	"""
+	if hasattr(data, 'open'):
+		data.open()
+		return data.columns, iter(data)
+	rows = iter(data)
+	first = next(rows, None)
+	if first is None:
+		return [], iter(())
+	return list(first.keys()), itertools.chain((first,), rows)
+
+
+class DataLink:
+	pool : ConnectionPool = None
+	settings = dict({"host": "localhost", "port": "3306", "user": "", "password": "", "database": "edxapp"})
 	
-	def _close(self):
-		self.connection.close()
+	def __init__(self, config, pool_size: int = 1, sheet_metrics = None):
+		"""
+		`sheet_metrics` returns the SheetMetrics of the sheet being produced, or None, where the time
+		of the queries and of fetching their rows is added.
+		"""
+		self.settings = config
+		self.pool = ConnectionPool(config, pool_size)
+		self.sheet_metrics = sheet_metrics or (lambda: None)
+	
+	@contextmanager
+	def _connection(self):
+		connection = self.pool.acquire()
+		try:
+			yield connection
+		except Exception:
+			self.pool.discard(connection)
+			raise
+		self.pool.release(connection)
+
+	def close(self):
+		self.pool.close()
 	
 	def execute(self, query):
-		self._connect()
-		mycursor = self.connection.cursor()
-		mycursor.execute(query)
-		self._close()
+		with self._connection() as connection:
+			mycursor = connection.cursor(buffered=True)
+			mycursor.execute(query)
 
 	def query(self, query):  # return a query result set as an list of dicts
-		self._connect()
-		cursor = self.connection.cursor()
-		query_with_transaction = f"""
-START TRANSACTION READ ONLY;
-{query};
-"""
-		results = cursor.execute(query_with_transaction, multi=True)
-
-		# assuming that only 1 statement returns data
-		for cur in results:
-			if cur.with_rows:
-				cursor = cur
-				break
-
-		description = cursor.description
-		result = []
+		metrics = self.sheet_metrics()
+		with self._connection() as connection:
+			start = time.perf_counter()
+			cursor = connection.cursor()
+			cursor.execute("START TRANSACTION READ ONLY")
+			cursor.execute(query)
+			executed = time.perf_counter()
 
-		for row in cursor.fetchall():
-			r = {}
-			for idx, column in enumerate(description):
-				r[column[0]] = row[idx]
-			result.append(r)
-		self._close()
+			columns = [column[0] for column in cursor.description]
+			result = QueryResult(dict(zip(columns, row)) for row in cursor.fetchall())
+			result.description = cursor.description
+		if metrics is not None:
+			metrics.add(QUERY, executed - start)
+			metrics.add(FETCH, time.perf_counter() - executed)
 		return result
+
+	def stream(self, query, batch_size: int = 10000) -> RowStream:  # return a query result set as an iterable of dicts
+		return RowStream(self, query, batch_size)
 	
 	def get(self, query):  # returns only one value on one line
-		self._connect()
-		mycursor = self.connection.cursor()
-		mycursor.execute(query)
-		row = mycursor.fetchone()
-		self._close()
+		with self._connection() as connection:
+			mycursor = connection.cursor(buffered=True)
+			mycursor.execute(query)
+			row = mycursor.fetchone()
 		return row[0]
 
 
@@ -67,8 +294,26 @@ class Reports:
 	data_link = None
 	config : configparser.ConfigParser = None
 	progress : bool
+	debug : bool
+	streaming : bool
+	batch_size : int
+	max_parallel_queries : int
+	single_scan_enrollments : bool
+	derived_enrollments_with_profile_info : bool
+	derive_in_exporter : bool
+	summary_windows : list
+	partitioned_sheets : list
+	incremental : IncrementalState = None
+	daily_user_sketches : DailySketches = None
+	metrics : RunMetrics = None
 	
-	def __init__(self, config: configparser.ConfigParser):
+	def __init__(self, config: configparser.ConfigParser, use_cache: bool = True, refresh_sheets: list = (), use_local_store: bool = True):
+		"""
+		With the `[cache]` enabled, the query results of each sheet are served from the local cache
+		while valid, unless `use_cache` is false, and the sheets of `refresh_sheets` are queried again.
+		With the `[local_store]` enabled, the queries run on the tables extracted to the local store,
+		unless `use_local_store` is false.
+		"""
 		settings : dict = {}
 		settings["host"] = config.get('connection', 'host', fallback='localhost')
 		settings["port"] = config.get('connection', 'port', fallback='3306')
@@ -80,11 +325,82 @@ class Reports:
 		debug : bool = config.get('connection', 'debug', fallback=False)
 		if debug:
 			print("Connection Settings: ", settings)
+		self.debug = debug
 		
-		self.data_link = DataLink(settings)
+		self.progress = config.get('sheets', 'progress', fallback=True)
+		self.streaming = config.getboolean('sheets', 'streaming', fallback=False)
+		self.batch_size = config.getint('sheets', 'batch_size', fallback=10000)
+		self.max_parallel_queries = max(1, config.getint('sheets', 'max_parallel_queries', fallback=1))
+		self.single_scan_enrollments = config.getboolean('sheets', 'single_scan_enrollments', fallback=True)
+		self.derived_enrollments_with_profile_info = config.getboolean('sheets', 'derived_enrollments_with_profile_info', fallback=True)
+		self.derive_in_exporter = config.getboolean('sheets', 'derive_in_exporter', fallback=False)
+		self.summary_windows = [int(days) for days in config.get('summary', 'windows', fallback='7,15,30').split(',')]
+		# the sheets bucketed by date queried with a query per range of dates
+		self.partitioned_sheets = []
+		if config.getboolean('partitioned_queries', 'enabled', fallback=False):
+			self.partitioned_sheets = config.get('partitioned_queries', 'sheets', fallback=','.join(PARTITIONED_SHEETS)).split(',')
+		self.partition = config.get('partitioned_queries', 'partition', fallback='month')
+		self.partitions_start = datetime.strptime(config.get('partitioned_queries', 'start', fallback='2019-01-01'), '%Y-%m-%d').date()
+		self.max_parallel_partitions = max(1, config.getint('partitioned_queries', 'max_parallel', fallback=4))
+
+		pool_size : int = config.getint('connection', 'pool_size', fallback=1)
+		if self.max_parallel_queries > 1:
+			# each producer needs its own connection, plus the one of the sheet being consumed
+			pool_size = max(pool_size, self.max_parallel_queries + 1)
+		if self.partitioned_sheets:
+			pool_size = max(pool_size, self.max_parallel_partitions + 1)
+		# key of the sheet, or of the shared result, being produced by each thread
+		self._producing = threading.local()
+		self.metrics = RunMetrics()
+		self.data_link = DataLink(settings, pool_size, lambda: self.metrics.sheet(self.producing_key()))
 		self.config = config
 
-		self.progress = config.get('sheets', 'progress', fallback=True)
+		if use_local_store and config.getboolean('local_store', 'enabled', fallback=False):
+			store = LocalStore(
+				config.get('local_store', 'path', fallback=os.path.join('state', 'local_store.duckdb')),
+				self.data_link,
+				self.edxapp_database,
+				self.batch_size,
+				config.getint('local_store', 'full_refresh_days', fallback=7),
+				config.getint('local_store', 'safety_window_hours', fallback=1),
+				config.getint('local_store', 'threads', fallback=0),
+			)
+			# extracted once per run, by the first sheet that queries it
+			self.data_link = LocalStoreLink(store, self.data_link, lambda: self._shared('local_store_extract', lambda: store.extract(self.progress), cached=False), QueryResult)
+
+		self.result_cache = None
+		if use_cache and config.getboolean('cache', 'enabled', fallback=False):
+			cache = self.result_cache = ResultCache(
+				config.get('cache', 'directory', fallback=os.path.join('state', 'cache')),
+				f"{settings['user']}@{settings['host']}:{settings['port']}/{settings['database']}",
+				config.getint('cache', 'ttl_seconds', fallback=3600),
+				{key: int(ttl) for key, ttl in config.items('cache_ttl', raw=True) if key not in config.defaults()} if config.has_section('cache_ttl') else {},
+				config.getint('cache', 'max_size_mb', fallback=1024) * 1024 * 1024,
+				refresh_sheets,
+			)
+			self.data_link = CachingDataLink(self.data_link, cache, self.producing_key, QueryResult)
+
+		self.incremental = None
+		if config.getboolean('incremental', 'enabled', fallback=False):
+			self.incremental = IncrementalState(
+				config.get('incremental', 'state_dir', fallback='state'),
+				config.getint('incremental', 'safety_window_days', fallback=3),
+				config.getint('incremental', 'full_refresh_days', fallback=7),
+			)
+
+		# the distinct users can be counted exactly on the database or approximated by merging daily sketches
+		self.daily_user_sketches = None
+		if config.get('distinct_users', 'mode', fallback='exact') == 'approximate':
+			self.daily_user_sketches = DailySketches(
+				config.get('distinct_users', 'sketches_file', fallback=os.path.join(config.get('incremental', 'state_dir', fallback='state'), 'distinct_users_sketches.pickle')),
+				config.getint('distinct_users', 'precision', fallback=14),
+				config.getint('incremental', 'safety_window_days', fallback=3),
+			)
+
+		# results shared by more than one sheet, computed once per run
+		self._shared_results = {}
+		self._shared_locks = collections.defaultdict(threading.Lock)
+		self._shared_lock = threading.Lock()
 
 		self.available_data = {
 			# Global - Now
@@ -98,7 +414,7 @@ class Reports:
 			},
 			"course_run_by_date": { 
 				'title': "Course run by date", 
-				'data': lambda: self.course_run_by_date() 
+				'data': lambda: self._course_run_by_date_rows(self._date_bucketed("course_run_by_date", self._course_run_by_date_query, 'date'))
 			},
 			"enrollments_with_profile_info": {
 				'title': "Enrollments with profile info", 
@@ -106,23 +422,23 @@ class Reports:
 			},
 			"enrollments_year_of_birth": {
 				'title': "Enrollments with year of birth",
-				'data': lambda: self.enrollments_year_of_birth()
+				'data': lambda: self._enrollments_breakdown('year_of_birth', self.enrollments_year_of_birth)
 			},
 			"enrollments_gender": {
 				'title': "Enrollments with gender",
-				'data': lambda: self.enrollments_gender()
+				'data': lambda: self._enrollments_breakdown('gender', self.enrollments_gender)
 			},
 			"enrollments_level_of_education": {
 				'title': "Enrollments with level of education",
-				'data': lambda: self.enrollments_level_of_education()
+				'data': lambda: self._enrollments_breakdown('level_of_education', self.enrollments_level_of_education)
 			},
 			"enrollments_country": {
 				'title': "Enrollments with country",
-				'data': lambda: self.enrollments_country()
+				'data': lambda: self._enrollments_breakdown('country', self.enrollments_country)
 			},
 			"enrollments_employment_situation": {
 				'title': "Enrollments with employment situation",
-				'data': lambda: self.enrollments_employment_situation()
+				'data': lambda: self._enrollments_breakdown('employment_situation', self.enrollments_employment_situation)
 			},
 			"users": { 
 				'title': "Users", 
@@ -130,15 +446,27 @@ class Reports:
 			},
 			"registered_users_by_day": { 
 				'title': "Registered users by day", 
-				'data': lambda: self.registered_users_by_day()
+				'data': lambda: self._date_bucketed("registered_users_by_day", self._registered_users_by_day_query, 'register_date')
 			},
 			"distinct_users_by_day": { 
 				'title': "Distinct Users by Day", 
-				'data': lambda: self.distinct_users_by_day() 
+				'data': lambda: self._distinct_users("day") 
 			},
 			"distinct_users_by_month": { 
 				'title': "Distinct Users by Month", 
-				'data': lambda: self.distinct_users_by_month() 
+				'data': lambda: self._distinct_users("month") 
+			},
+			"distinct_users_by_week": { 
+				'title': "Distinct Users by Week", 
+				'data': lambda: self._distinct_users("week") 
+			},
+			"distinct_users_rolling_30_days": { 
+				'title': "Distinct Users Rolling 30 Days", 
+				'data': lambda: self._distinct_users("rolling_30_days") 
+			},
+			"summary": { 
+				'title': "Summary", 
+				'data': lambda: self.summary() 
 			},
 			"final_summary": { 
 				'title': "Final Summary", 
@@ -146,6 +474,14 @@ class Reports:
 			},
 		}
 
+	def close(self):
+		"""
+		Close the database connections kept open during the run.
+		"""
+		self.data_link.close()
+		if self.debug:
+			print("Connection pool stats: ", self.data_link.pool.stats)
+
 	def available_sheets_to_export_keys(self):
 		return self.available_data.keys()
 
@@ -154,43 +490,217 @@ class Reports:
 		filtered_available_data = [value for key, value in self.available_data.items() if key in enabled_sheets_keys_list]
 		return list(map(self._apply_data, filtered_available_data))
 
+	def produce_sheets(self, sheets_keys: list):
+		"""
+		Yield a `(key, title, data)` tuple for each sheet key, in the same order of `sheets_keys`,
+		as soon as the sheet is produced. Unknown keys are ignored.
+		With `max_parallel_queries` bigger than 1, the queries of the following sheets are run
+		by a pool of threads, each one with its own connection, while the previous sheets are
+		being consumed.
+		"""
+		keys = [key for key in sheets_keys if key in self.available_data]
+		if self.max_parallel_queries <= 1:
+			for key in keys:
+				yield (key, *self._apply_data(self.available_data[key], key))
+			return
+
+		with ThreadPoolExecutor(max_workers=self.max_parallel_queries, thread_name_prefix='sheet') as executor:
+			keys_to_submit = iter(keys)
+			pending = collections.deque()
+			for key in itertools.islice(keys_to_submit, self.max_parallel_queries):
+				pending.append((key, executor.submit(self._produce_data, self.available_data[key], key)))
+			try:
+				while pending:
+					key, future = pending.popleft()
+					title, data = future.result()
+					next_key = next(keys_to_submit, None)
+					if next_key is not None:
+						pending.append((next_key, executor.submit(self._produce_data, self.available_data[next_key], next_key)))
+					yield (key, title, data)
+			finally:
+				# release the connections of the sheets that won't be consumed
+				for _, future in pending:
+					if future.cancel() or future.exception() is not None:
+						continue
+					_, data = future.result()
+					if hasattr(data, 'close'):
+						data.close()
+
+	def _produce_data(self, d:dict, key: str = None):
+		"""
+		Produce a sheet on a worker thread, running its query even when its rows are streamed.
+		"""
+		title, data = self._apply_data(d, key)
+		if hasattr(data, 'open'):
+			data.open()
+		return (title, data)
+
 	def sheets_data_enabled(self):
 		enabled_data_keys = self.config.get('sheets', 'enabled', fallback=','.join(self.available_data.keys())).split(',')
 		return {k:v for (k,v) in self.available_data.items() if k in enabled_data_keys}
 
-	def _apply_data(self, d:dict):
+	def _apply_data(self, d:dict, key: str = None):
 		title = d.get('title')
 		if self.progress:
 			print("Producing... " + title)
-		return (title, d.get('data')())
+		with self._producing_as(key), self.metrics.producing(key, title):
+			return (title, d.get('data')())
+
+	def producing_key(self) -> str:
+		"""
+		The key of the sheet, or of the shared result, being produced by this thread, or None.
+		"""
+		return getattr(self._producing, 'key', None)
+
+	@contextmanager
+	def _producing_as(self, key: str):
+		"""
+		Set the key of the sheet being produced by this thread, under which its query results are cached.
+		"""
+		previous = self.producing_key()
+		self._producing.key = key
+		try:
+			yield
+		finally:
+			self._producing.key = previous
+
+	def _date_bucketed(self, key: str, query_function, date_column: str, bucket: str = 'day'):
+		"""
+		Produce a sheet bucketed by date. With the incremental mode enabled only the recent buckets
+		are queried and merged with the rows stored on previous runs.
+		"""
+		if self.incremental is None:
+			return self._date_partitioned(key, query_function, bucket)
+		if key in self.partitioned_sheets:
+			run_range = lambda date_range: self._query_date_ranges(query_function, date_range, bucket)
+		else:
+			run_range = lambda date_range: self.data_link.query(query_function(date_range))
+		return self.incremental.refresh(key, query_function, run_range, date_column, bucket)
+
+	def _date_partitioned(self, key: str, query_function, bucket: str = 'day'):
+		"""
+		Produce a sheet bucketed by date, with a query per range of dates when it is partitioned.
+		"""
+		if key in self.partitioned_sheets:
+			return self._query_date_ranges(query_function, None, bucket)
+		return self._create_and_return_table(query_function(None))
+
+	def _query_date_ranges(self, query_function, date_range: tuple, bucket: str) -> QueryResult:
+		"""
+		The rows of `query_function(date_range)`, queried by a query per partition of the range,
+		run at the same time up to `max_parallel_partitions` and merged in order. The partitions
+		start on a bucket, so the rows are the same of a single query.
+		"""
+		ranges = date_partitions(date_range, self.partitions_start, datetime.now().date(), self.partition, bucket)
+		if len(ranges) <= 1:
+			# e.g. with the partitions starting in the future, or a range within a partition
+			return self.data_link.query(query_function(date_range))
+		producing_key = self.producing_key()
+		def run(partition_range):
+			# measured and cached as the rows of the sheet
+			with self._producing_as(producing_key):
+				return self.data_link.query(query_function(partition_range))
+		with ThreadPoolExecutor(max_workers=min(self.max_parallel_partitions, len(ranges)), thread_name_prefix='partition') as executor:
+			results = list(executor.map(run, ranges))
+		rows = QueryResult(itertools.chain.from_iterable(results))
+		rows.description = results[0].description
+		return rows
+
+	def forget_shared_results(self):
+		"""
+		Forget the results shared by the sheets, so they are computed again by the next sheet that needs them.
+		"""
+		with self._shared_lock:
+			self._shared_results = {}
+
+	def _shared(self, name: str, producer, cached: bool = True):
+		"""
+		Return the result of `producer`, computed once per run and shared by the sheets that use it.
+		The `cached` results are refreshed with the sheets that use them, so a sheet being refreshed
+		isn't built from the stale cached results of its queries.
+		"""
+		with self._shared_lock:
+			lock = self._shared_locks[name]
+		waiting_key = self.producing_key()
+		start = time.perf_counter()
+		with lock:
+			refresh = self.result_cache.refresh if cached and self.result_cache is not None else ()
+			if waiting_key in refresh and name not in refresh:
+				refresh.add(name)
+				self._shared_results.pop(name, None)
+			if name not in self._shared_results:
+				# cached and measured under its own name, whichever sheet needs it first
+				with self._producing_as(name), self.metrics.producing(name, shared=True):
+					self._shared_results[name] = producer()
+		self.metrics.add(waiting_key, SHARED, time.perf_counter() - start)
+		return self._shared_results[name]
+
+	@staticmethod
+	def _date_range_condition(column: str, date_range: tuple = None) -> str:
+		"""
+		SQL condition that restricts `column` to the `[start, end)` range, any bound can be None.
+		A range without start also has the NULL values, so consecutive ranges have all the rows.
+		"""
+		start, end = date_range if date_range else (None, None)
+		conditions = []
+		if start is not None:
+			conditions.append(f"{column} >= '{start}'")
+		if end is not None:
+			conditions.append(f"{column} < '{end}'" if start is not None else f"({column} < '{end}' OR {column} IS NULL)")
+		return ' AND '.join(conditions) if conditions else 'TRUE'
 
 	def _create_and_return_table(self, query):
+		if self.streaming:
+			return self.data_link.stream(query, self.batch_size)
 		return self.data_link.query(query)
 
 	def summary(self):
-		return [dict({
+		"""
+		Totals and the new users, enrollments and certificates on each of the configured windows of days.
+		All the counts are computed by a single query, that scans each table once.
+		"""
+		def window_columns(column, prefix):
+			return "".join(
+				f",\n\t\t\t\t\tCOUNT(CASE WHEN {column} > NOW() - INTERVAL {days} DAY THEN 1 END) as {prefix}_{days}"
+				for days in self.summary_windows
+			)
+		result = self.data_link.query(f"""
+			SELECT
+				(SELECT count(1) FROM {self.edxapp_database}.organizations_organization) as organizations,
+				(SELECT count(1) FROM {self.edxapp_database}.course_overviews_courseoverview) as courses,
+				users.*, enrollments.*, certificates.*
+			FROM (
+				SELECT
+					count(1) as users{window_columns('au.date_joined', 'users')}
+				FROM {self.edxapp_database}.auth_user au
+			) users, (
+				SELECT
+					count(1) as enrollments{window_columns('sce.created', 'enrollments')}
+				FROM {self.edxapp_database}.student_courseenrollment sce
+			) enrollments, (
+				SELECT
+					count(1) as certificates{window_columns('cgc.created_date', 'certificates')}
+				FROM {self.edxapp_database}.certificates_generatedcertificate cgc
+			) certificates
+		""")
+		# the queries explained by the profiler have no rows
+		counts = result[0] if result else collections.defaultdict(lambda: None)
+		summary = dict({
 			"Version": "v2",
 			"DataBase": (self.data_link.settings["host"] + ":" + self.data_link.settings["port"]),
 			"Date": datetime.now(),
-			"Organizations": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.organizations_organization"),
+			"Organizations": counts["organizations"],
 			# Global
-			"Courses": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.course_overviews_courseoverview"),
-			"Users": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.auth_user"),
-			"Enrollments": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.student_courseenrollment"),
-			"Certificates": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.certificates_generatedcertificate"),
-			# 7 Days
-			"New Users - 7 days": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.auth_user au WHERE au.date_joined > NOW() - INTERVAL 7 DAY"),
-			"New Enrollments - 7 days": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.student_courseenrollment sce WHERE sce.created > NOW() - INTERVAL 7 DAY"),
-			"News Certificates - 7 days": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.certificates_generatedcertificate cgc WHERE cgc.created_date > NOW() - INTERVAL 7 DAY"),
-			# 15 Days
-			"New Users - 15 days": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.auth_user au WHERE au.date_joined > NOW() - INTERVAL 15 DAY"),
-			"New Enrollments - 15 days": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.student_courseenrollment sce WHERE sce.created > NOW() - INTERVAL 15 DAY"),
-			"News Certificates - 15 days": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.certificates_generatedcertificate cgc WHERE cgc.created_date > NOW() - INTERVAL 15 DAY"),
-			# 30 Days
-			"New Users - 30 days": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.auth_user au WHERE au.date_joined > NOW() - INTERVAL 30 DAY"),
-			"New Enrollments - 30 days": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.student_courseenrollment sce WHERE sce.created > NOW() - INTERVAL 30 DAY"),
-			"News Certificates - 30 days": self.data_link.get(f"SELECT count(1) FROM {self.edxapp_database}.certificates_generatedcertificate cgc WHERE cgc.created_date > NOW() - INTERVAL 30 DAY"),
-		})]
+			"Courses": counts["courses"],
+			"Users": counts["users"],
+			"Enrollments": counts["enrollments"],
+			"Certificates": counts["certificates"],
+		})
+		for days in self.summary_windows:
+			summary[f"New Users - {days} days"] = counts[f"users_{days}"]
+			summary[f"New Enrollments - {days} days"] = counts[f"enrollments_{days}"]
+			summary[f"News Certificates - {days} days"] = counts[f"certificates_{days}"]
+		return [summary]
 
 	def final_summary(self):
 		return [dict({
@@ -210,12 +720,70 @@ class Reports:
 		"""
 		Each line is a course run.
 		"""
-		return self._create_and_return_table(f"""
+		courses = self._course_dimension()
+		result = []
+		for overview in courses.overviews:
+			row = {
+				'org_code': overview['org_code'],
+				'course_code': overview['course_code'],
+				'edition_code': overview['edition_code'],
+				'org_name': courses.org_name(overview['org_code']),
+			}
+			row.update(itertools.islice(overview.items(), 3, None))
+			aggregates = courses.aggregates(overview['id'])
+			row['enrolled_count'] = aggregates['enrolled_count']
+			row['enrolled_count_active'] = aggregates['enrolled_count_active']
+			row['certificates_count'] = aggregates['certificates_count']
+			row['average_grade'] = aggregates['average_grade']
+			row['course_runs_count'] = courses.runs_count(overview['course_code'])
+			row['course_run_is_first_edition'] = courses.is_first_edition(overview['course_code'], overview['id'])
+			row['passed'] = aggregates['passed']
+			result.append(row)
+		return result
+
+	def _course_dimension(self) -> CourseDimension:
+		"""
+		The course overviews, organization names and aggregates of each course run,
+		loaded once per run with grouped queries and shared by the course level sheets.
+		"""
+		return self._shared('course_dimension', lambda: CourseDimension(
+			self._course_overviews(),
+			self._organizations(),
+			[
+				self.data_link.query(f"""
+					SELECT course_id, count(1) as enrolled_count, count(CASE WHEN is_active THEN 1 END) as enrolled_count_active
+					FROM {self.edxapp_database}.student_courseenrollment
+					GROUP BY course_id
+				"""),
+				self.data_link.query(f"""
+					SELECT course_id, count(1) as certificates_count, AVG(grade) as average_grade
+					FROM {self.edxapp_database}.certificates_generatedcertificate
+					GROUP BY course_id
+				"""),
+				self.data_link.query(f"""
+					SELECT course_id, count(1) as passed
+					FROM {self.edxapp_database}.grades_persistentcoursegrade
+					WHERE passed_timestamp is not null
+					GROUP BY course_id
+				"""),
+			],
+		))
+
+	def _organizations(self) -> list:
+		# not named as the organizations sheet, so they are cached, refreshed and profiled on their own
+		return self._shared('organization_names', lambda: self.data_link.query(f"SELECT short_name, name FROM {self.edxapp_database}.organizations_organization"))
+
+	def _course_overviews(self) -> list:
+		"""
+		The course overviews ordered by creation, with the course codes, the dates relative to now
+		and the availability state, derived by the database or by the exporter.
+		"""
+		if not self.derive_in_exporter:
+			return self.data_link.query(f"""
 			SELECT 
 				SUBSTRING_INDEX(SUBSTRING_INDEX(id, ':', -1), '+', 1) as org_code,
 				SUBSTRING_INDEX(SUBSTRING_INDEX(id, '+', -2), '+', 1) as course_code,
 				SUBSTRING_INDEX(id, '+', -1) as edition_code,
-				(select oo.name from {self.edxapp_database}.organizations_organization oo WHERE org_code = oo.short_name) as org_name,
 				created, modified, id, _location, display_name, 
 				start, end, 
 				advertised_start, 
@@ -249,55 +817,157 @@ class Reports:
 						WHEN (NOT(COALESCE(coc.enrollment_start, coc.start) < NOW() AND NOW() < COALESCE(coc.enrollment_end, coc.end)) AND coc.end < NOW() ) THEN 'ARCHIVED_CLOSED' 
 						ELSE 'OTHER'
 					END
-				) AS availability_state,
-				(select count(1) from {self.edxapp_database}.student_courseenrollment sce WHERE sce.course_id = coc.id) AS enrolled_count,
-				(select count(1) from {self.edxapp_database}.student_courseenrollment sce WHERE sce.course_id = coc.id and sce.is_active) AS enrolled_count_active,
-			    (select count(1) from {self.edxapp_database}.certificates_generatedcertificate cgc WHERE cgc.course_id = coc.id) AS certificates_count,
-			    (select AVG(grade) from {self.edxapp_database}.certificates_generatedcertificate cgc WHERE cgc.course_id = coc.id) AS average_grade,
-				(select count(1) from {self.edxapp_database}.course_overviews_courseoverview coc2 where course_code=SUBSTRING_INDEX(SUBSTRING_INDEX(coc2.id, '+', -2), '+', 1)) as course_runs_count,
-				(select id from {self.edxapp_database}.course_overviews_courseoverview coc2 where course_code = SUBSTRING_INDEX(SUBSTRING_INDEX(coc2.id, '+', -2), '+', 1) order by created asc limit 1) = id as course_run_is_first_edition,
-				(select count(1) from {self.edxapp_database}.grades_persistentcoursegrade gpcg where coc.id = gpcg.course_id and gpcg.passed_timestamp is not null) as passed
+				) AS availability_state
+			FROM {self.edxapp_database}.course_overviews_courseoverview coc
+			ORDER BY created ASC
+			""")
+
+		overviews = self.data_link.query(f"""
+			SELECT 
+				created, modified, id, _location, display_name, 
+				start, end, 
+				advertised_start, 
+				CONCAT('https://lms.nau.edu.pt', course_image_url) as course_image_url, 
+				social_sharing_url, 
+				certificates_display_behavior, 
+				certificates_show_before_end, cert_html_view_enabled, 
+				has_any_active_web_certificate, cert_name_short, cert_name_long, 
+				lowest_passing_grade, days_early_for_beta, mobile_available, 
+				visible_to_staff_only, enrollment_start, 
+				enrollment_end, enrollment_domain, invitation_only, 
+				max_student_enrollments_allowed, announcement, catalog_visibility, 
+				course_video_url, effort, self_paced, 
+				certificate_available_date,
+				end as end_date,
+				start as start_date
 			FROM {self.edxapp_database}.course_overviews_courseoverview coc
 			ORDER BY created ASC
 		""")
+		# the same clock of the database
+		now = self.data_link.get("SELECT NOW()")
+		states = availability_states(
+			np.datetime64(now, 'us'),
+			*(to_datetime64([overview[column] for overview in overviews]) for column in ('enrollment_start', 'enrollment_end', 'start', 'end')),
+		)
+		result = []
+		for overview, state in zip(overviews, states):
+			org_code, course_code, edition_code = course_key_parts(overview['id'])
+			row = {'org_code': org_code, 'course_code': course_code, 'edition_code': edition_code}
+			row.update(overview)
+			opens = overview['start'] if overview['enrollment_start'] is None else overview['enrollment_start']
+			closes = overview['end'] if overview['enrollment_end'] is None else overview['enrollment_end']
+			row['enrollment_start_or_course_start'] = opens
+			row['enrollment_end_or_course_end'] = closes
+			row['days_to_enrollment_start'] = datediff(opens, now)
+			row['days_to_course_start'] = datediff(overview['start'], now)
+			row['days_to_enrollment_end'] = datediff(closes, now)
+			row['days_to_course_end'] = datediff(overview['end'], now)
+			row['availability_state'] = str(state)
+			result.append(row)
+		return result
 
-	def course_run_by_date(self):
-		return self._create_and_return_table(f"""
+	def _course_key_columns(self, column: str) -> str:
+		"""
+		SQL of the org_code, course_code and edition_code columns of a course id `column`,
+		empty when they are derived by the exporter.
+		"""
+		if self.derive_in_exporter:
+			return ""
+		return f"""SUBSTRING_INDEX(SUBSTRING_INDEX({column}, ':', -1), '+', 1) as org_code,
+				SUBSTRING_INDEX(SUBSTRING_INDEX({column}, '+', -2), '+', 1) as course_code,
+				SUBSTRING_INDEX({column}, '+', -1) as edition_code,"""
+
+	def _with_course_keys(self, rows, column: str, org_name: bool = False):
+		"""
+		Add the org_code, course_code and edition_code columns, and the org_name if requested,
+		in front of the other columns, when they are derived by the exporter from the course id `column`.
+		"""
+		if not self.derive_in_exporter:
+			return rows
+		org_names = organization_names(self._organizations()) if org_name else None
+		def add_course_keys(batch):
+			result = []
+			for row in batch:
+				org_code, course_code, edition_code = course_key_parts(row[column])
+				keys = {'org_code': org_code, 'course_code': course_code, 'edition_code': edition_code}
+				if org_names is not None:
+					keys['org_name'] = org_names.get(collation_key(org_code))
+				keys.update(row)
+				result.append(keys)
+			return result
+		return self._map_batches(rows, add_course_keys)
+
+	def _map_batches(self, rows, function):
+		"""
+		Apply `function`, that returns the new rows of a batch of rows, to a result.
+		A streamed result is mapped lazily, one batch at a time.
+		"""
+		if isinstance(rows, list):
+			return function(rows)
+		if hasattr(rows, 'open'):
+			rows.open()
+		rows = iter(rows)
+		batches = iter(lambda: list(itertools.islice(rows, self.batch_size)), [])
+		return itertools.chain.from_iterable(map(function, batches))
+
+	def course_run_by_date(self, date_range: tuple = None):
+		return self._course_run_by_date_rows(self._create_and_return_table(self._course_run_by_date_query(date_range)))
+
+	def _course_run_by_date_rows(self, rows):
+		"""
+		Add the attributes of the course run, from the course dimension, to the counts of each date.
+		"""
+		courses = self._course_dimension()
+		def course_run_dates(batch):
+			overviews = [courses.overview(row['course_id']) or {} for row in batch]
+			states = availability_states(
+				to_datetime64([row['date'] for row in batch]),
+				*(to_datetime64([overview.get(column) for overview in overviews]) for column in ('enrollment_start', 'enrollment_end', 'start', 'end')),
+			)
+			result = []
+			for row, overview, state in zip(batch, overviews, states):
+				course_id = row['course_id']
+				if self.derive_in_exporter:
+					org_code, course_code, edition_code = course_key_parts(course_id)
+				else:
+					org_code, course_code, edition_code = row['org_code'], row['course_code'], row['edition_code']
+				result.append({
+					'org_code': org_code,
+					'course_code': course_code,
+					'edition_code': edition_code,
+					'org_name': courses.org_name(org_code),
+					'course_id': course_id,
+					'date': row['date'],
+					# NULL for a course without overview, e.g. a deleted one, like the subquery of the database
+					'availability_state': str(state) if overview else None,
+					'enrollment_start': overview.get('enrollment_start'),
+					'enrollment_end': overview.get('enrollment_end'),
+					'start': overview.get('start'),
+					'end': overview.get('end'),
+					'course_name': overview.get('display_name'),
+					'catalog_visibility': overview.get('catalog_visibility'),
+					'course_marketing_url': overview.get('social_sharing_url'),
+					'self_paced': overview.get('self_paced'),
+					'invitation_only': overview.get('invitation_only'),
+					'enrollments_count': row['enrollments_count'],
+					'passed': row['passed'],
+					'certificates_count': row['certificates_count'],
+					'block_completion_count': row['block_completion_count'],
+					'course_run_is_first_edition': courses.is_first_edition(course_code, course_id),
+				})
+			return result
+		return self._map_batches(rows, course_run_dates)
+
+	def _course_run_by_date_query(self, date_range: tuple = None) -> str:
+		return f"""
 			SELECT 
-				SUBSTRING_INDEX(SUBSTRING_INDEX(course_id, ':', -1), '+', 1) as org_code,
-				SUBSTRING_INDEX(SUBSTRING_INDEX(course_id, '+', -2), '+', 1) as course_code,
-				SUBSTRING_INDEX(course_id, '+', -1) as edition_code,
-				(select oo.name from {self.edxapp_database}.organizations_organization oo WHERE org_code = oo.short_name) as org_name,				
+				{self._course_key_columns('course_id')}
 				course_id, 
 				date, 
-				(
-					SELECT CASE
-						WHEN (COALESCE(co.enrollment_start, co.start) < t.date AND t.date < COALESCE(co.enrollment_end, co.end) AND co.start < t.date AND t.date < co.end ) THEN 'ONGOING_OPEN'
-						WHEN (COALESCE(co.enrollment_start, co.start) < t.date AND t.date < COALESCE(co.enrollment_end, co.end) AND t.date < co.start ) THEN 'FUTURE_OPEN'
-						WHEN (COALESCE(co.enrollment_start, co.start) < t.date AND t.date < COALESCE(co.enrollment_end, co.end) AND co.end < t.date ) THEN 'ARCHIVED_OPEN'
-						WHEN (t.date < COALESCE(co.enrollment_start, co.start) AND t.date < co.start ) THEN 'FUTURE_NOT_YET_OPEN'
-						WHEN (NOT(COALESCE(co.enrollment_start, co.start) < t.date AND t.date < COALESCE(co.enrollment_end, co.end)) AND t.date IS NOT NULL AND t.date < co.start ) THEN 'FUTURE_CLOSED'
-						WHEN (NOT(COALESCE(co.enrollment_start, co.start) < t.date AND t.date < COALESCE(co.enrollment_end, co.end)) AND co.start < t.date AND t.date < co.end ) THEN 'ONGOING_CLOSED'
-						WHEN (NOT(COALESCE(co.enrollment_start, co.start) < t.date AND t.date < COALESCE(co.enrollment_end, co.end)) AND co.end < t.date ) THEN 'ARCHIVED_CLOSED' 
-						ELSE 'OTHER'
-					END
-					from {self.edxapp_database}.course_overviews_courseoverview co
-					where co.id = t.course_id
-				) as availability_state,
-				( SELECT co.enrollment_start from {self.edxapp_database}.course_overviews_courseoverview co where co.id = t.course_id) as enrollment_start,
-				( SELECT co.enrollment_end from {self.edxapp_database}.course_overviews_courseoverview co where co.id = t.course_id) as enrollment_end,
-				( SELECT co.start from {self.edxapp_database}.course_overviews_courseoverview co where co.id = t.course_id) as start,
-				( SELECT co.end from {self.edxapp_database}.course_overviews_courseoverview co where co.id = t.course_id) as end,
-				( SELECT co.display_name from {self.edxapp_database}.course_overviews_courseoverview co where co.id = t.course_id) as course_name,
-				( SELECT co.catalog_visibility from {self.edxapp_database}.course_overviews_courseoverview co where co.id = t.course_id) as catalog_visibility,
-				( SELECT co.social_sharing_url from {self.edxapp_database}.course_overviews_courseoverview co where co.id = t.course_id) as course_marketing_url,
-				( SELECT co.self_paced from {self.edxapp_database}.course_overviews_courseoverview co where co.id = t.course_id) as self_paced,
-				( SELECT co.invitation_only from {self.edxapp_database}.course_overviews_courseoverview co where co.id = t.course_id) as invitation_only,
 				SUM(enrollments_count) as enrollments_count,
 				SUM(passed) as passed,
 				SUM(certificates_count) as certificates_count,
-				SUM(block_completion_count) as block_completion_count,
-				(select id from {self.edxapp_database}.course_overviews_courseoverview coc2 where course_code = SUBSTRING_INDEX(SUBSTRING_INDEX(coc2.id, '+', -2), '+', 1) order by created asc limit 1) = course_id as course_run_is_first_edition
+				SUM(block_completion_count) as block_completion_count
 			FROM (
 				(
 					SELECT
@@ -308,6 +978,7 @@ class Reports:
 						0 as certificates_count,
 						0 as block_completion_count
 					FROM {self.edxapp_database}.student_courseenrollment sce
+					WHERE {self._date_range_condition('sce.created', date_range)}
 					GROUP BY course_id, date
 				) UNION (
 					SELECT
@@ -318,7 +989,7 @@ class Reports:
 						0 as certificates_count,
 						0 as block_completion_count
 					FROM {self.edxapp_database}.grades_persistentcoursegrade gpg
-					WHERE gpg.passed_timestamp is not null
+					WHERE gpg.passed_timestamp is not null AND {self._date_range_condition('gpg.passed_timestamp', date_range)}
 					GROUP BY course_id, date
 				) UNION (
 					SELECT
@@ -329,6 +1000,7 @@ class Reports:
 						count(1) AS certificates_count,
 						0 as block_completion_count
 					FROM {self.edxapp_database}.certificates_generatedcertificate
+					WHERE {self._date_range_condition('created_date', date_range)}
 					GROUP BY course_id, date
 				) UNION (
 					SELECT
@@ -339,17 +1011,75 @@ class Reports:
 						0 AS certificates_count,
 						COUNT(1) as block_completion_count
 					FROM {self.edxapp_database}.completion_blockcompletion cbc
+					WHERE {self._date_range_condition('cbc.created', date_range)}
 					GROUP BY course_key, date
 				)
 			) as t
 			GROUP BY course_id, date
-			ORDER BY date ASC
-		""")
+			ORDER BY date ASC, course_id ASC
+		"""
 
 	def enrollments_with_profile_info(self):
 		"""
 		Enrollment data with student information
 		"""
+		if not self.derived_enrollments_with_profile_info:
+			return self._enrollments_with_profile_info_correlated()
+		# the per user and per user and course counts are aggregated once and joined,
+		# instead of being counted by correlated subqueries on each enrollment
+		org_name_column = "" if self.derive_in_exporter else "oo.name as org_name,"
+		organizations_join = "" if self.derive_in_exporter else f"left join {self.edxapp_database}.organizations_organization oo on oo.short_name = SUBSTRING_INDEX(SUBSTRING_INDEX(sce.course_id, ':', -1), '+', 1)"
+		return self._with_course_keys(self._create_and_return_table(f"""
+			SELECT
+				{self._course_key_columns('sce.course_id')}
+				{org_name_column}
+				aup.year_of_birth, 
+				aup.gender, 
+				aup.level_of_education, 
+				aup.country,
+				sce.course_id, 
+				DATE_FORMAT(sce.created, "%Y-%m-%d") AS enrollment_created_date, 
+				sce.is_active as enrollment_is_active, 
+				sce.mode as enrollment_mode, 
+				nuem.employment_situation,
+				user_enrollments.enrollments_count as user_enrollments_count,
+				user_org_enrollments.enrollments_count as same_org_enrollments_count,
+				user_enrollments.enrollments_count = user_org_enrollments.enrollments_count as only_enrollments_this_org,
+				COALESCE(user_course_passed.passed, 0) as passed,
+				user_course_passed.passed_timestamp,
+				COALESCE(user_course_certificates.certificates, 0) as certificate,
+				aup.country in ('AO','BR','CV','GW','GQ','MZ','PT','ST','TL') as cplp
+			FROM {self.edxapp_database}.student_courseenrollment sce
+			left join {self.edxapp_database}.auth_userprofile aup on sce.user_id = aup.user_id
+			left join {self.edxapp_database}.nau_openedx_extensions_nauuserextendedmodel nuem on nuem.user_id = sce.user_id
+			{organizations_join}
+			join (
+				SELECT user_id, count(1) as enrollments_count
+				FROM {self.edxapp_database}.student_courseenrollment
+				GROUP BY user_id
+			) user_enrollments on user_enrollments.user_id = sce.user_id
+			join (
+				SELECT user_id, SUBSTRING_INDEX(SUBSTRING_INDEX(course_id, ':', -1), '+', 1) as org_code, count(1) as enrollments_count
+				FROM {self.edxapp_database}.student_courseenrollment
+				GROUP BY user_id, org_code
+			) user_org_enrollments on user_org_enrollments.user_id = sce.user_id and user_org_enrollments.org_code = SUBSTRING_INDEX(SUBSTRING_INDEX(sce.course_id, ':', -1), '+', 1)
+			left join (
+				SELECT user_id, course_id, count(1) as passed, MAX(passed_timestamp) as passed_timestamp
+				FROM {self.edxapp_database}.grades_persistentcoursegrade
+				WHERE passed_timestamp is not null
+				GROUP BY user_id, course_id
+			) user_course_passed on user_course_passed.user_id = sce.user_id and user_course_passed.course_id = sce.course_id
+			left join (
+				SELECT user_id, course_id, count(1) as certificates
+				FROM {self.edxapp_database}.certificates_generatedcertificate
+				GROUP BY user_id, course_id
+			) user_course_certificates on user_course_certificates.user_id = sce.user_id and user_course_certificates.course_id = sce.course_id
+		"""), 'course_id', org_name=True)
+
+	def _enrollments_with_profile_info_correlated(self):
+		"""
+		Enrollment data with student information, using correlated subqueries for each enrollment
+		"""
 		return self._create_and_return_table(f"""
 			SELECT
 				SUBSTRING_INDEX(SUBSTRING_INDEX(sce.course_id, ':', -1), '+', 1) as org_code,
@@ -377,6 +1107,57 @@ class Reports:
 			left join {self.edxapp_database}.nau_openedx_extensions_nauuserextendedmodel nuem on nuem.user_id = sce.user_id
 		""")
 
+	def _enrollments_breakdown(self, column: str, query_function):
+		"""
+		Enrollments and approved of each course by a profile `column`.
+		With `single_scan_enrollments` every breakdown is a projection of the same grouped query,
+		so the enrollments are joined with the profiles and grades only once per run.
+		"""
+		if not self.single_scan_enrollments:
+			return query_function()
+
+		groups = {}
+		for row in self._shared('enrollments_by_profile', self._enrollments_by_profile):
+			key = (row['course_id'], collation_key(row[column]))
+			group = groups.get(key)
+			if group is None:
+				group = groups[key] = {
+					'org_code': row['org_code'],
+					'course_code': row['course_code'],
+					'edition_code': row['edition_code'],
+					column: row[column],
+				}
+				if column == 'country':
+					country = row['country']
+					group['cplp'] = None if country is None else int(country.upper() in CPLP_COUNTRIES)
+				group['approved'] = 0
+				group['enrolled'] = 0
+			group['approved'] += row['approved']
+			group['enrolled'] += row['enrolled']
+		return [groups[key] for key in sorted(groups, key=lambda k: (k[0], k[1] is not None, k[1]))]
+
+	def _enrollments_by_profile(self):
+		"""
+		Enrollments and approved grouped by course and by all the profile columns of the breakdown sheets.
+		"""
+		return self._with_course_keys(self.data_link.query(f"""
+			SELECT
+				{self._course_key_columns('sce.course_id')}
+				sce.course_id,
+				aup.year_of_birth,
+				aup.gender,
+				aup.level_of_education,
+				aup.country,
+				nuem.employment_situation,
+				count(gpcg.id) as approved,
+				count(1) as enrolled
+			FROM {self.edxapp_database}.student_courseenrollment sce
+			left join {self.edxapp_database}.auth_userprofile aup on sce.user_id = aup.user_id
+			left join {self.edxapp_database}.nau_openedx_extensions_nauuserextendedmodel nuem on nuem.user_id = sce.user_id
+			left join {self.edxapp_database}.grades_persistentcoursegrade gpcg on sce.course_id = gpcg.course_id and sce.user_id = gpcg.user_id and gpcg.passed_timestamp is not null
+			GROUP BY sce.course_id, aup.year_of_birth, aup.gender, aup.level_of_education, aup.country, nuem.employment_situation
+		"""), 'course_id')
+
 	def enrollments_year_of_birth(self):
 		"""
 		Enrollment data with year of birth
@@ -485,8 +1266,11 @@ class Reports:
 			left join {self.edxapp_database}.nau_openedx_extensions_nauuserextendedmodel nuem on nuem.user_id = au.id
 		""")
 
-	def registered_users_by_day(self):
-		return self._create_and_return_table(f"""
+	def registered_users_by_day(self, date_range: tuple = None):
+		return self._create_and_return_table(self._registered_users_by_day_query(date_range))
+
+	def _registered_users_by_day_query(self, date_range: tuple = None) -> str:
+		return f"""
 			SELECT register_date, sum(active) as total_active, sum(total) as total, sum(enrollment_count) as enrollment_count
 			FROM 
 			(
@@ -498,6 +1282,7 @@ class Reports:
 						0 as enrollment_count
 					FROM
 						{self.edxapp_database}.auth_user au
+					WHERE {self._date_range_condition('au.date_joined', date_range)}
 					GROUP BY date_format(date_joined, "%Y-%m-%d"), au.is_active
 				) UNION (
 					SELECT
@@ -507,7 +1292,7 @@ class Reports:
 						0 as enrollment_count
 					FROM
 						{self.edxapp_database}.auth_user au
-					WHERE is_active=true
+					WHERE is_active=true AND {self._date_range_condition('au.date_joined', date_range)}
 					GROUP BY date_format(date_joined, "%Y-%m-%d"), au.is_active
 				) UNION (
 					SELECT
@@ -517,29 +1302,106 @@ class Reports:
 						count(1) as enrollment_count
 					FROM
 						{self.edxapp_database}.student_courseenrollment sce
+					WHERE {self._date_range_condition('sce.created', date_range)}
 					GROUP BY date_format(created, "%Y-%m-%d")
 				)
 			) as t
 			GROUP BY register_date
 			ORDER BY register_date ASC
-		""")
+		"""
 
-	def distinct_users_by_day(self):
+	def _distinct_users(self, window: str):
+		"""
+		Distinct users that have learn on each `window`: 'day', 'week', 'month' or 'rolling_30_days'.
+		On the approximate mode the counts are estimated by merging the daily sketches.
+		"""
+		if self.daily_user_sketches is not None:
+			sketches = self._shared('daily_user_sketches', lambda: self.daily_user_sketches.refresh(
+				self._distinct_users_by_day_pairs_query,
+				lambda query: self.data_link.stream(query, self.batch_size),
+				self.batch_size,
+			))
+			return distinct_counts_by_window(sketches, window)
+		match window:
+			case 'day':
+				return self._date_bucketed("distinct_users_by_day", self._distinct_users_by_day_query, 'date')
+			case 'month':
+				return self._date_bucketed("distinct_users_by_month", self._distinct_users_by_month_query, 'date', 'month')
+			case 'week':
+				return self._date_partitioned("distinct_users_by_week", self._distinct_users_by_week_query, 'week')
+			case 'rolling_30_days':
+				return self._date_partitioned("distinct_users_rolling_30_days", self._distinct_users_rolling_30_days_query)
+			case _:
+				raise ValueError(f"Invalid distinct users window {window}")
+
+	def _distinct_users_by_day_pairs_query(self, date_range: tuple = None) -> str:
+		return f"""
+			SELECT DISTINCT DATE_FORMAT(created, "%Y-%m-%d") date, user_id
+			FROM {self.edxapp_database}.completion_blockcompletion cbc
+			WHERE {self._date_range_condition('cbc.created', date_range)}
+		"""
+
+	def distinct_users_by_day(self, date_range: tuple = None):
 		"""
 		This gives the number of users that have learn by day
 		"""
-		return self._create_and_return_table(f"""
+		return self._create_and_return_table(self._distinct_users_by_day_query(date_range))
+
+	def _distinct_users_by_day_query(self, date_range: tuple = None) -> str:
+		return f"""
 	 		SELECT DATE_FORMAT(created, "%Y-%m-%d") date, COUNT(distinct user_id) as users
 			FROM {self.edxapp_database}.completion_blockcompletion cbc
+			WHERE {self._date_range_condition('cbc.created', date_range)}
 			GROUP BY date
-		""")
+			ORDER BY date ASC
+		"""
 	
-	def distinct_users_by_month(self):
+	def distinct_users_by_month(self, date_range: tuple = None):
 		"""
 		Number of users that have learn on the platform by month
 		"""
-		return self._create_and_return_table(f"""
+		return self._create_and_return_table(self._distinct_users_by_month_query(date_range))
+
+	def _distinct_users_by_month_query(self, date_range: tuple = None) -> str:
+		return f"""
 	 		SELECT DATE_FORMAT(created, "%Y-%m") date, COUNT(distinct user_id) as users
 			FROM {self.edxapp_database}.completion_blockcompletion cbc
+			WHERE {self._date_range_condition('cbc.created', date_range)}
 			GROUP BY date
-		""")
+			ORDER BY date ASC
+		"""
+
+	def distinct_users_by_week(self, date_range: tuple = None):
+		"""
+		Number of users that have learn on the platform by ISO week
+		"""
+		return self._create_and_return_table(self._distinct_users_by_week_query(date_range))
+
+	def _distinct_users_by_week_query(self, date_range: tuple = None) -> str:
+		return f"""
+			SELECT DATE_FORMAT(created, "%x-%v") date, COUNT(distinct user_id) as users
+			FROM {self.edxapp_database}.completion_blockcompletion cbc
+			WHERE {self._date_range_condition('cbc.created', date_range)}
+			GROUP BY date
+			ORDER BY date ASC
+		"""
+
+	def distinct_users_rolling_30_days(self, date_range: tuple = None):
+		"""
+		Number of users that have learn on the platform on the 30 days until each day
+		"""
+		return self._create_and_return_table(self._distinct_users_rolling_30_days_query(date_range))
+
+	def _distinct_users_rolling_30_days_query(self, date_range: tuple = None) -> str:
+		# the days of the range, each one with the users of its 30 days, also the ones before the range
+		return f"""
+			SELECT DATE_FORMAT(d.day, "%Y-%m-%d") date, COUNT(distinct cbc.user_id) as users
+			FROM (
+				SELECT DISTINCT DATE(created) day FROM {self.edxapp_database}.completion_blockcompletion
+				WHERE {self._date_range_condition('created', date_range)}
+			) d
+			JOIN {self.edxapp_database}.completion_blockcompletion cbc
+				ON cbc.created >= d.day - INTERVAL 29 DAY AND cbc.created < d.day + INTERVAL 1 DAY
+			GROUP BY d.day
+			ORDER BY d.day
+		"""
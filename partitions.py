@@ -0,0 +1,48 @@
+"""
+Split of the queries of the sheets bucketed by date on ranges of dates, e.g. one per month, that
+are queried at the same time, each one short and with a small temporary table, and merged in order.
+"""
+import datetime
+
+from incremental import bucket_start
+
+PARTITIONS = ('week', 'month', 'quarter', 'year')
+
+
+def _partition_start(day: datetime.date, partition: str) -> datetime.date:
+	if partition == 'week':
+		return day - datetime.timedelta(days=day.weekday())
+	if partition == 'month':
+		return day.replace(day=1)
+	if partition == 'quarter':
+		return day.replace(month=(day.month - 1) // 3 * 3 + 1, day=1)
+	return day.replace(month=1, day=1)
+
+
+def _next_partition(day: datetime.date, partition: str) -> datetime.date:
+	if partition == 'week':
+		return day + datetime.timedelta(days=7)
+	months = {'month': 1, 'quarter': 3, 'year': 12}[partition]
+	month = day.month - 1 + months
+	return day.replace(year=day.year + month // 12, month=month % 12 + 1, day=1)
+
+
+def date_partitions(date_range: tuple, first_day: datetime.date, last_day: datetime.date, partition: str, bucket: str) -> list:
+	"""
+	The `[start, end)` ranges that split `date_range`, with a boundary on each `partition` from
+	`first_day` until `last_day`, moved to the start of its `bucket`, 'day', 'week' or 'month', so
+	all the rows of a bucket are on the same range. The rows before `first_day`, and after
+	`last_day`, are on the first, and on the last, range, open when `date_range` is.
+	"""
+	if partition not in PARTITIONS:
+		raise ValueError(f"Invalid partition {partition}, choose from {', '.join(PARTITIONS)}")
+	start, end = date_range if date_range else (None, None)
+	boundaries = []
+	day = _partition_start(first_day, partition)
+	while day <= last_day:
+		boundary = bucket_start(day, bucket)
+		if (start is None or boundary > start) and (end is None or boundary < end) and (not boundaries or boundary > boundaries[-1]):
+			boundaries.append(boundary)
+		day = _next_partition(day, partition)
+	points = [start, *boundaries, end]
+	return list(zip(points, points[1:]))
@@ -0,0 +1,238 @@
+"""
+Profiler of the queries of the sheets, with the plans of the database instead of their results.
+The queries of each sheet are explained with `EXPLAIN FORMAT=JSON`, and optionally run with
+`EXPLAIN ANALYZE`, and their plans are summarized and stored, so the plans of two runs can be diffed.
+
+    python profiler.py state/query_profiles/20260101-020000.json state/query_profiles/20260102-020000.json
+"""
+import argparse
+import configparser
+import datetime
+import glob
+import hashlib
+import json
+import os
+
+import mysql.connector
+
+from nau import QueryResult, Reports
+
+# a change of the estimated rows of a query by this factor is reported on the diff
+_ROWS_CHANGE_FACTOR = 10
+
+
+def summarize_plan(plan: dict) -> dict:
+	"""
+	Summary of an `EXPLAIN FORMAT=JSON` plan of MySQL, or of MariaDB: its cost, the estimated rows
+	examined, the full table and index scans, the dependent subqueries, the temporary tables, the
+	filesorts and the access of each table.
+	"""
+	summary = {
+		"cost": None,
+		"rows": 0,
+		"full_scans": [],
+		"full_index_scans": [],
+		"dependent_subqueries": 0,
+		"temporary_tables": 0,
+		"filesorts": 0,
+		"tables": [],
+	}
+	cost = plan.get("query_block", {}).get("cost_info", {}).get("query_cost")
+	if cost is not None:
+		summary["cost"] = float(cost)
+
+	def walk(node):
+		if isinstance(node, list):
+			for value in node:
+				walk(value)
+			return
+		if not isinstance(node, dict):
+			return
+		if "table_name" in node and "access_type" in node:
+			rows = node.get("rows_examined_per_scan", node.get("rows", 0)) or 0
+			summary["tables"].append([node["table_name"], node["access_type"], node.get("key"), rows])
+			summary["rows"] += rows
+			if node["access_type"] == "ALL":
+				summary["full_scans"].append(node["table_name"])
+			elif node["access_type"] == "index":
+				summary["full_index_scans"].append(node["table_name"])
+		if node.get("dependent") is True:
+			summary["dependent_subqueries"] += 1
+		if node.get("using_temporary_table") is True or "temporary_table" in node:
+			summary["temporary_tables"] += 1
+		if node.get("using_filesort") is True or "filesort" in node:
+			summary["filesorts"] += 1
+		for value in node.values():
+			walk(value)
+
+	walk(plan)
+	return summary
+
+
+def _summary_line(summary: dict) -> str:
+	parts = [f"cost {summary['cost']}", f"~{summary['rows']:,} rows examined"]
+	if summary["full_scans"]:
+		parts.append(f"full scans of {', '.join(summary['full_scans'])}")
+	if summary["full_index_scans"]:
+		parts.append(f"full index scans of {', '.join(summary['full_index_scans'])}")
+	for field, name in (("dependent_subqueries", "dependent subqueries"), ("temporary_tables", "temporary tables"), ("filesorts", "filesorts")):
+		if summary[field]:
+			parts.append(f"{summary[field]} {name}")
+	return ', '.join(parts)
+
+
+class ExplainingDataLink:
+	"""
+	A DataLink that explains the queries of each sheet instead of running them, and returns them
+	without rows. `sheet_key()` returns the key of the sheet being produced. The single values of
+	`get`, e.g. the clock of the database, are still queried, as the sheets need them.
+	"""
+	def __init__(self, data_link, sheet_key, analyze: bool = False):
+		self.data_link = data_link
+		self.sheet_key = sheet_key
+		self.analyze = analyze
+		self.plans = {}
+
+	def __getattr__(self, name):
+		return getattr(self.data_link, name)
+
+	def _explain_value(self, statement: str) -> str:
+		value = next(iter(self.data_link.query(statement)[0].values()))
+		return value.decode() if isinstance(value, (bytes, bytearray)) else value
+
+	def _explain(self, query: str):
+		plan = json.loads(self._explain_value(f"EXPLAIN FORMAT=JSON {query}"))
+		entry = {
+			"sql_hash": hashlib.sha256(query.encode()).hexdigest()[:16],
+			"sql": query,
+			"summary": summarize_plan(plan),
+			"plan": plan,
+		}
+		if self.analyze:
+			try:
+				entry["analyze"] = self._explain_value(f"EXPLAIN ANALYZE {query}")
+			except mysql.connector.Error as e:
+				# only on MySQL 8.0.18 or newer
+				print(f"EXPLAIN ANALYZE isn't available: {e}")
+				self.analyze = False
+		self.plans.setdefault(self.sheet_key(), []).append(entry)
+
+	def query(self, query):
+		self._explain(query)
+		return QueryResult()
+
+	def stream(self, query, batch_size: int = 10000):
+		self._explain(query)
+		return QueryResult()
+
+
+def diff_profiles(previous: dict, current: dict) -> list:
+	"""
+	The changes of the query plans of each sheet between two profiles, as lines of text.
+	The queries of a sheet are compared in the order they run.
+	"""
+	lines = []
+	for key, entries in current["sheets"].items():
+		previous_entries = previous["sheets"].get(key)
+		if previous_entries is None:
+			lines.append(f"{key}: new sheet")
+			continue
+		if len(entries) != len(previous_entries):
+			lines.append(f"{key}: {len(previous_entries)} queries before, {len(entries)} now")
+		for number, (before, now) in enumerate(zip(previous_entries, entries), start=1):
+			name = f"{key} #{number}"
+			if before.get("error") or now.get("error"):
+				if before.get("error") != now.get("error"):
+					lines.append(f"{name}: error {before.get('error')!r} before, {now.get('error')!r} now")
+				continue
+			if before["sql_hash"] != now["sql_hash"]:
+				lines.append(f"{name}: the query changed")
+			old, new = before["summary"], now["summary"]
+			old_access = [table[:3] for table in old["tables"]]
+			new_access = [table[:3] for table in new["tables"]]
+			if old_access != new_access:
+				lines.append(f"{name}: the plan changed, tables (name, access, key) {old_access} before, {new_access} now")
+			for field in ("full_scans", "full_index_scans"):
+				added = sorted(set(new[field]) - set(old[field]))
+				if added:
+					lines.append(f"{name}: new {field.replace('_', ' ')} of {', '.join(added)}")
+			for field in ("dependent_subqueries", "temporary_tables", "filesorts"):
+				if old[field] != new[field]:
+					lines.append(f"{name}: {old[field]} {field.replace('_', ' ')} before, {new[field]} now")
+			if max(old["rows"], new["rows"]) >= _ROWS_CHANGE_FACTOR * max(min(old["rows"], new["rows"]), 1):
+				lines.append(f"{name}: ~{old['rows']:,} rows examined before, ~{new['rows']:,} now")
+	for key in previous["sheets"].keys() - current["sheets"].keys():
+		lines.append(f"{key}: no longer profiled")
+	return lines
+
+
+def _load_profile(path: str) -> dict:
+	with open(path) as f:
+		return json.load(f)
+
+
+def profile_queries(config: configparser.ConfigParser, report: Reports) -> str:
+	"""
+	Explain the queries of all the sheets, print a summary of their plans and the changes since
+	the previous profile, and save the profile on the `[profile]` directory. Returns its path.
+	A sheet that fails without the rows of its queries only has the queries run until then.
+	"""
+	directory = config.get('profile', 'directory', fallback=os.path.join('state', 'query_profiles'))
+	def label():
+		# the results shared by several sheets, e.g. the course_dimension of course_runs, have their own entries
+		key = report.producing_key()
+		return key if key is None or key in report.available_data else f"shared:{key}"
+	link = ExplainingDataLink(report.data_link, label, config.getboolean('profile', 'analyze', fallback=False))
+	report.data_link = link
+	# they would store the empty results of the sheets
+	report.incremental = None
+	report.daily_user_sketches = None
+
+	errors = {}
+	for key in report.available_sheets_to_export_keys():
+		try:
+			for _ in report.produce_sheets([key]):
+				pass
+		except Exception as e:
+			errors[key] = f"{type(e).__name__}: {e}"
+
+	sheets = {key: entries for key, entries in link.plans.items()}
+	for key, error in errors.items():
+		sheets.setdefault(key, []).append({"error": error})
+	for key in report.available_sheets_to_export_keys():
+		sheets.setdefault(key, [])
+	profile = {"generated": datetime.datetime.now().isoformat(timespec='seconds'), "sheets": sheets}
+
+	for key, entries in sheets.items():
+		if not entries:
+			print(f"{key}: no queries of its own")
+		for number, entry in enumerate(entries, start=1):
+			if "error" in entry:
+				print(f"{key} #{number}: stopped on {entry['error']}")
+			else:
+				print(f"{key} #{number}: {_summary_line(entry['summary'])}")
+
+	previous_paths = sorted(glob.glob(os.path.join(directory, '*.json')))
+	if previous_paths:
+		changes = diff_profiles(_load_profile(previous_paths[-1]), profile)
+		print(f"Changes since {previous_paths[-1]}:" if changes else f"No plan changes since {previous_paths[-1]}")
+		for line in changes:
+			print("  " + line)
+
+	os.makedirs(directory, exist_ok=True)
+	path = os.path.join(directory, datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+	with open(path, 'w') as f:
+		json.dump(profile, f, indent=1, default=str)
+	print(f"Saved the query profile to {path}")
+	return path
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Diff the query plans of two profiles saved by export.py --profile-queries.')
+	parser.add_argument('previous', help='The path of the previous profile.')
+	parser.add_argument('current', help='The path of the current profile.')
+	args = parser.parse_args()
+
+	changes = diff_profiles(_load_profile(args.previous), _load_profile(args.current))
+	for line in changes or ["No plan changes"]:
+		print(line)
@@ -0,0 +1,203 @@
+"""
+Script that exports each sheet to its own file, as gzip compressed CSV, JSON Lines or Parquet,
+e.g. to be loaded into a data warehouse.
+"""
+import configparser
+import csv
+import datetime
+import gzip
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from mysql.connector import FieldType
+
+import converters
+from nau import Reports, result_columns_and_rows
+
+FILE_EXTENSIONS = {
+	'csv': '.csv.gz',
+	'jsonl': '.jsonl',
+	'parquet': '.parquet',
+}
+
+_INTEGER_TYPE_CODES = (FieldType.TINY, FieldType.SHORT, FieldType.LONG, FieldType.LONGLONG, FieldType.INT24, FieldType.YEAR, FieldType.BIT)
+
+
+def write_csv(data, path: str):
+	"""
+	Write a sheet result to a gzip compressed CSV file, with a header row and NULL as empty.
+	Returns the number of rows.
+	"""
+	columns, lines = result_columns_and_rows(data)
+	rows = 0
+	with gzip.open(path, 'wt', newline='', encoding='utf-8') as f:
+		writer = csv.writer(f)
+		writer.writerow(columns)
+		for line in lines:
+			writer.writerow(line.values())
+			rows += 1
+	return rows
+
+
+def _json_value(value):
+	if isinstance(value, Decimal):
+		return float(value)
+	if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+		return value.isoformat()
+	return str(value)
+
+
+def write_jsonl(data, path: str):
+	"""
+	Write a sheet result to a JSON Lines file, an object per row, with the numbers as JSON numbers
+	and the dates on the ISO format. Returns the number of rows.
+	"""
+	_, lines = result_columns_and_rows(data)
+	encoder = json.JSONEncoder(ensure_ascii=False, default=_json_value)
+	rows = 0
+	with open(path, 'w', encoding='utf-8') as f:
+		for line in lines:
+			f.write(encoder.encode(line))
+			f.write('\n')
+			rows += 1
+	return rows
+
+
+def _arrow_type_of_description(pa, type_code: int):
+	"""
+	Arrow type of a column with the `type_code` of the cursor description. The decimals are stored
+	as doubles, as the description doesn't have their scale.
+	"""
+	kind = converters.kind_of_type_code(type_code)
+	if kind == converters.NUMBER:
+		return pa.int64() if type_code in _INTEGER_TYPE_CODES else pa.float64()
+	if kind == converters.DATE:
+		return pa.date32() if type_code in (FieldType.DATE, FieldType.NEWDATE) else pa.timestamp('us')
+	if kind == converters.TIME:
+		return pa.duration('us')
+	return pa.string()
+
+
+def _arrow_type_of_values(pa, values: list):
+	"""
+	Arrow type of a column from its values not NULL, string when they are of different kinds.
+	"""
+	types = {type(value) for value in values}
+	if not types or bool in types:
+		return pa.string()
+	if types <= {int}:
+		return pa.int64()
+	if types <= {int, float, Decimal}:
+		return pa.float64()
+	if types <= {datetime.date}:
+		return pa.date32()
+	if types <= {datetime.datetime, datetime.date}:
+		return pa.timestamp('us')
+	if types <= {datetime.timedelta}:
+		return pa.duration('us')
+	return pa.string()
+
+
+def _arrow_schema(pa, data, columns: list, first_rows: list):
+	"""
+	Schema of a sheet, from the description of its query or from the values of the `first_rows`.
+	"""
+	description = getattr(data, 'description', None)
+	if description is not None and [column[0] for column in description] == list(columns):
+		types = [_arrow_type_of_description(pa, column[1]) for column in description]
+	else:
+		types = [_arrow_type_of_values(pa, [row[index] for row in first_rows if row[index] is not None]) for index in range(len(columns))]
+	return pa.schema([pa.field(column, arrow_type) for column, arrow_type in zip(columns, types)])
+
+
+def _arrow_array(pa, values: tuple, field):
+	try:
+		return pa.array(values, type=field.type)
+	except (pa.ArrowInvalid, pa.ArrowTypeError):
+		if field.type == pa.string():
+			return pa.array([None if value is None else str(value) for value in values], type=field.type)
+		# the decimals are converted to doubles, other conversions would lose information
+		if field.type == pa.float64() and all(value is None or type(value) in (int, float, Decimal) for value in values):
+			return pa.array([None if value is None else float(value) for value in values], type=field.type)
+		raise ValueError(f"The column {field.name} of type {field.type} has values of other types")
+
+
+def write_parquet(data, path: str, batch_size: int = 10000):
+	"""
+	Write a sheet result to a Parquet file, with a row group per batch of `batch_size` rows.
+	The column types come from the description of the query or from the values of the first batch.
+	Returns the number of rows.
+	"""
+	try:
+		import pyarrow as pa
+		import pyarrow.parquet as pq
+	except ImportError as e:
+		raise ImportError("The parquet export needs pyarrow, install it with `pip install -r requirements-optional.txt`") from e
+
+	columns, lines = result_columns_and_rows(data)
+	lines = iter(lines)
+	def next_batch() -> list:
+		batch = []
+		for line in lines:
+			batch.append(tuple(line.values()))
+			if len(batch) >= batch_size:
+				break
+		return batch
+
+	batch = next_batch()
+	schema = _arrow_schema(pa, data, columns, batch)
+	rows = 0
+	with pq.ParquetWriter(path, schema, compression='snappy') as writer:
+		while batch:
+			# converted column by column
+			arrays = [_arrow_array(pa, values, field) for values, field in zip(zip(*batch), schema)]
+			writer.write_batch(pa.record_batch(arrays, schema=schema))
+			rows += len(batch)
+			batch = next_batch()
+	return rows
+
+
+def _write_file(file_format: str, data, path: str, batch_size: int) -> int:
+	# written to a temporary file, so a failed export doesn't leave a partial file
+	tmp_path = path + '.tmp'
+	match file_format:
+		case 'csv':
+			rows = write_csv(data, tmp_path)
+		case 'jsonl':
+			rows = write_jsonl(data, tmp_path)
+		case 'parquet':
+			rows = write_parquet(data, tmp_path, batch_size)
+		case _:
+			raise ValueError(f"Invalid file format {file_format}")
+	os.replace(tmp_path, path)
+	return rows
+
+
+def export_to_files(config : configparser.ConfigParser, report:Reports, file_format: str):
+	"""
+	Export each sheet to a file named after its key on the `[files]` directory.
+	The files of different sheets are written at the same time, up to `max_parallel_writes`.
+	"""
+	directory : str = config.get('files', 'directory', fallback='export')
+	max_parallel_writes : int = max(1, config.getint('files', 'max_parallel_writes', fallback=4))
+	sheets_to_export_keys = config.get('files', 'export', fallback=','.join(report.available_sheets_to_export_keys())).split(',')
+	os.makedirs(directory, exist_ok=True)
+
+	def write(sheet_key: str, sheet_title: str, sheet_result):
+		path = os.path.join(directory, sheet_key + FILE_EXTENSIONS[file_format])
+		with report.metrics.writing(sheet_key, file_format) as written:
+			written["rows"] = _write_file(file_format, sheet_result, path, report.batch_size)
+			written["bytes"] = os.path.getsize(path)
+
+	with ThreadPoolExecutor(max_workers=max_parallel_writes, thread_name_prefix='file') as executor:
+		# bounded, so the sheets aren't produced much faster than they are written
+		pending = deque()
+		for sheet in report.produce_sheets(sheets_to_export_keys):
+			if len(pending) >= max_parallel_writes:
+				pending.popleft().result()
+			pending.append(executor.submit(write, *sheet))
+		while pending:
+			pending.popleft().result()
@@ -5,15 +5,28 @@ from array import array
 import configparser
 import gspread
 import datetime
+import hashlib
+import itertools
+import os
+import random
+import threading
+import time
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from gspread.spreadsheet import Spreadsheet
-from gspread.exceptions import WorksheetNotFound
+from gspread.exceptions import APIError, WorksheetNotFound
 from gspread.worksheet import Worksheet
 from gspread.utils import ValueInputOption
 
-from nau import Reports
+import converters
+from nau import Reports, result_columns_and_rows
+from sharding import GOOGLE_MAX_CELLS, Manifest, ShardedRows
 
 def transform_value(value):
-	if isinstance(value, (datetime.datetime, datetime.date, datetime.time, datetime.timedelta)):
+	if isinstance(value, datetime.timedelta):
+		return str(value)
+	elif isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
 		return value.strftime("%Y-%m-%d") #  %H:%M:%S
 	elif value is None:
 		return ""
@@ -28,46 +41,460 @@ def transform_values(values : array):
 		new_values.append(new_value)
 	return new_values
 
-def write_data(data: dict, worksheet: Worksheet):
+# cell values of each kind of column, the numbers are sent as JSON numbers, not parsed again by Sheets
+def _number_cell(value):
+	"""
+	A number as a JSON number. The decimals are sent as floats, the numbers of Sheets, so a decimal
+	with more than 15 significant digits loses precision, e.g. 12345678901234567.89.
+	"""
+	if type(value) in (int, float):
+		return value
+	if type(value) is Decimal:
+		return float(value)
+	return transform_value(value)
+
+def _text_cell(value):
+	return value if type(value) is str else transform_value(value)
+
+def _date_cell(value):
+	return "" if value is None else value.strftime("%Y-%m-%d")
+
+def _time_cell(value):
+	return "" if value is None else str(value)
+
+CELL_CONVERTERS = {
+	converters.NUMBER: _number_cell,
+	converters.TEXT: _text_cell,
+	converters.DATE: _date_cell,
+	converters.TIME: _time_cell,
+}
+
+def cell_converters(kinds: list) -> converters.ColumnConverters:
+	"""
+	Converter of the rows to the cell values sent to Google Sheets, with a function per column.
+	"""
+	return converters.ColumnConverters(kinds, CELL_CONVERTERS, transform_value)
+
+# responses of the API that are retried: quota exceeded and server errors
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+class RateLimiter:
+	"""
+	Token bucket that allows `rate` requests per second, with bursts of up to `burst` requests.
+	"""
+	rate : float
+	burst : int
+
+	def __init__(self, rate: float, burst: int = 1):
+		self.rate = rate
+		self.burst = max(1, burst)
+		self._tokens = float(self.burst)
+		self._updated = time.monotonic()
+		self._lock = threading.Lock()
+
+	def acquire(self):
+		"""
+		Take a token, waiting until one is available. The waiting threads are served in turn.
+		"""
+		if self.rate <= 0:
+			return
+		with self._lock:
+			while True:
+				now = time.monotonic()
+				self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+				self._updated = now
+				if self._tokens >= 1:
+					self._tokens -= 1
+					return
+				time.sleep((1 - self._tokens) / self.rate)
+
+class Uploader:
+	"""
+	Calls to the Google Sheets API shared by all the uploads of a run, rate limited by a token bucket
+	and retried with exponential backoff on quota and server errors.
+	The writes are split on chunks of at most `batch_size` rows and about `max_payload_bytes`.
+	"""
+	limiter : RateLimiter
+	batch_size : int
+	max_payload_bytes : int
+	max_retries : int
+	backoff : float
+
+	def __init__(self, limiter: RateLimiter = None, batch_size: int = 10000, max_payload_bytes: int = 2000000, max_retries: int = 5, backoff: float = 1.0):
+		self.limiter = limiter if limiter is not None else RateLimiter(0)
+		self.batch_size = batch_size
+		self.max_payload_bytes = max_payload_bytes
+		self.max_retries = max_retries
+		self.backoff = backoff
+		self.stats = {"requests": 0, "retries": 0, "rows": 0, "bytes": 0}
+		self._lock = threading.Lock()
+
+	def call(self, function, *args, **kwargs):
+		"""
+		Call an API `function`, retrying it after `backoff * 2 ** attempt` seconds plus a random jitter.
+		"""
+		attempt = 0
+		while True:
+			self.limiter.acquire()
+			with self._lock:
+				self.stats["requests"] += 1
+			try:
+				return function(*args, **kwargs)
+			except APIError as e:
+				if attempt >= self.max_retries or e.response.status_code not in RETRY_STATUS_CODES:
+					raise
+			with self._lock:
+				self.stats["retries"] += 1
+			time.sleep(self.backoff * (2 ** attempt) * (1 + random.random()))
+			attempt += 1
+
+	def sent(self, rows: int, payload_bytes: int):
+		with self._lock:
+			self.stats["rows"] += rows
+			self.stats["bytes"] += payload_bytes
+
+	def chunk_is_full(self, rows: int, payload_bytes: int) -> bool:
+		return rows >= self.batch_size or payload_bytes >= self.max_payload_bytes
+
+def _payload_size(values: list) -> int:
 	"""
-	Write the result of the SQL query to a Google Sheet worksheet
+	Approximate size of a row on the JSON body of the requests, each text is quoted and separated.
 	"""
-	alter_data = []
+	return sum(len(value) + 3 if type(value) is str else 12 for value in values)
+
+def _grow(worksheet: Worksheet, last_row: int, uploader: Uploader):
+	# resize instead of add_rows, so a retried request doesn't grow it twice
+	if last_row > worksheet.row_count:
+		uploader.call(worksheet.resize, rows=last_row)
 
+def _write_rows(worksheet: Worksheet, first_row: int, rows: list, uploader: Uploader, payload_bytes: int) -> int:
+	"""
+	Write the rows starting on `first_row`, growing the worksheet if needed.
+	Returns the number of the next row to write.
+	"""
+	last_row = first_row + len(rows) - 1
+	_grow(worksheet, last_row, uploader)
+	uploader.call(worksheet.update, f"A{first_row}", rows, value_input_option=ValueInputOption.user_entered)
+	uploader.sent(len(rows), payload_bytes)
+	return last_row + 1
+
+def _shrink(worksheet: Worksheet, rows: int, uploader: Uploader):
+	# removes the rows left from a longer previous result, they also count on the cells limit
+	if worksheet.row_count > rows:
+		uploader.call(worksheet.resize, rows=max(rows, 1))
+
+def write_data(data, worksheet: Worksheet, uploader: Uploader = None) -> tuple:
+	"""
+	Write the result of the SQL query to a Google Sheet worksheet.
+	The rows are consumed incrementally and sent in chunks bounded by the `uploader` batch size
+	and payload size. Returns the number of rows and bytes sent.
+	"""
+	columns, lines = result_columns_and_rows(data)
+	converter = cell_converters(converters.column_kinds(data, columns))
+	return _write_data(columns, lines, converter, worksheet, uploader if uploader is not None else Uploader())
+
+def _write_data(columns: list, lines, converter: converters.ColumnConverters, worksheet: Worksheet, uploader: Uploader) -> tuple:
 	# append header
-	alter_data.append(transform_values(data[0].keys()))
+	header = transform_values(columns)
+	alter_data = [header]
+	payload_bytes = _payload_size(header)
+	next_row = 1
+	total_bytes = 0
 	
-	for line in data:
-		new_line = transform_values(line.values())
+	for line in lines:
+		new_line = converter.convert(line.values())
 		alter_data.append(new_line)
+		payload_bytes += _payload_size(new_line)
+		if uploader.chunk_is_full(len(alter_data), payload_bytes):
+			next_row = _write_rows(worksheet, next_row, alter_data, uploader, payload_bytes)
+			total_bytes += payload_bytes
+			alter_data = []
+			payload_bytes = 0
 	
-	worksheet.update(alter_data, value_input_option=ValueInputOption.user_entered)
+	if alter_data:
+		next_row = _write_rows(worksheet, next_row, alter_data, uploader, payload_bytes)
+		total_bytes += payload_bytes
+	_shrink(worksheet, next_row - 1, uploader)
+	return (next_row - 1, total_bytes)
+
+ROW_HASH_SIZE = 8
 
+def _row_hash(values: list) -> bytes:
+	return hashlib.blake2b('\x1f'.join(map(str, values)).encode(), digest_size=ROW_HASH_SIZE).digest()
 
-def export_queries_to_google(config : configparser.ConfigParser, report:Reports):
+class SheetFingerprints:
 	"""
-	Export the spread sheet information to Google Sheets.
-	Each table can be exported to a different Google Sheet file.
+	Hashes of the rows written on each worksheet, kept on local files, so the next run only
+	sends the rows that changed.
+	"""
+	directory : str
+
+	def __init__(self, directory: str):
+		self.directory = directory
+
+	def _path(self, key: str) -> str:
+		return os.path.join(self.directory, f"{key}.hashes")
+
+	def load(self, key: str) -> bytes:
+		try:
+			with open(self._path(key), 'rb') as f:
+				return f.read()
+		except FileNotFoundError:
+			return b''
+
+	def save(self, key: str, hashes: bytes):
+		os.makedirs(self.directory, exist_ok=True)
+		path = self._path(key)
+		tmp_path = path + '.tmp'
+		with open(tmp_path, 'wb') as f:
+			f.write(hashes)
+		os.replace(tmp_path, path)
+
+	def forget(self, key: str):
+		try:
+			os.remove(self._path(key))
+		except FileNotFoundError:
+			pass
+
+def _write_ranges(worksheet: Worksheet, ranges: list, uploader: Uploader, payload_bytes: int):
+	"""
+	Write a list of `(first_row, rows)` ranges with a single request, growing the worksheet if needed.
+	"""
+	_grow(worksheet, max(first_row + len(rows) - 1 for first_row, rows in ranges), uploader)
+	uploader.call(
+		worksheet.batch_update,
+		[{'range': f"A{first_row}", 'values': rows} for first_row, rows in ranges],
+		value_input_option=ValueInputOption.user_entered,
+	)
+	uploader.sent(sum(len(rows) for _, rows in ranges), payload_bytes)
+
+def write_data_delta(data, worksheet: Worksheet, fingerprints: SheetFingerprints, key: str, uploader: Uploader = None) -> tuple:
+	"""
+	Write only the rows of the worksheet that changed since its last write, comparing the hash
+	of each row with the ones stored on `fingerprints` with `key`.
+	The changed and appended rows are grouped on contiguous ranges and sent with `batch_update`
+	in chunks bounded by the `uploader` batch size and payload size, the rows left from a longer
+	previous result are removed. Returns the number of rows and bytes sent.
+	"""
+	columns, lines = result_columns_and_rows(data)
+	converter = cell_converters(converters.column_kinds(data, columns))
+	return _write_data_delta(columns, lines, converter, worksheet, fingerprints, key, uploader if uploader is not None else Uploader())
+
+def _write_data_delta(columns: list, lines, converter: converters.ColumnConverters, worksheet: Worksheet, fingerprints: SheetFingerprints, key: str, uploader: Uploader) -> tuple:
+	previous = fingerprints.load(key)
+	header = transform_values(columns)
+	# with other columns every row is written again
+	if previous[:ROW_HASH_SIZE] != _row_hash(header):
+		previous = b''
+
+	hashes = bytearray()
+	ranges = []
+	pending = 0
+	payload_bytes = 0
+	changed = 0
+	total_bytes = 0
+	for index, values in enumerate(itertools.chain([header], (converter.convert(line.values()) for line in lines))):
+		row_hash = _row_hash(values)
+		hashes += row_hash
+		offset = index * ROW_HASH_SIZE
+		if previous[offset:offset + ROW_HASH_SIZE] == row_hash:
+			continue
+		row_number = index + 1
+		if ranges and ranges[-1][0] + len(ranges[-1][1]) == row_number:
+			ranges[-1][1].append(values)
+		else:
+			ranges.append((row_number, [values]))
+		pending += 1
+		payload_bytes += _payload_size(values)
+		changed += 1
+		if uploader.chunk_is_full(pending, payload_bytes):
+			_write_ranges(worksheet, ranges, uploader, payload_bytes)
+			total_bytes += payload_bytes
+			ranges = []
+			pending = 0
+			payload_bytes = 0
+	if ranges:
+		_write_ranges(worksheet, ranges, uploader, payload_bytes)
+		total_bytes += payload_bytes
+
+	_shrink(worksheet, len(hashes) // ROW_HASH_SIZE, uploader)
+
+	# only stored after all the rows are written, a failed run sends them again on the next one
+	fingerprints.save(key, bytes(hashes))
+	return (changed, total_bytes)
+
+def _open_worksheet(client, spreadsheet_id: str, title: str, columns: list, uploader: Uploader, create: bool = True) -> tuple:
+	"""
+	Return the spreadsheet and its worksheet with the `title`, creating the worksheet if needed,
+	or None when it doesn't exist and not `create`.
+	"""
+	spreadsheet : Spreadsheet = uploader.call(client.open_by_key, spreadsheet_id)
+	# Get existing worksheet or create a new one
+	worksheet : Worksheet
+	try:
+		worksheet = uploader.call(spreadsheet.worksheet, title)
+	except WorksheetNotFound:
+		if not create:
+			return (spreadsheet, None)
+		# the result may be streamed, so its size is unknown, the rows are added while writing
+		worksheet = uploader.call(spreadsheet.add_worksheet, title, 1, max(len(columns), 1))
+	return (spreadsheet, worksheet)
+
+def _shard_capacity(spreadsheet: Spreadsheet, worksheet: Worksheet, columns: list, max_cells: int, uploader: Uploader) -> int:
+	"""
+	Number of rows, without the header, that fit on the worksheet without exceeding the `max_cells`
+	of the spreadsheet, with the cells used by its other worksheets.
+	"""
+	other_cells = sum(w.row_count * w.col_count for w in uploader.call(spreadsheet.worksheets) if w.id != worksheet.id)
+	return max(0, (max_cells - other_cells) // max(worksheet.col_count, len(columns), 1) - 1)
+
+def _write_shard(columns: list, lines, converter: converters.ColumnConverters, spreadsheet: Spreadsheet, worksheet: Worksheet, uploader: Uploader,
+		fingerprints: SheetFingerprints, lock: threading.Lock) -> tuple:
+	try:
+		if fingerprints is None:
+			return _write_data(columns, lines, converter, worksheet, uploader)
+		# a new worksheet has a new id, so nothing is stored for it and every row is written
+		return _write_data_delta(columns, lines, converter, worksheet, fingerprints, f"{spreadsheet.id}-{worksheet.id}", uploader)
+	finally:
+		lock.release()
+
+def _clear_shard(client, spreadsheet_id: str, title: str, uploader: Uploader, fingerprints: SheetFingerprints, lock: threading.Lock):
+	"""
+	Clear the worksheet of a shard not needed anymore, as the sheet now fits on fewer spreadsheets.
+	"""
+	with lock:
+		spreadsheet, worksheet = _open_worksheet(client, spreadsheet_id, title, [], uploader, create=False)
+		if worksheet is None:
+			return
+		_shrink(worksheet, 1, uploader)
+		uploader.call(worksheet.clear)
+		if fingerprints is not None:
+			fingerprints.forget(f"{spreadsheet.id}-{worksheet.id}")
+
+def _upload_sheet(client, spreadsheet_ids: list, sheet_title: str, sheet_result, uploader: Uploader, fingerprints: SheetFingerprints,
+		spreadsheet_locks: dict, max_cells: int = GOOGLE_MAX_CELLS, max_parallel_shards: int = 1) -> tuple:
 	"""
+	Upload a sheet to its worksheet on the first spreadsheet of `spreadsheet_ids`, and the rows that
+	don't fit on the `max_cells` of a spreadsheet to a worksheet with the same title on the next one.
+	The shards of a list are written at the same time, up to `max_parallel_shards`, the shards of
+	a stream one after the other. Each spreadsheet is locked while its shard is being written.
+	Returns the columns, the shards and the number of rows and bytes sent.
+	"""
+	columns, lines = result_columns_and_rows(sheet_result)
+	converter = cell_converters(converters.column_kinds(sheet_result, columns))
+	rows = ShardedRows(lines)
+	# the rows of a list are sliced, so its shards don't depend on each other
+	parallel = isinstance(sheet_result, list) and max_parallel_shards > 1 and len(spreadsheet_ids) > 1
+	shards = []
+	futures = []
+	with ThreadPoolExecutor(max_workers=max_parallel_shards if parallel else 1, thread_name_prefix='shard') as executor:
+		for index, spreadsheet_id in enumerate(spreadsheet_ids):
+			lock = spreadsheet_locks[spreadsheet_id]
+			if index > 0 and not rows.has_more():
+				_clear_shard(client, spreadsheet_id, sheet_title, uploader, fingerprints, lock)
+				continue
+			# released by the shard writer, after the rows are written
+			lock.acquire()
+			try:
+				spreadsheet, worksheet = _open_worksheet(client, spreadsheet_id, sheet_title, columns, uploader)
+				first_row = rows.count + 1
+				shard_rows = rows.take(_shard_capacity(spreadsheet, worksheet, columns, max_cells, uploader))
+				if parallel:
+					shard_rows = list(shard_rows)
+			except BaseException:
+				lock.release()
+				raise
+			future = executor.submit(_write_shard, columns, shard_rows, converter, spreadsheet, worksheet, uploader, fingerprints, lock)
+			if not parallel:
+				future.result()
+			futures.append(future)
+			shards.append({"spreadsheet_id": spreadsheet_id, "worksheet": sheet_title, "first_row": first_row, "rows": rows.count - first_row + 1})
+		results = [future.result() for future in futures]
+
+	if rows.has_more():
+		raise ValueError(f"The sheet {sheet_title} doesn't fit on its {len(spreadsheet_ids)} spreadsheets, add more spreadsheet ids to it on the [google_sheets] section")
+	return (columns, shards, sum(r[0] for r in results), sum(r[1] for r in results))
 
+def _print_throughput(title: str, rows: int, payload_bytes: int, seconds: float):
+	print(f"Uploaded {title}: {rows} rows, {payload_bytes / 1e6:.1f} MB in {seconds:.1f}s ({rows / max(seconds, 1e-6):.0f} rows/s, {payload_bytes / 1e6 / max(seconds, 1e-6):.2f} MB/s)")
+
+def google_client(config : configparser.ConfigParser):
+	"""
+	The gspread client of the `[google_service_account]`.
+	"""
 	credentials_list_tuples = config.items(section='google_service_account')
 	credentials_dict = dict(credentials_list_tuples)
-	gc = gspread.service_account_from_dict(credentials_dict)
-	
-	for sheet_key, worksheet_id in config.items('google_sheets'):
-		spreadsheet : Spreadsheet = gc.open_by_key(worksheet_id)		
-		sheets_results = report.sheets_data([sheet_key])
-		for sheet_title, sheet_result in sheets_results:
-			# Get existing worksheet or create a new one
-			worksheet : Worksheet
-			try:
-				worksheet = spreadsheet.worksheet(sheet_title)
-			except WorksheetNotFound:
-				rows_count = len(sheet_result)
-				column_count = len(sheet_result[0]) if sheet_result[0] else 1
-				worksheet = spreadsheet.add_worksheet(sheet_title, rows_count, column_count)
+	return gspread.service_account_from_dict(credentials_dict)
+
+
+def export_queries_to_google(config : configparser.ConfigParser, report:Reports, client = None):
+	"""
+	Export the spread sheet information to Google Sheets.
+	Each table can be exported to a different Google Sheet file.
+	The sheets of different spreadsheets are uploaded at the same time, up to `max_parallel_uploads`,
+	while the sheets of the same spreadsheet are uploaded one at a time.
+	A sheet with several comma separated spreadsheet ids is split on those spreadsheets when it
+	doesn't fit on the cells limit of one, and its shards are recorded on the manifest.
+	`client` is the gspread client to use, by default one for the `[google_service_account]`.
+	"""
+	own_client = client is None
+	if own_client:
+		client = google_client(config)
+
+	fingerprints = None
+	if config.getboolean('google_upload', 'delta', fallback=False):
+		fingerprints = SheetFingerprints(config.get('google_upload', 'fingerprints_dir', fallback=os.path.join('state', 'google_sheets')))
+
+	uploader = Uploader(
+		RateLimiter(
+			config.getfloat('google_upload', 'requests_per_minute', fallback=60) / 60,
+			config.getint('google_upload', 'burst', fallback=10),
+		),
+		batch_size=report.batch_size,
+		max_payload_bytes=config.getint('google_upload', 'max_payload_bytes', fallback=2000000),
+		max_retries=config.getint('google_upload', 'max_retries', fallback=5),
+		backoff=config.getfloat('google_upload', 'backoff_seconds', fallback=1.0),
+	)
+	max_parallel_uploads = max(1, config.getint('google_upload', 'max_parallel_uploads', fallback=1))
+	max_cells = config.getint('google_upload', 'max_cells', fallback=GOOGLE_MAX_CELLS)
+	manifest = Manifest(config.get('google_upload', 'manifest', fallback='google_sheets_manifest.json'))
+
+	def upload(sheet_key: str, sheet_title: str, sheet_result):
+		start = time.perf_counter()
+		with report.metrics.writing(sheet_key, 'google_sheets') as written:
+			columns, shards, rows, payload_bytes = _upload_sheet(client, spreadsheet_ids[sheet_key], sheet_title, sheet_result, uploader, fingerprints,
+				spreadsheet_locks, max_cells, max_parallel_uploads)
+			# the rows of the sheet, the rows sent also count the headers and, on delta uploads, only the changed rows
+			written.update(rows=sum(shard["rows"] for shard in shards), bytes=payload_bytes)
+		manifest.add(sheet_key, sheet_title, columns, shards)
+		if report.progress:
+			_print_throughput(sheet_title, rows, payload_bytes, time.perf_counter() - start)
+
+	start = time.perf_counter()
+	spreadsheet_ids = {key: [spreadsheet_id.strip() for spreadsheet_id in value.split(',')] for key, value in config.items('google_sheets')}
+	spreadsheet_locks = {spreadsheet_id: threading.Lock() for ids in spreadsheet_ids.values() for spreadsheet_id in ids}
+	sheets = report.produce_sheets(list(spreadsheet_ids.keys()))
+	if max_parallel_uploads <= 1:
+		for sheet in sheets:
+			upload(*sheet)
+	else:
+		with ThreadPoolExecutor(max_workers=max_parallel_uploads, thread_name_prefix='upload') as executor:
+			# bounded, so the sheets aren't produced much faster than they are uploaded
+			pending = deque()
+			for sheet in sheets:
+				if len(pending) >= max_parallel_uploads:
+					pending.popleft().result()
+				pending.append(executor.submit(upload, *sheet))
+			while pending:
+				pending.popleft().result()
+	# the configured sheets not exported on this run, e.g. not due on the daemon, keep their shards
+	manifest.keep_previous(spreadsheet_ids.keys())
+	manifest.save()
+
+	if report.progress:
+		_print_throughput("all sheets", uploader.stats["rows"], uploader.stats["bytes"], time.perf_counter() - start)
+		print(f"Google Sheets requests: {uploader.stats['requests']}, retried: {uploader.stats['retries']}")
 
-		write_data(sheet_result, worksheet)
-	
 	# Close connection to Google Cloud
-	gc.session.close()
+	if own_client:
+		client.session.close()
@@ -2,46 +2,89 @@
 Script that exports to a single xlsx file all the data relevant to be sent to Google Cloud.
 """
 import configparser
-import datetime
+import os
 
 import xlsxwriter
 
-from nau import Reports
+import converters
+from nau import Reports, result_columns_and_rows
+from sharding import XLSX_MAX_ROWS, Manifest, ShardedRows, shard_title
 
 
 def xlsx_worksheet(data, worksheet):
-	row = 0
-	col = 0
-	
-	for key in data[0]:
-		worksheet.write(row, col, key)
-		col += 1
-	
-	row = + 1
+	"""
+	Write a sheet result, a list of dicts or a RowStream, consuming its rows incrementally.
+	"""
+	columns, lines = result_columns_and_rows(data)
+	_write_worksheet(columns, lines, worksheet, converters.column_kinds(data, columns))
+
+
+def _cell_writers(worksheet) -> dict:
+	"""
+	The write method of the worksheet for each kind of column.
+	"""
+	return {
+		converters.NUMBER: worksheet.write_number,
+		converters.TEXT: worksheet.write_string,
+		converters.DATE: worksheet.write_datetime,
+		converters.TIME: worksheet.write_datetime,
+	}
+
+
+def _write_worksheet(columns: list, lines, worksheet, kinds: list = None):
+	"""
+	Write the header and the rows, in order, so it also works on the constant memory mode.
+	The write method of each column is chosen once, from its kind on `kinds` or from its first value.
+	"""
+	worksheet.write_row(0, 0, columns)
+	cell_writers = _cell_writers(worksheet)
+	writers = [None if kind is None else cell_writers.get(kind, worksheet.write) for kind in (kinds or [None] * len(columns))]
 	
-	for line in data:
-		col = 0
-		for value in line.values():
-			if isinstance(value, (datetime.datetime, datetime.date, datetime.time, datetime.timedelta)):
-				worksheet.write_datetime(row, col, value)
-			else:
+	row = 1
+	for line in lines:
+		for col, value in enumerate(line.values()):
+			# empty values are left blank, the same as the write method
+			if value is None or value == "":
+				continue
+			writer = writers[col]
+			if writer is None:
+				writer = writers[col] = cell_writers.get(converters.kind_of_value(value), worksheet.write)
+			try:
+				writer(row, col, value)
+			except TypeError:
+				# a value with other type than the one of its column
 				worksheet.write(row, col, value)
-			col += 1
 		row += 1
 
 
 def export_to_xlsx(config : configparser.ConfigParser, report:Reports):
 	file_name : str = config.get('xlsx', 'file', fallback='report.xlsx')
 	default_date_format : str = config.get('xlsx', 'default_date_format', fallback='yyyy-mm-dd')
-	workbook = xlsxwriter.Workbook(file_name, {'default_date_format': default_date_format})
+	# each row is flushed to a temporary file when the next one is started, so the memory doesn't grow with the rows
+	constant_memory : bool = config.getboolean('xlsx', 'constant_memory', fallback=True)
+	workbook = xlsxwriter.Workbook(file_name, {'default_date_format': default_date_format, 'constant_memory': constant_memory})
 
 	sheets_to_export_keys = config.get('xlsx', 'export', fallback=','.join(report.available_sheets_to_export_keys())).split(',')
 	
-	for sheet_key in sheets_to_export_keys:
-		sheets_results = report.sheets_data([sheet_key])
-		for sheet_title, sheet_result in sheets_results:
-			# xlsx supports max of 31 characters on sheet title
-			worksheet = workbook.add_worksheet(sheet_title[:31])
-			xlsx_worksheet(sheet_result, worksheet)
+	max_rows : int = config.getint('xlsx', 'max_rows', fallback=XLSX_MAX_ROWS)
+	manifest = Manifest(config.get('xlsx', 'manifest', fallback=os.path.splitext(file_name)[0] + '.manifest.json'))
+	
+	for sheet_key, sheet_title, sheet_result in report.produce_sheets(sheets_to_export_keys):
+		# the rows over the limit of a worksheet continue on numbered worksheets, each with the header
+		with report.metrics.writing(sheet_key, 'xlsx') as written:
+			columns, lines = result_columns_and_rows(sheet_result)
+			kinds = converters.column_kinds(sheet_result, columns)
+			rows = ShardedRows(lines)
+			shards = []
+			while not shards or rows.has_more():
+				# xlsx supports max of 31 characters on sheet title
+				title = shard_title(sheet_title, len(shards) + 1, 31)
+				worksheet = workbook.add_worksheet(title)
+				first_row = rows.count + 1
+				_write_worksheet(columns, rows.take(max_rows - 1), worksheet, kinds)
+				shards.append({"worksheet": title, "first_row": first_row, "rows": rows.count - first_row + 1})
+			written["rows"] = rows.count
+		manifest.add(sheet_key, sheet_title, columns, shards)
 	
 	workbook.close()
+	manifest.save()
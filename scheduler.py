@@ -0,0 +1,276 @@
+"""
+Daemon that exports each sheet on its own cadence, a cron expression or an interval, keeping the
+database connections and the Google Sheets session open between the runs, with the status of the
+runs on a local HTTP endpoint.
+"""
+import calendar
+import configparser
+import datetime
+import json
+import random
+import re
+import signal
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from export import export_report, save_metrics
+from metrics import RunMetrics, prometheus_text
+from nau import Reports
+
+# minute, hour, day of month, month and day of week, with 0 or 7 as Sunday
+_CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+_INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+class Interval:
+	"""
+	A cadence of a fixed number of seconds between the start of the runs, e.g. `30m`, `1h` or `1d`.
+	"""
+	def __init__(self, seconds: int):
+		self.seconds = seconds
+
+	def first(self, now: datetime.datetime) -> datetime.datetime:
+		return now
+
+	def next(self, after: datetime.datetime) -> datetime.datetime:
+		return after + datetime.timedelta(seconds=self.seconds)
+
+
+class Cron:
+	"""
+	A cadence of a cron expression, with the minute, hour, day of month, month and day of week,
+	each one `*`, a number, a range or a list of them, with an optional `/step`.
+	Like on cron, when both the day of month and the day of week are restricted, either one matches.
+	"""
+	def __init__(self, expression: str):
+		fields = expression.split()
+		if len(fields) != 5:
+			raise ValueError(f"Invalid cron expression {expression!r}, it needs 5 fields")
+		self.minutes, self.hours, self.days, self.months, weekdays = (
+			self._field(field, low, high) for field, (low, high) in zip(fields, _CRON_FIELDS))
+		self.weekdays = {weekday % 7 for weekday in weekdays}
+		self.any_day = fields[2].startswith('*')
+		self.any_weekday = fields[4].startswith('*')
+
+	@staticmethod
+	def _field(field: str, low: int, high: int) -> set:
+		values = set()
+		for part in field.split(','):
+			values_range, _, step = part.partition('/')
+			if values_range == '*':
+				start, end = low, high
+			elif '-' in values_range:
+				start, end = (int(value) for value in values_range.split('-'))
+			else:
+				start = int(values_range)
+				end = high if step else start
+			if not low <= start <= end <= high:
+				raise ValueError(f"Invalid cron field {field!r}, the values must be between {low} and {high}")
+			values.update(range(start, end + 1, int(step) if step else 1))
+		return values
+
+	def _day_matches(self, day: datetime.datetime) -> bool:
+		# the day of week of cron starts on Sunday
+		day_matches = day.day in self.days
+		weekday_matches = (day.weekday() + 1) % 7 in self.weekdays
+		if self.any_day or self.any_weekday:
+			return day_matches and weekday_matches
+		return day_matches or weekday_matches
+
+	def first(self, now: datetime.datetime) -> datetime.datetime:
+		return self.next(now)
+
+	def next(self, after: datetime.datetime) -> datetime.datetime:
+		moment = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+		while moment.year <= after.year + 5:
+			if moment.month not in self.months:
+				days_in_month = calendar.monthrange(moment.year, moment.month)[1]
+				moment = moment.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=days_in_month)
+			elif not self._day_matches(moment):
+				moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+			elif moment.hour not in self.hours:
+				moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+			elif moment.minute not in self.minutes:
+				moment += datetime.timedelta(minutes=1)
+			else:
+				return moment
+		raise ValueError("The cron expression never matches")
+
+
+def cadence(value: str):
+	"""
+	The cadence of a value of the configuration, an interval like `30m` or a cron expression.
+	"""
+	match = re.fullmatch(r'\s*(\d+)\s*([smhd])\s*', value)
+	if match:
+		return Interval(int(match.group(1)) * _INTERVAL_UNITS[match.group(2)])
+	return Cron(value)
+
+
+class DueSheetsReport:
+	"""
+	The `Reports` of a run of the daemon, that only produces the sheets due on that run,
+	the other attributes are the ones of the `Reports`.
+	"""
+	def __init__(self, report: Reports, keys: list):
+		self._report = report
+		self._keys = keys
+
+	def __getattr__(self, name):
+		return getattr(self._report, name)
+
+	def available_sheets_to_export_keys(self):
+		return list(self._keys)
+
+	def produce_sheets(self, sheets_keys: list):
+		return self._report.produce_sheets([key for key in sheets_keys if key in self._keys])
+
+
+class _Schedule:
+	"""
+	The sheets with the same cadence, run together so they share their results.
+	"""
+	def __init__(self, value: str, keys: list, now: datetime.datetime, jitter_seconds: float):
+		self.value = value
+		self.cadence = cadence(value)
+		self.keys = keys
+		self.jitter_seconds = jitter_seconds
+		self.due = self._jittered(self.cadence.first(now))
+
+	def _jittered(self, moment: datetime.datetime) -> datetime.datetime:
+		return moment + datetime.timedelta(seconds=random.uniform(0, self.jitter_seconds))
+
+	def advance(self, now: datetime.datetime):
+		self.due = self._jittered(self.cadence.next(now))
+
+
+class Scheduler:
+	"""
+	Runs the export of the sheets when they are due, one run at a time, so the runs of a sheet
+	never overlap. A sheet that comes due during a run runs after it, and the occurrences of its
+	cadence missed during a long run are skipped. A run that fails doesn't stop the daemon.
+	"""
+	def __init__(self, config: configparser.ConfigParser, report: Reports, export_modes_selected: list):
+		self.config = config
+		self.report = report
+		self.export_modes_selected = export_modes_selected
+		self.stop = threading.Event()
+		self.started = datetime.datetime.now()
+		self.running = None
+		self.last_run = None
+		self._lock = threading.Lock()
+
+		default = config.get('daemon', 'default', fallback='0 2 * * *')
+		cadences = {key: value for key, value in config.items('daemon_sheets', raw=True) if key not in config.defaults()} if config.has_section('daemon_sheets') else {}
+		keys_by_cadence = {}
+		for key in report.available_sheets_to_export_keys():
+			keys_by_cadence.setdefault(cadences.get(key, default), []).append(key)
+		jitter_seconds = config.getfloat('daemon', 'jitter_seconds', fallback=60)
+		self.schedules = [_Schedule(value, keys, self.started, jitter_seconds) for value, keys in keys_by_cadence.items()]
+		self.sheets = {key: {"cadence": schedule.value, "runs": 0, "failures": 0, "last_started": None, "last_seconds": None, "last_succeeded": None, "last_error": None}
+			for schedule in self.schedules for key in schedule.keys}
+
+		self.google_client = None
+		if 'google_sheets' in export_modes_selected:
+			from report_google import google_client
+			self.google_client = google_client(config)
+
+	def _run(self, keys: list):
+		started = datetime.datetime.now()
+		with self._lock:
+			self.running = {"keys": keys, "started": started.isoformat(timespec='seconds')}
+		print(f"Running {', '.join(keys)}")
+		# each run has its own metrics and computes again the results shared by its sheets
+		self.report.metrics = RunMetrics()
+		self.report.forget_shared_results()
+		succeeded = False
+		error = None
+		try:
+			export_report(self.config, DueSheetsReport(self.report, keys), self.export_modes_selected, self.google_client)
+			succeeded = True
+		except Exception as e:
+			traceback.print_exc()
+			error = f"{type(e).__name__}: {e}"
+		run = save_metrics(self.config, self.report, succeeded)
+		seconds = (datetime.datetime.now() - started).total_seconds()
+		print(f"Run of {', '.join(keys)} {'succeeded' if succeeded else 'failed'} in {seconds:.1f}s")
+		with self._lock:
+			self.running = None
+			self.last_run = run
+			for key in keys:
+				sheet = self.sheets[key]
+				sheet.update(last_started=started.isoformat(timespec='seconds'), last_seconds=round(seconds, 3), last_succeeded=succeeded, last_error=error)
+				sheet["runs"] += 1
+				sheet["failures"] += not succeeded
+
+	def run_pending(self) -> float:
+		"""
+		Run the sheets that are due, and return the seconds until the next ones are.
+		"""
+		now = datetime.datetime.now()
+		due = [schedule for schedule in self.schedules if schedule.due <= now]
+		if due:
+			for schedule in due:
+				schedule.advance(now)
+			self._run([key for schedule in due for key in schedule.keys])
+		return max(0.0, (min(schedule.due for schedule in self.schedules) - datetime.datetime.now()).total_seconds())
+
+	def status(self) -> dict:
+		with self._lock:
+			return {
+				"started": self.started.isoformat(timespec='seconds'),
+				"running": self.running,
+				"sheets": {key: {**sheet, "next_due": schedule.due.isoformat(timespec='seconds')}
+					for schedule in self.schedules for key, sheet in self.sheets.items() if key in schedule.keys},
+				"last_run": self.last_run,
+			}
+
+	def run_forever(self):
+		"""
+		Run the sheets when they are due until SIGTERM or SIGINT, serving the status on the
+		`[daemon]` HTTP port.
+		"""
+		for signal_number in (signal.SIGTERM, signal.SIGINT):
+			signal.signal(signal_number, lambda *_: self.stop.set())
+		server = None
+		http_port = self.config.getint('daemon', 'http_port', fallback=8000)
+		if http_port:
+			server = status_server(self, self.config.get('daemon', 'http_host', fallback='127.0.0.1'), http_port)
+			threading.Thread(target=server.serve_forever, name='status', daemon=True).start()
+		try:
+			while not self.stop.is_set():
+				# woken up at least every minute, so a change of the clock doesn't delay the runs much
+				self.stop.wait(min(self.run_pending(), 60))
+		finally:
+			if server is not None:
+				server.shutdown()
+			if self.google_client is not None:
+				self.google_client.session.close()
+
+
+def status_server(scheduler: Scheduler, host: str, port: int) -> ThreadingHTTPServer:
+	"""
+	HTTP server with the status of the daemon on `/status`, as JSON, and the metrics of its last run
+	on `/metrics`, on the Prometheus text format.
+	"""
+	class StatusHandler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path in ('/', '/status'):
+				body, content_type = json.dumps(scheduler.status(), indent=1, default=str), 'application/json'
+			elif self.path == '/metrics' and scheduler.last_run is not None:
+				body, content_type = prometheus_text(scheduler.last_run), 'text/plain; version=0.0.4'
+			else:
+				self.send_error(404)
+				return
+			data = body.encode()
+			self.send_response(200)
+			self.send_header('Content-Type', content_type)
+			self.send_header('Content-Length', str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+
+		def log_message(self, format, *args):
+			pass
+
+	return ThreadingHTTPServer((host, port), StatusHandler)
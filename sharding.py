@@ -0,0 +1,94 @@
+"""
+Split of the sheets that exceed the limits of the export targets on several worksheets or
+spreadsheets, and the manifest of how the shards fit back together.
+"""
+import datetime
+import itertools
+import json
+import os
+import threading
+
+# rows of a xlsx worksheet, including the header
+XLSX_MAX_ROWS = 1048576
+# cells of a Google spreadsheet, of all its worksheets
+GOOGLE_MAX_CELLS = 10000000
+
+
+class ShardedRows:
+	"""
+	Consecutive shards of an iterator of rows, with the size of each shard chosen when it is taken.
+	Each shard must be consumed before checking for more rows or taking the next one.
+	"""
+	count : int
+
+	def __init__(self, lines):
+		self._lines = iter(lines)
+		self._next = []
+		self.count = 0
+
+	def has_more(self) -> bool:
+		if not self._next:
+			self._next = list(itertools.islice(self._lines, 1))
+		return bool(self._next)
+
+	def take(self, size: int):
+		"""
+		Iterator of the next `size` rows at most.
+		"""
+		head, self._next = self._next[:size], self._next[size:]
+		for line in itertools.chain(head, itertools.islice(self._lines, size - len(head))):
+			self.count += 1
+			yield line
+
+
+def shard_title(title: str, number: int, max_length: int = None) -> str:
+	"""
+	Title of the worksheet of the shard `number`, starting on 1, the first keeps the sheet title.
+	"""
+	suffix = "" if number == 1 else f" ({number})"
+	if max_length is not None:
+		title = title[:max_length - len(suffix)]
+	return title + suffix
+
+
+class Manifest:
+	"""
+	Shards of each exported sheet, saved as a JSON file, so the dashboard can join them back.
+	Each shard has its location, e.g. the worksheet or the spreadsheet id, and the `first_row`
+	and number of `rows` of the sheet that it has, without counting the header of each shard.
+	"""
+	path : str
+
+	def __init__(self, path: str):
+		self.path = path
+		self.sheets = {}
+		self._lock = threading.Lock()
+
+	def add(self, key: str, title: str, columns: list, shards: list):
+		with self._lock:
+			self.sheets[key] = {
+				"title": title,
+				"columns": list(columns),
+				"rows": sum(shard["rows"] for shard in shards),
+				"shards": shards,
+			}
+
+	def keep_previous(self, keys):
+		"""
+		Keep the shards of the saved manifest of the sheets of `keys` that weren't added.
+		"""
+		if not os.path.exists(self.path):
+			return
+		with open(self.path) as f:
+			previous = json.load(f)["sheets"]
+		with self._lock:
+			for key in keys:
+				if key not in self.sheets and key in previous:
+					self.sheets[key] = previous[key]
+
+	def save(self):
+		os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+		tmp_path = self.path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump({"generated": datetime.datetime.now().isoformat(timespec='seconds'), "sheets": self.sheets}, f, indent=1)
+		os.replace(tmp_path, self.path)
@@ -0,0 +1,127 @@
+"""
+The synthetic edxapp dataset extracted to a local store, so the sheets run on DuckDB without a
+MySQL database.
+"""
+import configparser
+import random
+import re
+
+import pytest
+from mysql.connector import FieldType
+
+import dataset
+import nau
+from local_store import LocalStore
+from nau import Reports
+
+DATABASE = 'edxapp'
+ENROLLMENTS = 2000
+
+_FIELD_TYPES = [
+	('TINYINT', FieldType.TINY),
+	('BIGINT', FieldType.LONGLONG),
+	('INT', FieldType.LONG),
+	('DATETIME', FieldType.DATETIME),
+	('DOUBLE', FieldType.DOUBLE),
+	('DECIMAL', FieldType.NEWDECIMAL),
+]
+
+
+def _table_columns(ddl: str) -> dict:
+	"""
+	The field type of each column of a CREATE TABLE of the dataset.
+	"""
+	columns = {}
+	for line in ddl.splitlines()[2:]:
+		match = re.match(r'\s*(\w+) (\w+)', line)
+		if match is None or match.group(1) in ('KEY', 'UNIQUE', 'PRIMARY'):
+			continue
+		columns[match.group(1)] = next((code for prefix, code in _FIELD_TYPES if match.group(2).startswith(prefix)), FieldType.VAR_STRING)
+	return columns
+
+
+class _DatasetStream:
+	"""
+	The rows of a column list of a dataset table, with the interface of a RowStream.
+	"""
+	def __init__(self, columns: list, description: list, rows: list):
+		self.columns = columns
+		self.description = description
+		self._rows = rows
+
+	def open(self):
+		return self
+
+	def __iter__(self):
+		for row in self._rows:
+			yield dict(zip(self.columns, row))
+
+	def close(self):
+		pass
+
+
+class DatasetSource:
+	"""
+	The tables of the synthetic dataset in memory, queried by the full extracts of the local store.
+	"""
+	def __init__(self, enrollments: int, seed: int = 0):
+		counts = dataset.scale_counts(enrollments)
+		self.tables = {table: [] for table in dataset.TABLES}
+		for table, row in (
+			*(("organizations_organization", row) for row in dataset.organizations(counts, random.Random(seed * 10 + 1))),
+			*(("course_overviews_courseoverview", row) for row in dataset.course_overviews(counts, random.Random(seed * 10 + 2))),
+			*dataset.users(counts, random.Random(seed * 10 + 3)),
+			*dataset.enrollments(counts, random.Random(seed * 10 + 4)),
+		):
+			self.tables[table].append(row)
+		self.columns = {table: _table_columns(ddl) for table, ddl in dataset.TABLES.items()}
+
+	def stream(self, query: str, batch_size: int = 10000) -> _DatasetStream:
+		match = re.fullmatch(rf"SELECT (.+) FROM {DATABASE}\.(\w+)", query)
+		assert match is not None, f"Only full extracts are expected: {query}"
+		table = match.group(2)
+		table_columns = list(self.columns[table])
+		names, description, indexes = [], [], []
+		for column in match.group(1).split(', '):
+			# an expression with its alias, e.g. `grade + 0 as grade`
+			source, _, alias = column.partition(' as ')
+			name = source.split()[0]
+			names.append(alias or name)
+			description.append((alias or name, FieldType.DOUBLE if alias else self.columns[table][name]))
+			indexes.append(table_columns.index(name))
+		# the booleans of the generator are read as numbers from MySQL
+		rows = [tuple(int(row[index]) if isinstance(row[index], bool) else row[index] for index in indexes) for row in self.tables[table]]
+		return _DatasetStream(names, description, rows)
+
+
+@pytest.fixture(scope='session')
+def local_store(tmp_path_factory):
+	"""
+	The synthetic dataset extracted to a local store, shared by the tests.
+	"""
+	store = LocalStore(str(tmp_path_factory.mktemp('local_store') / 'store.duckdb'), DatasetSource(ENROLLMENTS), DATABASE)
+	store.extract(progress=False)
+	yield store
+	store.close()
+
+
+@pytest.fixture
+def reports_on_local_store(local_store, monkeypatch):
+	"""
+	Returns a Reports, with the options of the `[sheets]` section and the other `sections`, whose
+	queries run on the local store.
+	"""
+	# extracted once and closed after all the tests
+	monkeypatch.setattr(nau, 'LocalStore', lambda *args, **kwargs: local_store)
+	monkeypatch.setattr(local_store, 'extract', lambda progress=True: None)
+	monkeypatch.setattr(local_store, 'close', lambda: None)
+	def reports(sections: dict = None, refresh_sheets: list = (), **sheets_options) -> Reports:
+		config = configparser.ConfigParser()
+		config.read_dict({
+			'connection': {'database': DATABASE, 'password': ''},
+			'sheets': {'progress': '', **{name: str(value) for name, value in sheets_options.items()}},
+			'local_store': {'enabled': 'True'},
+			**(sections or {}),
+		})
+		return Reports(config, refresh_sheets=refresh_sheets)
+	return reports
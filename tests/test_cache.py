@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+from cache import CachingDataLink, ResultCache
+
+
+@pytest.fixture
+def renamed_organization(local_store):
+	"""
+	Returns a function that renames the ORG0 organization on the store, restored at the end.
+	"""
+	name = local_store.connection.execute("SELECT name FROM edxapp.organizations_organization WHERE short_name = 'ORG0'").fetchone()[0]
+	def rename(new_name: str):
+		local_store.connection.execute("UPDATE edxapp.organizations_organization SET name = ? WHERE short_name = 'ORG0'", [new_name])
+	yield rename
+	rename(name)
+
+
+def _org0_names(report) -> set:
+	(_, _, rows), = report.produce_sheets(['course_runs'])
+	return {row['org_name'] for row in rows if row['org_code'] == 'ORG0'}
+
+
+def test_refresh_of_a_sheet_also_refreshes_its_shared_results(reports_on_local_store, renamed_organization, tmp_path):
+	sections = {'cache': {'enabled': 'True', 'directory': str(tmp_path)}}
+	original = _org0_names(reports_on_local_store(sections))
+
+	renamed_organization("Renamed organization")
+	# served from the cache while valid
+	assert _org0_names(reports_on_local_store(sections)) == original
+	assert _org0_names(reports_on_local_store(sections, refresh_sheets=['course_runs'])) == {"Renamed organization"}
+	# and the refreshed results replaced the cached ones
+	assert _org0_names(reports_on_local_store(sections)) == {"Renamed organization"}
+
+
+class _RowsLink:
+	"""
+	A DataLink with the same rows for every query, that counts the queries it runs.
+	"""
+	def __init__(self, rows: list):
+		self.rows = rows
+		self.queries = 0
+
+	def stream(self, query, batch_size: int = 10000):
+		self.queries += 1
+		return _ListStream(self.rows)
+
+
+class _ListStream:
+	description = None
+
+	def __init__(self, rows: list):
+		self.rows = rows
+		self.columns = list(rows[0].keys())
+
+	def open(self):
+		return self
+
+	def __iter__(self):
+		return iter(self.rows)
+
+	def close(self):
+		pass
+
+
+def test_a_cached_stream_evicted_before_it_is_read_is_still_read(tmp_path):
+	rows = [{'id': n, 'name': f"row {n}"} for n in range(2500)]
+	source = _RowsLink(rows)
+	cache = ResultCache(str(tmp_path), 'target')
+	link = CachingDataLink(source, cache, lambda: 'sheet', list)
+	assert list(link.stream("SELECT 1")) == rows
+
+	stream = link.stream("SELECT 1")
+	# evicted by the commit of another sheet, after the lookup of this one
+	cache.max_size_bytes = 0
+	cache.evict()
+	assert not os.listdir(tmp_path)
+	assert list(stream) == rows
+	assert source.queries == 1
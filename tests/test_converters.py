@@ -0,0 +1,42 @@
+import datetime
+from decimal import Decimal
+
+from mysql.connector import FieldType
+
+import converters
+from converters import ColumnConverters
+from nau import QueryResult
+from report_google import cell_converters
+
+_CONVERTERS = {converters.NUMBER: lambda value: ('number', value), converters.TEXT: lambda value: ('text', value)}
+
+
+def _fallback(value):
+	return ('fallback', value)
+
+
+def test_the_columns_without_a_kind_get_the_function_of_their_first_value():
+	converter = ColumnConverters([None, None, converters.TEXT], _CONVERTERS, _fallback)
+	assert converter.convert([None, 'a', 'b']) == [('fallback', None), ('text', 'a'), ('text', 'b')]
+	assert converter.convert([1, 'c', 'd']) == [('number', 1), ('text', 'c'), ('text', 'd')]
+	# resolved once, with the function of the first value not NULL
+	assert converter.convert([2.5, 3, 'e']) == [('number', 2.5), ('text', 3), ('text', 'e')]
+
+
+def test_a_row_with_values_of_other_types_than_their_columns_is_converted_by_the_fallback():
+	# the first value of the column is a date, so its function is the one of the dates
+	converter = cell_converters([None, converters.NUMBER])
+	assert converter.convert([datetime.date(2026, 1, 5), Decimal('1.5')]) == ['2026-01-05', 1.5]
+	# a text on a column of dates, e.g. of a UNION, converts the whole row value by value
+	assert converter.convert(['unknown', Decimal('2.5')]) == ['unknown', '2.5']
+	assert converter.convert([None, None]) == ['', '']
+	assert converter.convert([datetime.datetime(2026, 1, 6, 10, 0), 3]) == ['2026-01-06', 3]
+
+
+def test_the_kinds_of_the_description_of_the_query():
+	result = QueryResult()
+	result.description = [('id', FieldType.LONGLONG), ('name', FieldType.VAR_STRING), ('created', FieldType.DATETIME), ('data', FieldType.BLOB)]
+	assert converters.column_kinds(result, ['id', 'name', 'created', 'data']) == [converters.NUMBER, converters.TEXT, converters.DATE, converters.OTHER]
+	# the description of other columns isn't used
+	assert converters.column_kinds(result, ['id', 'name']) == [None, None]
+	assert converters.column_kinds([{'id': 1}], ['id']) == [None]
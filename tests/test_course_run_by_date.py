@@ -0,0 +1,11 @@
+def test_course_without_overview_has_no_availability_state(reports_on_local_store, local_store):
+	course_id = 'course-v1:ORG0+DELETED+2020_T1'
+	local_store.connection.execute(f"INSERT INTO edxapp.student_courseenrollment VALUES (1000000, 1, '{course_id}', TIMESTAMP '2020-06-01 10:00:00', 1, 'audit')")
+	try:
+		rows = reports_on_local_store().course_run_by_date()
+	finally:
+		local_store.connection.execute("DELETE FROM edxapp.student_courseenrollment WHERE id = 1000000")
+
+	deleted = [row for row in rows if row['course_id'] == course_id]
+	assert [(row['date'], row['availability_state'], row['start'], row['end']) for row in deleted] == [('2020-06-01', None, None, None)]
+	assert all(row['availability_state'] is not None for row in rows if row['course_id'] != course_id)
@@ -0,0 +1,52 @@
+import datetime
+
+import pytest
+
+from nau import result_columns_and_rows
+
+# days from now of the enrollment start and end, and of the start and end, of a run on each state
+_RUNS = {
+	'ONGOING_OPEN': (-10, 10, -5, 30),
+	'FUTURE_OPEN': (-5, 30, 10, 40),
+	'ARCHIVED_OPEN': (-100, 10, -90, -10),
+	'FUTURE_NOT_YET_OPEN': (5, 30, 10, 40),
+	'FUTURE_CLOSED': (-30, -20, 10, 40),
+	'ONGOING_CLOSED': (-30, -20, -10, 10),
+	'ARCHIVED_CLOSED': (None, None, -90, -10),
+	# without an end the enrollment is never known to be open
+	'OTHER': (None, None, -10, None),
+}
+
+
+@pytest.fixture
+def runs_on_each_state(local_store):
+	"""
+	A course run on each availability state, with its dates relative to now, removed at the end.
+	"""
+	now = datetime.datetime.now()
+	ids = {}
+	for number, (state, days) in enumerate(_RUNS.items()):
+		course_id = f"course-v1:ORG0+STATE+2026_T{number}"
+		ids[course_id] = state
+		enrollment_start, enrollment_end, start, end = (None if value is None else now + datetime.timedelta(days=value) for value in days)
+		local_store.connection.execute(
+			"INSERT INTO edxapp.course_overviews_courseoverview "
+			"SELECT * REPLACE (? AS id, ? AS enrollment_start, ? AS enrollment_end, ? AS start, ? AS \"end\") "
+			"FROM edxapp.course_overviews_courseoverview LIMIT 1",
+			[course_id, enrollment_start, enrollment_end, start, end],
+		)
+	yield ids
+	local_store.connection.execute("DELETE FROM edxapp.course_overviews_courseoverview WHERE id LIKE 'course-v1:ORG0+STATE+%'")
+
+
+def _availability_states(report) -> dict:
+	(_, _, data), = report.produce_sheets(['course_runs'])
+	_, rows = result_columns_and_rows(data)
+	return {row['id']: row['availability_state'] for row in rows}
+
+
+def test_the_availability_states_of_the_exporter_are_the_ones_of_the_database(reports_on_local_store, runs_on_each_state):
+	on_database = _availability_states(reports_on_local_store())
+	on_exporter = _availability_states(reports_on_local_store(derive_in_exporter=True))
+	assert {course_id: on_database[course_id] for course_id in runs_on_each_state} == runs_on_each_state
+	assert on_exporter == on_database
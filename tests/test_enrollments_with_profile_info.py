@@ -0,0 +1,21 @@
+import collections
+
+from nau import result_columns_and_rows
+
+
+def _rows(report) -> collections.Counter:
+	_, rows = result_columns_and_rows(report.enrollments_with_profile_info())
+	return collections.Counter(tuple(row.items()) for row in rows)
+
+
+def test_derived_tables_have_the_rows_of_the_correlated_subqueries(reports_on_local_store):
+	derived = _rows(reports_on_local_store(derived_enrollments_with_profile_info=True))
+	correlated = _rows(reports_on_local_store(derived_enrollments_with_profile_info=False))
+	assert sum(derived.values()) == 2000
+	assert derived == correlated
+
+
+def test_derived_tables_count_the_passed_grades_and_certificates(reports_on_local_store):
+	rows = list(_rows(reports_on_local_store()).elements())
+	assert any(dict(row)['passed'] == 1 and dict(row)['certificate'] == 1 for row in rows)
+	assert any(dict(row)['passed'] == 0 and dict(row)['passed_timestamp'] is None for row in rows)
@@ -0,0 +1,80 @@
+import configparser
+import threading
+
+import pytest
+
+from fanout import FanOut
+from metrics import RunMetrics
+from nau import result_columns_and_rows
+from report_xlsx import export_to_xlsx
+
+
+class _StreamingReport:
+	"""
+	A report with a sheet of streamed rows, that records when all of them were produced.
+	"""
+	batch_size = 10
+
+	def __init__(self, rows: int):
+		self.rows = rows
+		self.produced = threading.Event()
+
+	def _stream(self):
+		yield from ({'n': n} for n in range(self.rows))
+		self.produced.set()
+
+	def produce_sheets(self, sheets_keys: list):
+		yield ('numbers', "Numbers", self._stream())
+
+
+def _reading_exporter(received: list, wait: threading.Event = None):
+	def export(report):
+		for _, _, data in report.produce_sheets(['numbers']):
+			if wait is not None:
+				assert wait.wait(timeout=10), "the producer was held by the slow target"
+			_, rows = result_columns_and_rows(data)
+			received.extend(row['n'] for row in rows)
+	return export
+
+
+def test_slow_target_spills_to_disk_without_holding_the_producer(tmp_path):
+	report = _StreamingReport(1000)
+	fast, slow = [], []
+	FanOut(report, [('fast', _reading_exporter(fast)), ('slow', _reading_exporter(slow, report.produced))], max_batches=2, spill_directory=str(tmp_path)).run()
+	assert fast == list(range(1000))
+	assert slow == list(range(1000))
+
+
+class _FailingReport:
+	"""
+	A report whose second sheet fails while it is produced.
+	"""
+	batch_size = 10
+
+	def __init__(self):
+		self.metrics = RunMetrics()
+
+	def available_sheets_to_export_keys(self):
+		return ['first', 'second']
+
+	def produce_sheets(self, sheets_keys: list):
+		yield ('first', "First", [{'n': 1}])
+		raise ValueError("the database went away")
+
+
+def test_a_failed_producer_keeps_the_previous_exports(tmp_path):
+	path = tmp_path / 'report.xlsx'
+	path.write_bytes(b'previous')
+	config = configparser.ConfigParser()
+	config.read_dict({'xlsx': {'file': str(path)}})
+	completed = []
+	def recording_exporter(report):
+		for sheet in report.produce_sheets(['first', 'second']):
+			pass
+		completed.append(True)
+
+	with pytest.raises(ValueError, match="the database went away"):
+		FanOut(_FailingReport(), [('xlsx', lambda report: export_to_xlsx(config, report)), ('recording', recording_exporter)]).run()
+	assert path.read_bytes() == b'previous'
+	assert not (tmp_path / 'report.manifest.json').exists()
+	assert completed == []
@@ -0,0 +1,74 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from hyperloglog import HyperLogLog, distinct_counts_by_window
+
+# the relative standard error of the default precision of 14
+_STANDARD_ERROR = 1.04 / np.sqrt(2 ** 14)
+
+
+def _sketch(values) -> HyperLogLog:
+	sketch = HyperLogLog()
+	sketch.add_many(np.asarray(values))
+	return sketch
+
+
+@pytest.mark.parametrize('count', [10, 1000, 20000, 200000])
+def test_the_estimates_are_within_the_error_bound(count):
+	values = np.random.default_rng(count).choice(10 ** 9, size=count, replace=False)
+	# with the values repeated
+	estimate = _sketch(np.concatenate([values, values[:count // 2]])).count()
+	assert abs(estimate - count) <= max(1, 4 * _STANDARD_ERROR * count)
+
+
+def test_the_merge_is_the_sketch_of_the_union_in_any_order():
+	rng = np.random.default_rng(0)
+	a, b, c = (rng.integers(0, 50000, size=20000) for _ in range(3))
+	left = _sketch(a)
+	left.merge(_sketch(b))
+	left.merge(_sketch(c))
+	bc = _sketch(b)
+	bc.merge(_sketch(c))
+	right = _sketch(a)
+	right.merge(bc)
+	assert np.array_equal(left.registers, right.registers)
+	assert np.array_equal(left.registers, _sketch(np.concatenate([a, b, c])).registers)
+	assert np.array_equal(HyperLogLog.from_bytes(14, left.to_bytes()).registers, left.registers)
+
+
+def _window_labels(day: datetime.date) -> dict:
+	year, week, _ = day.isocalendar()
+	return {'day': day.isoformat(), 'week': f"{year}-{week:02d}", 'month': day.strftime("%Y-%m")}
+
+
+def test_the_distinct_counts_of_each_window_are_near_the_exact_ones():
+	rng = np.random.default_rng(1)
+	first = datetime.date(2025, 12, 1)
+	users_by_day = {}
+	for number in range(120):
+		day = first + datetime.timedelta(days=number)
+		# a day without users isn't on the sketches, and a pool of users that grows
+		if number % 10 != 3:
+			users_by_day[day] = rng.integers(0, 2000 + 300 * number, size=int(rng.integers(100, 3000)))
+	sketches = {day.isoformat(): _sketch(users) for day, users in users_by_day.items()}
+
+	exact = {'day': {}, 'week': {}, 'month': {}, 'rolling_30_days': {}}
+	for day, users in users_by_day.items():
+		for window, label in _window_labels(day).items():
+			exact[window].setdefault(label, set()).update(users.tolist())
+		exact['rolling_30_days'][day.isoformat()] = set().union(*(
+			other_users.tolist() for other, other_users in users_by_day.items() if day - datetime.timedelta(days=29) <= other <= day))
+
+	for window, counts in exact.items():
+		estimates = distinct_counts_by_window(sketches, window)
+		assert [row['date'] for row in estimates] == sorted(counts)
+		errors = [abs(row['users'] - len(counts[row['date']])) / len(counts[row['date']]) for row in estimates]
+		# about 95% within 2 standard errors, and all within 4
+		assert sum(error <= 2 * _STANDARD_ERROR for error in errors) >= 0.9 * len(errors), window
+		assert max(errors) <= 4 * _STANDARD_ERROR, window
+
+
+def test_no_counts_without_sketches():
+	assert distinct_counts_by_window({}, 'week') == []
@@ -0,0 +1,98 @@
+import datetime
+import types
+
+import pytest
+
+import incremental
+from incremental import IncrementalState
+
+
+class _Database:
+	"""
+	The rows of a sheet bucketed by day, with the ranges of the queries run on it.
+	"""
+	def __init__(self, values: dict):
+		self.values = values
+		self.ranges = []
+
+	def query_function(self, date_range: tuple) -> str:
+		return "SELECT day, value FROM sheet" + ("" if date_range is None else f" WHERE {date_range}")
+
+	def run_range(self, date_range: tuple) -> list:
+		self.ranges.append(date_range)
+		start, end = date_range
+		assert end is None
+		return [
+			{'day': day, 'value': value} for day, value in sorted(self.values.items(), key=lambda item: (item[0] is not None, str(item[0])))
+			if start is None or (day is not None and day >= start.isoformat())
+		]
+
+
+@pytest.fixture
+def today(monkeypatch):
+	"""
+	Returns a function that sets the day of the runs.
+	"""
+	clock = {}
+	class FixedDate(datetime.date):
+		@classmethod
+		def today(cls):
+			return clock['today']
+	monkeypatch.setattr(incremental, 'datetime', types.SimpleNamespace(date=FixedDate, timedelta=datetime.timedelta))
+	def set_today(value: str):
+		clock['today'] = datetime.date.fromisoformat(value)
+	return set_today
+
+
+def _values(rows: list) -> dict:
+	return {row['day']: row['value'] for row in rows}
+
+
+def test_the_recent_buckets_are_replaced_and_the_older_ones_kept(tmp_path, today):
+	state = IncrementalState(str(tmp_path), safety_window_days=3, full_refresh_days=7)
+	database = _Database({None: 'undated', '2026-01-01': 'old', '2026-01-08': 'recent'})
+	today('2026-01-10')
+	rows = state.refresh('sheet', database.query_function, database.run_range, 'day')
+	assert database.ranges == [(None, None)]
+	assert [row['day'] for row in rows] == [None, '2026-01-01', '2026-01-08']
+
+	database.values.update({None: 'undated changed', '2026-01-01': 'old changed', '2026-01-08': 'recent changed', '2026-01-11': 'new'})
+	today('2026-01-11')
+	rows = state.refresh('sheet', database.query_function, database.run_range, 'day')
+	# since the watermark of the last run minus the safety window
+	assert database.ranges[-1] == (datetime.date(2026, 1, 7), None)
+	assert _values(rows) == {None: 'undated', '2026-01-01': 'old', '2026-01-08': 'recent changed', '2026-01-11': 'new'}
+	assert [row['day'] for row in rows] == [None, '2026-01-01', '2026-01-08', '2026-01-11']
+
+	# the full refresh every 7 days, from the last one
+	today('2026-01-16')
+	state.refresh('sheet', database.query_function, database.run_range, 'day')
+	assert database.ranges[-1] == (datetime.date(2026, 1, 8), None)
+	today('2026-01-17')
+	rows = state.refresh('sheet', database.query_function, database.run_range, 'day')
+	assert database.ranges[-1] == (None, None)
+	assert _values(rows) == database.values
+
+
+def test_the_refresh_starts_on_the_first_day_of_the_bucket(tmp_path, today):
+	state = IncrementalState(str(tmp_path), safety_window_days=3, full_refresh_days=0)
+	database = _Database({'2026-01-05': 1})
+	today('2026-01-10')
+	state.refresh('sheet', database.query_function, database.run_range, 'day', bucket='week')
+	# 2026-01-07 is on the week of Monday 2026-01-05
+	today('2026-03-20')
+	state.refresh('sheet', database.query_function, database.run_range, 'day', bucket='week')
+	assert database.ranges[-1] == (datetime.date(2026, 1, 5), None)
+	# never in full with full_refresh_days = 0, and 2026-03-17 is on the month of 2026-03-01
+	state.refresh('sheet', database.query_function, database.run_range, 'day', bucket='month')
+	assert database.ranges[-1] == (datetime.date(2026, 3, 1), None)
+
+
+def test_a_changed_query_refreshes_in_full(tmp_path, today):
+	state = IncrementalState(str(tmp_path))
+	database = _Database({'2026-01-01': 1})
+	today('2026-01-10')
+	state.refresh('sheet', database.query_function, database.run_range, 'day')
+	today('2026-01-11')
+	state.refresh('sheet', lambda date_range: database.query_function(date_range) + " ORDER BY day", database.run_range, 'day')
+	assert database.ranges[-1] == (None, None)
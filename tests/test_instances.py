@@ -0,0 +1,35 @@
+import configparser
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import instances
+import nau
+
+
+def test_the_merged_instances_use_the_cache_arguments_and_remove_their_spool_files(reports_on_local_store, tmp_path, monkeypatch):
+	# the instances on threads of this process, with its local store
+	monkeypatch.setattr(instances, 'ProcessPoolExecutor', ThreadPoolExecutor)
+	monkeypatch.chdir(tmp_path)
+	arguments = []
+	def reports(config, **kwargs):
+		arguments.append(kwargs)
+		return nau.Reports(config, **kwargs)
+	monkeypatch.setattr(instances, 'Reports', reports)
+	config = configparser.ConfigParser()
+	config.read_dict({
+		'connection': {'database': 'edxapp', 'password': ''},
+		'connection:a': {},
+		'connection:b': {},
+		'sheets': {'progress': ''},
+		'local_store': {'enabled': 'True'},
+		'instances': {'directory': str(tmp_path / 'instances'), 'max_parallel_instances': '1', 'merge': 'True', 'export': 'course_runs'},
+		'files': {'directory': str(tmp_path / 'export')},
+		'metrics': {'run_report': str(tmp_path / 'run_report.json')},
+	})
+
+	instances.export_instances(config, ['csv'], use_cache=False, refresh_sheets=['course_runs'])
+
+	assert arguments == [{'use_cache': False, 'refresh_sheets': ['course_runs']}] * 2
+	assert os.listdir(tmp_path / 'export')
+	for name in ('a', 'b'):
+		assert not os.path.exists(tmp_path / 'instances' / name / 'merge')
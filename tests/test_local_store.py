@@ -0,0 +1,59 @@
+import pytest
+
+from local_store import SOURCE_TABLES, LocalStore
+from nau import result_columns_and_rows
+
+from conftest import DATABASE, DatasetSource
+
+# the options of the [sheets] section that change the queries of the sheets
+_SHEETS_OPTIONS = [
+	{},
+	{'single_scan_enrollments': False, 'derived_enrollments_with_profile_info': False},
+	{'derive_in_exporter': True},
+	{'streaming': True, 'max_parallel_queries': 4},
+]
+
+
+@pytest.mark.parametrize('sheets_options', _SHEETS_OPTIONS)
+def test_the_queries_of_every_sheet_run_on_duckdb(reports_on_local_store, sheets_options):
+	report = reports_on_local_store(**sheets_options)
+	keys = list(report.available_sheets_to_export_keys())
+	produced = []
+	for key, _, data in report.produce_sheets(keys):
+		_, rows = result_columns_and_rows(data)
+		for _ in rows:
+			pass
+		produced.append(key)
+	assert produced == keys
+
+
+def test_the_partitioned_and_incremental_queries_run_on_duckdb(reports_on_local_store, tmp_path):
+	sections = {
+		'partitioned_queries': {'enabled': 'True', 'start': '2019-01-01'},
+		'incremental': {'enabled': 'True', 'state_dir': str(tmp_path)},
+		'distinct_users': {'mode': 'approximate'},
+	}
+	for _ in range(2):
+		# the second run only queries the buckets since the last one
+		report = reports_on_local_store(sections)
+		keys = list(report.available_sheets_to_export_keys())
+		for _, _, data in report.produce_sheets(keys):
+			_, rows = result_columns_and_rows(data)
+			for _ in rows:
+				pass
+
+
+def test_the_changed_enrollments_are_extracted_again(tmp_path):
+	source = DatasetSource(200)
+	store = LocalStore(str(tmp_path / 'store.duckdb'), source, DATABASE)
+	try:
+		store.extract(progress=False)
+		enrollments = source.tables['student_courseenrollment']
+		# an unenrollment of the first enrollment, on the columns id, user_id, course_id, created, is_active, mode
+		enrollments[0] = (*enrollments[0][:4], 0, 'verified')
+		table = next(table for table in SOURCE_TABLES if table.name == 'student_courseenrollment')
+		store._extract_table(table, store._incremental_condition(table))
+		row = store.connection.execute(f"SELECT is_active, mode FROM {DATABASE}.student_courseenrollment WHERE id = ?", [enrollments[0][0]]).fetchone()
+		assert row == (0, 'verified')
+	finally:
+		store.close()
@@ -0,0 +1,30 @@
+import metrics
+from metrics import RunMetrics
+
+MB = 1024 * 1024
+
+
+def test_each_sheet_records_its_own_growth_of_the_peak_memory(monkeypatch):
+	# the peak of the process before and after each block, and of the run
+	peaks = iter([100 * MB, 356 * MB, 356 * MB, 356 * MB, 356 * MB, 400 * MB, 400 * MB])
+	monkeypatch.setattr(metrics, 'peak_rss_bytes', lambda: next(peaks))
+	run = RunMetrics()
+	with run.producing('large'):
+		pass
+	# the peak of the process doesn't grow again after the larger sheet
+	with run.producing('small'):
+		pass
+	with run.writing('small', 'xlsx'):
+		pass
+	sheets = {sheet["key"]: sheet for sheet in run.to_dict(True)["sheets"]}
+	assert sheets['large']['peak_rss_growth_bytes'] == 256 * MB
+	# also the growth while it is written
+	assert sheets['small']['peak_rss_growth_bytes'] == 44 * MB
+
+
+def test_the_growth_of_the_peak_memory_is_unknown_without_the_peak(monkeypatch):
+	monkeypatch.setattr(metrics, 'peak_rss_bytes', lambda: None)
+	run = RunMetrics()
+	with run.producing('sheet'):
+		pass
+	assert run.to_dict(True)["sheets"][0]["peak_rss_growth_bytes"] is None
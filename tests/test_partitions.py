@@ -0,0 +1,63 @@
+from datetime import date
+
+import pytest
+
+from nau import PARTITIONED_SHEETS, result_columns_and_rows
+from partitions import date_partitions
+
+
+@pytest.mark.parametrize('first_day, last_day, partition, bucket, boundaries', [
+	(date(2026, 1, 15), date(2026, 4, 10), 'month', 'day', [date(2026, 1, 1), date(2026, 2, 1), date(2026, 3, 1), date(2026, 4, 1)]),
+	# from the Monday of the week of the first day
+	(date(2026, 1, 7), date(2026, 1, 20), 'week', 'day', [date(2026, 1, 5), date(2026, 1, 12), date(2026, 1, 19)]),
+	(date(2025, 5, 10), date(2026, 1, 1), 'quarter', 'day', [date(2025, 4, 1), date(2025, 7, 1), date(2025, 10, 1), date(2026, 1, 1)]),
+	(date(2019, 6, 1), date(2021, 1, 1), 'year', 'day', [date(2019, 1, 1), date(2020, 1, 1), date(2021, 1, 1)]),
+	# moved to the Monday of their week, so a week isn't split
+	(date(2026, 1, 1), date(2026, 3, 1), 'month', 'week', [date(2025, 12, 29), date(2026, 1, 26), date(2026, 2, 23)]),
+	# the weeks of the same month have the same boundary
+	(date(2026, 1, 7), date(2026, 2, 20), 'week', 'month', [date(2026, 1, 1), date(2026, 2, 1)]),
+])
+def test_the_boundaries_of_an_open_range(first_day, last_day, partition, bucket, boundaries):
+	points = [None, *boundaries, None]
+	assert date_partitions(None, first_day, last_day, partition, bucket) == list(zip(points, points[1:]))
+
+
+def test_the_boundaries_within_a_closed_range():
+	ranges = date_partitions((date(2026, 2, 1), date(2026, 4, 15)), date(2026, 1, 1), date(2026, 6, 1), 'month', 'day')
+	# the boundaries on the start of the range or outside of it are dropped
+	assert ranges == [(date(2026, 2, 1), date(2026, 3, 1)), (date(2026, 3, 1), date(2026, 4, 1)), (date(2026, 4, 1), date(2026, 4, 15))]
+	assert date_partitions((date(2026, 2, 1), None), date(2026, 1, 1), date(2026, 3, 1), 'month', 'day') == [(date(2026, 2, 1), date(2026, 3, 1)), (date(2026, 3, 1), None)]
+
+
+def test_a_single_range_when_the_first_day_is_after_the_last_one():
+	assert date_partitions(None, date(2100, 1, 1), date(2026, 1, 1), 'month', 'day') == [(None, None)]
+	assert date_partitions((date(2026, 1, 1), None), date(2100, 1, 1), date(2026, 1, 1), 'month', 'day') == [(date(2026, 1, 1), None)]
+
+
+def test_an_invalid_partition():
+	with pytest.raises(ValueError, match="Invalid partition"):
+		date_partitions(None, date(2026, 1, 1), date(2026, 2, 1), 'day', 'day')
+
+
+def _sheets(report) -> dict:
+	sheets = {}
+	for key, _, data in report.produce_sheets(list(PARTITIONED_SHEETS)):
+		_, rows = result_columns_and_rows(data)
+		sheets[key] = [tuple(row.items()) for row in rows]
+	return sheets
+
+
+@pytest.mark.parametrize('partitioned_queries', [
+	{'partition': 'month'},
+	{'partition': 'week', 'max_parallel': '8'},
+	{'partition': 'quarter'},
+	# a single query when the partitions start in the future
+	{'start': '2100-01-01'},
+])
+def test_the_partitioned_sheets_have_the_rows_of_a_single_query(reports_on_local_store, partitioned_queries):
+	single = _sheets(reports_on_local_store())
+	partitioned = _sheets(reports_on_local_store({'partitioned_queries': {'enabled': 'True', **partitioned_queries}}))
+	assert partitioned.keys() == single.keys()
+	for key in single:
+		assert partitioned[key] == single[key], key
+	assert all(single.values())
@@ -0,0 +1,38 @@
+import configparser
+import json
+
+from profiler import profile_queries
+
+_PLAN = {"query_block": {"cost_info": {"query_cost": "1.00"}, "table": {"table_name": "t", "access_type": "ALL", "rows_examined_per_scan": 10}}}
+
+
+class _ExplainingDatabase:
+	"""
+	A DataLink that answers the EXPLAIN statements with a plan, and the other queries with the wrapped one.
+	"""
+	def __init__(self, data_link):
+		self.data_link = data_link
+
+	def __getattr__(self, name):
+		return getattr(self.data_link, name)
+
+	def query(self, query):
+		assert query.startswith("EXPLAIN FORMAT=JSON")
+		return [{"EXPLAIN": json.dumps(_PLAN)}]
+
+
+def test_profile_of_all_the_sheets_without_errors(reports_on_local_store, tmp_path):
+	report = reports_on_local_store()
+	report.data_link = _ExplainingDatabase(report.data_link)
+	config = configparser.ConfigParser()
+	config.read_dict({'profile': {'directory': str(tmp_path)}})
+	with open(profile_queries(config, report)) as f:
+		sheets = json.load(f)["sheets"]
+
+	assert [key for key, entries in sheets.items() if any("error" in entry for entry in entries)] == []
+	assert len(sheets["summary"]) == 1
+	# the shared results are profiled apart from the sheets with the same name
+	assert len(sheets["organizations"]) == 1
+	assert len(sheets["shared:organization_names"]) == 1
+	assert len(sheets["shared:course_dimension"]) == 4
+	assert sheets["course_runs"] == []
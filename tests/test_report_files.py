@@ -0,0 +1,74 @@
+import datetime
+import json
+from decimal import Decimal
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from mysql.connector import FieldType
+
+from nau import QueryResult
+from report_files import write_jsonl, write_parquet
+
+_ROWS = [
+	{'id': 1, 'grade': Decimal('0.75'), 'created': datetime.datetime(2026, 1, 5, 10, 30, 15, 123456), 'day': datetime.date(2026, 1, 5), 'name': "Ana"},
+	{'id': 2, 'grade': None, 'created': None, 'day': None, 'name': None},
+	{'id': None, 'grade': Decimal('1'), 'created': datetime.datetime(2026, 2, 1), 'day': datetime.date(2026, 2, 1), 'name': "João"},
+]
+
+
+def _result(description: bool) -> QueryResult:
+	result = QueryResult(dict(row) for row in _ROWS)
+	if description:
+		result.description = [
+			('id', FieldType.LONGLONG), ('grade', FieldType.NEWDECIMAL), ('created', FieldType.DATETIME),
+			('day', FieldType.DATE), ('name', FieldType.VAR_STRING),
+		]
+	return result
+
+
+def test_jsonl_round_trip(tmp_path):
+	path = tmp_path / 'sheet.jsonl'
+	assert write_jsonl(_result(True), str(path)) == 3
+	lines = [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+	assert lines == [
+		{'id': 1, 'grade': 0.75, 'created': '2026-01-05T10:30:15.123456', 'day': '2026-01-05', 'name': "Ana"},
+		{'id': 2, 'grade': None, 'created': None, 'day': None, 'name': None},
+		{'id': None, 'grade': 1.0, 'created': '2026-02-01T00:00:00', 'day': '2026-02-01', 'name': "João"},
+	]
+
+
+def _expected_parquet_rows() -> list:
+	# the decimals are stored as doubles
+	return [{**row, 'grade': None if row['grade'] is None else float(row['grade'])} for row in _ROWS]
+
+
+def test_parquet_round_trip_with_the_types_of_the_description(tmp_path):
+	path = tmp_path / 'sheet.parquet'
+	assert write_parquet(_result(True), str(path), batch_size=2) == 3
+	table = pq.read_table(path)
+	assert table.schema.types == [pa.int64(), pa.float64(), pa.timestamp('us'), pa.date32(), pa.string()]
+	assert table.to_pylist() == _expected_parquet_rows()
+	# a row group per batch
+	assert pq.ParquetFile(path).num_row_groups == 2
+
+
+def test_parquet_round_trip_with_the_types_of_the_first_batch(tmp_path):
+	path = tmp_path / 'sheet.parquet'
+	assert write_parquet(_result(False), str(path), batch_size=3) == 3
+	table = pq.read_table(path)
+	assert table.schema.types == [pa.int64(), pa.float64(), pa.timestamp('us'), pa.date32(), pa.string()]
+	assert table.to_pylist() == _expected_parquet_rows()
+
+
+def test_parquet_columns_of_the_first_batch_with_mixed_or_no_values(tmp_path):
+	path = tmp_path / 'sheet.parquet'
+	rows = [
+		{'amount': 1, 'note': None},
+		{'amount': Decimal('2.5'), 'note': None},
+		# on the next batch, converted to the type of the first one
+		{'amount': 3, 'note': 7},
+	]
+	assert write_parquet(rows, str(path), batch_size=2) == 3
+	table = pq.read_table(path)
+	assert table.schema.types == [pa.float64(), pa.string()]
+	assert table.to_pylist() == [{'amount': 1.0, 'note': None}, {'amount': 2.5, 'note': None}, {'amount': 3.0, 'note': '7'}]
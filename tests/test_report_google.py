@@ -0,0 +1,118 @@
+import configparser
+import time
+
+import pytest
+from gspread.exceptions import APIError
+
+import benchmark
+import report_google
+from report_google import RateLimiter, Uploader, export_queries_to_google
+
+
+class _Response:
+	def __init__(self, status_code: int):
+		self.status_code = status_code
+		self.text = f"HTTP {status_code}"
+
+	def json(self):
+		return {"error": {"code": self.status_code, "message": self.text}}
+
+
+def _failing(status_codes: list, result='done'):
+	"""
+	A function that raises an APIError with each status code of `status_codes` and then returns `result`.
+	"""
+	calls = []
+	def function():
+		calls.append(time.monotonic())
+		if len(calls) <= len(status_codes):
+			raise APIError(_Response(status_codes[len(calls) - 1]))
+		return result
+	function.calls = calls
+	return function
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+	slept = []
+	monkeypatch.setattr(report_google.time, 'sleep', slept.append)
+	return slept
+
+
+def test_quota_and_server_errors_are_retried_with_exponential_backoff(sleeps):
+	uploader = Uploader(max_retries=5, backoff=1.0)
+	function = _failing([429, 503, 500])
+	assert uploader.call(function) == 'done'
+	assert len(function.calls) == 4
+	assert uploader.stats["requests"] == 4 and uploader.stats["retries"] == 3
+	# backoff * 2 ** attempt, plus a jitter of up to the same
+	for attempt, seconds in enumerate(sleeps):
+		assert 2 ** attempt <= seconds <= 2 * 2 ** attempt
+
+
+def test_other_errors_and_the_last_retry_are_raised(sleeps):
+	with pytest.raises(APIError):
+		Uploader(max_retries=5).call(_failing([400]))
+	assert sleeps == []
+	uploader = Uploader(max_retries=2)
+	with pytest.raises(APIError):
+		uploader.call(_failing([429, 429, 429]))
+	assert uploader.stats["retries"] == 2
+
+
+def test_token_bucket_limits_the_rate_after_the_burst():
+	limiter = RateLimiter(rate=50, burst=3)
+	start = time.monotonic()
+	for _ in range(3):
+		limiter.acquire()
+	assert time.monotonic() - start < 0.02
+	for _ in range(5):
+		limiter.acquire()
+	# the 5 requests after the burst wait for a token each 1 / 50 seconds
+	assert time.monotonic() - start >= 5 / 50 * 0.9
+
+
+@pytest.fixture
+def google_sheets(monkeypatch):
+	"""
+	The local gspread client of the benchmark, recording the rows sent on each request, whose
+	first batch_update fails with a quota error.
+	"""
+	requests = []
+	update, batch_update = benchmark._LocalWorksheet.update, benchmark._LocalWorksheet.batch_update
+	def recording_update(self, range_name, values, **kwargs):
+		requests.append((self.title, len(values)))
+		return update(self, range_name, values, **kwargs)
+	def failing_batch_update(self, data, **kwargs):
+		if not any(request == 'quota' for request in requests):
+			requests.append('quota')
+			raise APIError(_Response(429))
+		requests.append((self.title, sum(len(d['values']) for d in data)))
+		return batch_update(self, data, **kwargs)
+	monkeypatch.setattr(benchmark._LocalWorksheet, 'update', recording_update)
+	monkeypatch.setattr(benchmark._LocalWorksheet, 'batch_update', failing_batch_update)
+	client = benchmark.LocalGoogleSheets()
+	client.requests = requests
+	return client
+
+
+def test_delta_upload_retries_the_quota_error_and_skips_an_unchanged_sheet(reports_on_local_store, google_sheets, tmp_path, sleeps):
+	config = configparser.ConfigParser()
+	config.read_dict({
+		'google_upload': {
+			'delta': 'True', 'fingerprints_dir': str(tmp_path / 'fingerprints'), 'manifest': str(tmp_path / 'manifest.json'),
+			'requests_per_minute': '0', 'backoff_seconds': '0.1',
+		},
+		'google_sheets': {'organizations': 'spreadsheet-a', 'enrollments_gender': 'spreadsheet-b'},
+	})
+	export_queries_to_google(config, reports_on_local_store(), google_sheets)
+	first = google_sheets.requests[:]
+	assert first[0] == 'quota' and len(sleeps) == 1
+	assert ("Organizations", 5 + 1) in first
+	assert any(title == "Enrollments with gender" and rows > 1 for title, rows in first[1:])
+
+	report = reports_on_local_store()
+	export_queries_to_google(config, report, google_sheets)
+	# nothing changed, so no rows are sent again
+	assert google_sheets.requests == first
+	assert report.metrics.sheet('organizations').targets['google_sheets']['rows'] == 5
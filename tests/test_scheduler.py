@@ -0,0 +1,125 @@
+import configparser
+import datetime
+import types
+
+import pytest
+
+import scheduler
+from metrics import RunMetrics
+from scheduler import Cron, Interval, Scheduler, cadence
+
+
+@pytest.mark.parametrize('expression, after, expected', [
+	# every 5 minutes from the 5th, 5/10 is 5, 15, ..., 55
+	('5/10 * * * *', '2026-01-05 10:05', '2026-01-05 10:15'),
+	('5/10 * * * *', '2026-01-05 10:55', '2026-01-05 11:05'),
+	('*/15 * * * *', '2026-01-05 10:59:59', '2026-01-05 11:00'),
+	('0 2 * * *', '2026-01-05 02:00', '2026-01-06 02:00'),
+	# ranges and lists
+	('30 8-10,14 * * *', '2026-01-05 10:30', '2026-01-05 14:30'),
+	# Sunday as 0 and as 7, the 2026-01-11 is a Sunday
+	('0 0 * * 0', '2026-01-05 00:00', '2026-01-11 00:00'),
+	('0 0 * * 7', '2026-01-05 00:00', '2026-01-11 00:00'),
+	('0 0 * * 1-5', '2026-01-09 12:00', '2026-01-12 00:00'),
+	# with both restricted, the day of month or the day of week, the 2026-01-07 is a Wednesday
+	('0 0 15 * 3', '2026-01-05 00:00', '2026-01-07 00:00'),
+	('0 0 15 * 3', '2026-01-14 00:00', '2026-01-15 00:00'),
+	# with one of them *, only the other one
+	('0 0 15 * *', '2026-01-05 00:00', '2026-01-15 00:00'),
+	# the rollover of the months and the years
+	('0 0 1 * *', '2026-01-31 23:59', '2026-02-01 00:00'),
+	('0 0 31 * *', '2026-01-31 00:00', '2026-03-31 00:00'),
+	('0 0 29 2 *', '2026-01-01 00:00', '2028-02-29 00:00'),
+	('0 9 1 1,7 *', '2026-07-01 09:00', '2027-01-01 09:00'),
+])
+def test_the_next_occurrence_of_a_cron_expression(expression, after, expected):
+	assert Cron(expression).next(datetime.datetime.fromisoformat(after)) == datetime.datetime.fromisoformat(expected)
+
+
+@pytest.mark.parametrize('expression', ['* * * *', '60 * * * *', '0 0 0 * *', '0 0 * 13 *', '0 0 * * 8', '5-1 * * * *'])
+def test_invalid_cron_expressions(expression):
+	with pytest.raises(ValueError):
+		Cron(expression)
+
+
+def test_a_cron_expression_that_never_matches():
+	with pytest.raises(ValueError, match="never matches"):
+		Cron('0 0 30 2 *').next(datetime.datetime(2026, 1, 1))
+
+
+def test_the_cadence_of_an_interval_or_a_cron_expression():
+	assert isinstance(cadence('30m'), Interval) and cadence('30m').seconds == 1800
+	assert cadence(' 2 h ').seconds == 7200
+	assert cadence('1d').next(datetime.datetime(2026, 1, 5, 10)) == datetime.datetime(2026, 1, 6, 10)
+	assert isinstance(cadence('0 2 * * *'), Cron)
+
+
+class _Clock:
+	"""
+	The `datetime` module of the scheduler, with the time set by the test.
+	"""
+	def __init__(self, now: str):
+		self.set(now)
+		clock = self
+		class FixedDatetime(datetime.datetime):
+			@classmethod
+			def now(cls, tz=None):
+				return clock.now
+		self.module = types.SimpleNamespace(datetime=FixedDatetime, timedelta=datetime.timedelta)
+
+	def set(self, now: str):
+		self.now = datetime.datetime.fromisoformat(now)
+
+
+class _Report:
+	def __init__(self):
+		self.metrics = RunMetrics()
+
+	def available_sheets_to_export_keys(self):
+		return ['hourly', 'often', 'failing']
+
+	def forget_shared_results(self):
+		pass
+
+
+def test_run_pending_runs_the_due_sheets_once_and_skips_the_missed_runs(monkeypatch, tmp_path):
+	clock = _Clock('2026-01-05 10:00:30')
+	monkeypatch.setattr(scheduler, 'datetime', clock.module)
+	runs = []
+	def export_report(config, report, export_modes_selected, google_client):
+		keys = report.available_sheets_to_export_keys()
+		runs.append(keys)
+		if 'failing' in keys:
+			raise RuntimeError("the export failed")
+	monkeypatch.setattr(scheduler, 'export_report', export_report)
+	config = configparser.ConfigParser()
+	config.read_dict({
+		'daemon': {'default': '0 * * * *', 'jitter_seconds': '0'},
+		'daemon_sheets': {'often': '10m', 'failing': '0 12 * * *'},
+		'metrics': {'run_report': str(tmp_path / 'run_report.json')},
+	})
+	daemon = Scheduler(config, _Report(), ['csv'])
+
+	# an interval is due at the start
+	assert daemon.run_pending() == 600
+	assert runs == [['often']]
+	# nothing is due yet
+	clock.set('2026-01-05 10:05:30')
+	assert daemon.run_pending() == 300
+	assert runs == [['often']]
+	# after a long run, the runs missed of each cadence run once, together
+	clock.set('2026-01-05 11:35:00')
+	daemon.run_pending()
+	assert runs == [['often'], ['hourly', 'often']]
+	status = daemon.status()["sheets"]
+	assert status['often']['runs'] == 2 and status['often']['next_due'] == '2026-01-05T11:45:00'
+	assert status['hourly']['runs'] == 1 and status['hourly']['next_due'] == '2026-01-05T12:00:00'
+
+	# a failed run doesn't stop the others
+	clock.set('2026-01-05 12:00:00')
+	daemon.run_pending()
+	assert runs[-1] == ['hourly', 'often', 'failing']
+	status = daemon.status()["sheets"]
+	assert status['failing']['failures'] == 1 and status['failing']['last_error'] == "RuntimeError: the export failed"
+	assert status['failing']['next_due'] == '2026-01-06T12:00:00'
+	assert status['hourly']['last_succeeded'] is False
@@ -0,0 +1,94 @@
+import configparser
+import json
+import zipfile
+
+import pytest
+
+import benchmark
+from metrics import RunMetrics
+from report_google import export_queries_to_google
+from report_xlsx import export_to_xlsx
+from sharding import ShardedRows, shard_title
+
+
+class _ListReport:
+	"""
+	A report with a sheet of numbered rows for each key of `sheets`, with its number of rows.
+	"""
+	batch_size = 100
+	progress = False
+
+	def __init__(self, sheets: dict):
+		self.sheets = sheets
+		self.metrics = RunMetrics()
+
+	def available_sheets_to_export_keys(self):
+		return list(self.sheets)
+
+	def produce_sheets(self, sheets_keys: list):
+		for key in sheets_keys:
+			if key in self.sheets:
+				yield key, key.title(), [{'n': n, 'name': f"row {n}"} for n in range(1, self.sheets[key] + 1)]
+
+
+def _manifest_shards(path) -> dict:
+	with open(path) as f:
+		return {key: [(shard.get("spreadsheet_id"), shard["worksheet"], shard["first_row"], shard["rows"]) for shard in sheet["shards"]]
+			for key, sheet in json.load(f)["sheets"].items()}
+
+
+def test_sharded_rows_take_shards_of_each_size():
+	rows = ShardedRows(range(10))
+	shards = []
+	while rows.has_more():
+		shards.append(list(rows.take(4)))
+	assert shards == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+	assert rows.count == 10
+	assert shard_title("Enrollments with profile info", 1, 20) == "Enrollments with pro"
+	# the suffix of the number is kept within the max length
+	assert shard_title("Enrollments with profile info", 12, 20) == "Enrollments wit (12)"
+
+
+def test_xlsx_sheets_over_the_rows_of_a_worksheet_continue_on_numbered_ones(tmp_path):
+	config = configparser.ConfigParser()
+	config.read_dict({'xlsx': {'file': str(tmp_path / 'report.xlsx'), 'max_rows': '4'}})
+	export_to_xlsx(config, _ListReport({'numbers': 10, 'few': 3}))
+	assert _manifest_shards(tmp_path / 'report.manifest.json') == {
+		# 3 rows and the header on each worksheet
+		'numbers': [(None, "Numbers", 1, 3), (None, "Numbers (2)", 4, 3), (None, "Numbers (3)", 7, 3), (None, "Numbers (4)", 10, 1)],
+		'few': [(None, "Few", 1, 3)],
+	}
+	with zipfile.ZipFile(tmp_path / 'report.xlsx') as workbook:
+		assert len([name for name in workbook.namelist() if name.startswith('xl/worksheets/sheet')]) == 5
+
+
+def _google_config(tmp_path, sheets: dict) -> configparser.ConfigParser:
+	config = configparser.ConfigParser()
+	config.read_dict({
+		# 2 columns, so each spreadsheet has the header and 4 rows
+		'google_upload': {'max_cells': '10', 'requests_per_minute': '0', 'manifest': str(tmp_path / 'manifest.json')},
+		'google_sheets': sheets,
+	})
+	return config
+
+
+def test_google_sheets_over_the_cells_of_a_spreadsheet_continue_on_the_next_ones(tmp_path):
+	client = benchmark.LocalGoogleSheets()
+	config = _google_config(tmp_path, {'numbers': 'a, b, c', 'other': 'd'})
+	export_queries_to_google(config, _ListReport({'numbers': 10, 'other': 2}), client)
+	assert _manifest_shards(tmp_path / 'manifest.json') == {
+		'numbers': [('a', "Numbers", 1, 4), ('b', "Numbers", 5, 4), ('c', "Numbers", 9, 2)],
+		'other': [('d', "Other", 1, 2)],
+	}
+
+	# fewer rows, and the sheets not exported keep their previous shards
+	export_queries_to_google(config, _ListReport({'numbers': 3}), client)
+	assert _manifest_shards(tmp_path / 'manifest.json') == {
+		'numbers': [('a', "Numbers", 1, 3)],
+		'other': [('d', "Other", 1, 2)],
+	}
+	# the shards not needed anymore are cleared
+	assert [client.open_by_key(key).worksheet("Numbers").row_count for key in ('b', 'c')] == [1, 1]
+
+	with pytest.raises(ValueError, match="doesn't fit on its 3 spreadsheets"):
+		export_queries_to_google(config, _ListReport({'numbers': 13}), client)